@@ -0,0 +1,134 @@
+import io
+import warnings
+
+import config
+import metrics
+from image_converter import ImageConverter
+
+# Enough to get past a large EXIF block to a JPEG's frame header
+SNIFF_BYTES = 128 * 1024
+
+# Where an admitted job runs: the normal pool, or the low-priority one for expensive inputs
+LIGHT = 'light'
+HEAVY = 'heavy'
+
+# Image formats we convert, as named by PIL
+IMAGE_FORMATS = ('JPEG', 'PNG')
+
+# Relative cost of a conversion per MB of input and per PDF page, for ordering queued jobs
+COST_PER_MB = 1.0
+COST_PER_PAGE = {'pdf_to_text': 0.2, 'pdf_to_csv': 1.0}
+
+
+class AdmissionError(Exception):
+    """Raised when an input is refused before it's downloaded or decoded"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Admission:
+    """Cheap pre-flight checks deciding whether a job runs at all, and in which lane
+
+    check_size() runs on the size Telegram reports, before downloading.
+    image_lane() and pdf_lane() look at the first bytes of the download
+    only: the real format and the dimensions, never the pixels. Inputs
+    over the pixel or page limits are refused; valid ones whose decode
+    would need more than HEAVY_DECODE_BYTES of memory, or PDFs over
+    HEAVY_PDF_PAGES, go to the heavy lane. Inputs whose cost can't be told
+    from their header also go there, where the converters check again.
+    estimate_cost() turns the size and page count into the cost the
+    executors order queued jobs by.
+    """
+
+    @staticmethod
+    def check_size(file_size, max_size=None):
+        """Refuse a file by its Telegram-reported size"""
+        max_size = max_size or config.MAX_FILE_SIZE
+        if file_size and file_size > max_size:
+            raise Admission._reject('size', f"File is too big. Maximum size is {max_size // (1024 * 1024)}MB")
+
+    @staticmethod
+    def image_lane(source):
+        """Sniff an image (bytes or a file path) and return the lane its conversion should run in"""
+        # Loaded on the first upload rather than at startup
+        from PIL import Image
+
+        head = Admission._read_head(source)
+        if ImageConverter.read_jpeg_info(head):
+            # Embedded as-is without decoding, so it costs no more than its size
+            return LIGHT
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+                with Image.open(io.BytesIO(head)) as image:
+                    image_format, (width, height), bands = image.format, image.size, len(image.getbands())
+        except Image.DecompressionBombError:
+            raise Admission._reject('pixels', f"Image is too large, the limit is {Admission._megapixels()} megapixels")
+        except Exception:
+            # The header doesn't fit in the first bytes; let the converter check it
+            if head[:2] == b'\xff\xd8' or head[:8] == b'\x89PNG\r\n\x1a\n':
+                return HEAVY
+            raise Admission._reject('format', "This file is not a JPG or PNG image")
+
+        if image_format not in IMAGE_FORMATS:
+            raise Admission._reject('format', "This file is not a JPG or PNG image")
+        if width * height > config.MAX_IMAGE_PIXELS:
+            raise Admission._reject('pixels', f"Image is too large, the limit is {Admission._megapixels()} megapixels")
+
+        # Decoded pixels plus the RGB copy made for the PDF
+        decode_bytes = width * height * (bands + 3)
+        return HEAVY if decode_bytes > config.HEAVY_DECODE_BYTES else LIGHT
+
+    @staticmethod
+    def sniff_pdf(path):
+        """Refuse a file that doesn't start like a PDF"""
+        # The header may follow some junk within the first kilobyte
+        if b'%PDF-' not in Admission._read_head(path, 1024):
+            raise Admission._reject('format', "This file is not a valid PDF")
+
+    @staticmethod
+    def pdf_lane(path, max_pages=None):
+        """Sniff a PDF and return the lane its conversion should run in, by page count, and the page count
+
+        The page count is None when the PDF's page tree can't be read.
+        """
+        from pypdf import PdfReader
+
+        max_pages = max_pages or config.MAX_PDF_PAGES
+        Admission.sniff_pdf(path)
+        try:
+            # Reads the xref and page tree, not the page contents
+            with open(path, 'rb') as pdf_file:
+                page_count = len(PdfReader(pdf_file).pages)
+        except Exception:
+            return HEAVY, None
+        if page_count > max_pages:
+            raise Admission._reject('pages', f"PDF has {page_count} pages, the limit is {max_pages}")
+        return HEAVY if page_count > config.HEAVY_PDF_PAGES else LIGHT, page_count
+
+    @staticmethod
+    def estimate_cost(operation, size, page_count=None):
+        """Relative cost of a conversion from its input size in bytes and, for PDFs, its page count"""
+        cost = 1.0 + COST_PER_MB * (size or 0) / (1024 * 1024)
+        if page_count:
+            cost += COST_PER_PAGE.get(operation, 0.0) * page_count
+        return cost
+
+    @staticmethod
+    def _read_head(source, size=SNIFF_BYTES):
+        if isinstance(source, str):
+            with open(source, 'rb') as source_file:
+                return source_file.read(size)
+        return source[:size]
+
+    @staticmethod
+    def _megapixels():
+        return config.MAX_IMAGE_PIXELS // 1000000
+
+    @staticmethod
+    def _reject(reason, message):
+        metrics.ADMISSION_REJECTIONS.labels(reason=reason).inc()
+        return AdmissionError(message, reason)
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumCollector:
+    """Collect updates that share a media_group_id and hand them over as one batch
+
+    Telegram delivers each photo of an album as a separate update. A batch is
+    flushed once no new part has arrived for `window` seconds, by running the
+    on_album coroutine function as a task on the event loop.
+    """
+
+    def __init__(self, on_album, window=1.0):
+        self.on_album = on_album
+        self.window = window
+        self._groups = {}
+        self._tasks = set()
+
+    def add(self, media_group_id, item):
+        """Add one part of an album, (re)starting its flush timer; call from the event loop"""
+        group = self._groups.get(media_group_id)
+        if group is None:
+            group = self._groups[media_group_id] = {'items': [], 'timer': None}
+        else:
+            group['timer'].cancel()
+
+        group['items'].append(item)
+        group['timer'] = asyncio.get_running_loop().call_later(self.window, self._flush, media_group_id)
+
+    def _flush(self, media_group_id):
+        group = self._groups.pop(media_group_id, None)
+        if not group:
+            return
+
+        # Keep a reference until the task is done, the loop only holds weak ones
+        task = asyncio.get_running_loop().create_task(self._run(media_group_id, group['items']))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, media_group_id, items):
+        try:
+            await self.on_album(items)
+        except Exception as e:
+            logger.error(f"Error processing album {media_group_id}: {str(e)}")
@@ -0,0 +1,109 @@
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+
+from corpus import make_image_corpus, make_table_corpus, make_text_corpus
+from fake_bot_api import FakeBotAPI
+from run_bench import _ms, collect_results, percentile, register, send_request, start_bot, stop_bot, wait_until_ready
+
+
+def summarize(latencies, requests, errors, busy):
+    latencies = sorted(latencies)
+    return {
+        'requests': requests,
+        'completed': len(latencies),
+        'errors': errors,
+        'busy': busy,
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 0.50)),
+            'p95': _ms(percentile(latencies, 0.95)),
+            'max': _ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+def run_mixed(api, corpus, args, workdir):
+    """Fill the workers with /tocsv and /totext jobs, then time single photos sent while they run"""
+    event_index = len(api.events_since(0))
+    process = start_bot(api, workdir, {'CONVERSION_WORKERS': str(args.workers)})
+    chat_ids = itertools.count(10 ** 6)
+    try:
+        wait_until_ready(api, process, event_index)
+        event_index = len(api.events_since(0))
+
+        heavy = {}
+        for number in range(args.heavy):
+            scenario = 'tocsv' if number % 2 == 0 else 'totext'
+            chat_id = next(chat_ids)
+            heavy[chat_id] = send_request(api, scenario, chat_id, corpus[scenario], number)
+
+        # Photos arrive while the heavy jobs are queued and running
+        time.sleep(args.delay)
+        photos = {}
+        for number in range(args.photos):
+            chat_id = next(chat_ids)
+            photos[chat_id] = api.push_message(chat_id, document=register(api, corpus['image_to_pdf'][number % 2]))
+            time.sleep(1 / args.rate)
+
+        photo_latencies, photo_errors, photo_busy, _ = collect_results(api, photos, event_index, args.timeout)
+        heavy_latencies, heavy_errors, heavy_busy, _ = collect_results(api, heavy, event_index, args.timeout)
+    finally:
+        stop_bot(process)
+        api.clear_updates()
+
+    return {
+        'photos': summarize(photo_latencies, args.photos, photo_errors, photo_busy),
+        'heavy': summarize(heavy_latencies, args.heavy, heavy_errors, heavy_busy),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure photo latency while /tocsv and /totext jobs saturate the workers")
+    parser.add_argument('--heavy', type=int, default=12, help="/tocsv and /totext requests sent first")
+    parser.add_argument('--photos', type=int, default=10, help="single photos sent while they run")
+    parser.add_argument('--rate', type=float, default=4.0, help="photos per second")
+    parser.add_argument('--delay', type=float, default=1.0, help="seconds between the heavy requests and the photos")
+    parser.add_argument('--workers', type=int, default=2, help="CONVERSION_WORKERS of the started bot")
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = {
+            # The two smaller images, so the photos themselves stay cheap
+            'image_to_pdf': make_image_corpus(os.path.join(directory, 'images'))[:2],
+            'totext': make_text_corpus(os.path.join(directory, 'text'), page_counts=(100,)),
+            'tocsv': make_table_corpus(os.path.join(directory, 'tables'), page_counts=(50,)),
+        }
+        workdir = os.path.join(directory, 'run')
+        os.makedirs(workdir)
+
+        api = FakeBotAPI(latency=0.02).start()
+        try:
+            results = run_mixed(api, corpus, args, workdir)
+        finally:
+            api.stop()
+
+    report = json.dumps({
+        'benchmark': 'mixed_load',
+        'parameters': {
+            'heavy': args.heavy,
+            'photos': args.photos,
+            'rate': args.rate,
+            'workers': args.workers,
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfplumber
+
+from corpus import make_table_corpus
+from pdf_converter import PDFConverter
+
+
+def time_runs(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def pdfplumber_baseline(pdf_path):
+    """pdfplumber's own line/text table finder, for comparison"""
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages:
+            page.extract_tables({"vertical_strategy": "text", "horizontal_strategy": "text"})
+            page.flush_cache()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDFConverter.pdf_to_csv on generated table PDFs")
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', action='store_true', help="also time pdfplumber.extract_tables")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for pdf_path in make_table_corpus(directory, args.pages):
+            with pdfplumber.open(pdf_path) as pdf:
+                pages = len(pdf.pages)
+
+            def convert():
+                PDFConverter.cleanup_files([PDFConverter.pdf_to_csv(pdf_path)])
+
+            timings = time_runs(convert, args.repeat)
+            result = {
+                'file': os.path.basename(pdf_path),
+                'pages': pages,
+                'median_seconds': statistics.median(timings),
+                'pages_per_second': pages / statistics.median(timings),
+            }
+            if args.baseline:
+                baseline = statistics.median(time_runs(lambda: pdfplumber_baseline(pdf_path), args.repeat))
+                result['baseline_median_seconds'] = baseline
+            results.append(result)
+
+    report = json.dumps({'benchmark': 'pdf_to_csv', 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from corpus import make_image_corpus, make_text_corpus
+from fake_bot_api import FakeBotAPI
+from run_bench import ROOT, _chat_id, _ms, collect_results, register, start_bot, stop_bot
+
+IMPORT_SCRIPT = (
+    "import time\n"
+    "started = time.perf_counter()\n"
+    "import bot\n"
+    "print(time.perf_counter() - started)\n"
+)
+
+
+def time_import(workdir):
+    """Seconds a fresh interpreter takes to import bot.py"""
+    env = dict(os.environ, TEMP_DIR=os.path.join(workdir, 'temp'))
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def wait_for_polling(api, process, event_index, timeout):
+    """Time at which the bot cleared its webhook, right before it starts polling"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"Bot exited during startup with code {process.returncode}")
+        for event in api.events_since(event_index):
+            if event['method'] == 'deleteWebhook':
+                return event['time']
+        time.sleep(0.01)
+    raise Exception("Bot did not start polling in time")
+
+
+def time_start(api, workdir, image, text_pdf, timeout):
+    """Launch the bot, then time its first image and first text conversion"""
+    event_index = len(api.events_since(0))
+    launched = time.monotonic()
+    process = start_bot(api, workdir, {})
+    try:
+        polling = wait_for_polling(api, process, event_index, timeout)
+        event_index = len(api.events_since(0))
+        sent = {
+            1: api.push_message(1, document=register(api, image)),
+            2: api.push_message(2, document=register(api, text_pdf), caption='/totext'),
+        }
+        requested = dict(sent)
+        latencies, errors, busy, finished = collect_results(api, sent, event_index, timeout)
+    finally:
+        stop_bot(process)
+        api.clear_updates()
+
+    if errors or busy or len(latencies) < 2:
+        raise Exception("The first requests after startup did not all succeed")
+    replies = {}
+    for event in api.events_since(event_index):
+        chat_id = _chat_id(event['params'])
+        if event['method'] == 'sendDocument' and chat_id in requested and chat_id not in replies:
+            replies[chat_id] = event['time'] - requested[chat_id]
+    return {
+        'to_polling': polling - launched,
+        'first_image': replies[1],
+        'first_text': replies[2],
+    }
+
+
+def summarize(timings):
+    return {
+        'median_ms': _ms(statistics.median(timings)),
+        'min_ms': _ms(min(timings)),
+        'max_ms': _ms(max(timings)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's cold start against a local fake Bot API server")
+    parser.add_argument('--repeat', type=int, default=3, help="cold starts to measure")
+    parser.add_argument('--workers', type=int, default=2, help="CONVERSION_WORKERS of the started bot")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    os.environ['CONVERSION_WORKERS'] = str(args.workers)
+
+    with tempfile.TemporaryDirectory() as directory:
+        image = make_image_corpus(os.path.join(directory, 'images'))[0]
+        text_pdf = make_text_corpus(os.path.join(directory, 'text'))[0]
+
+        imports = [time_import(directory) for _ in range(args.repeat)]
+
+        api = FakeBotAPI(latency=0).start()
+        starts = []
+        try:
+            for number in range(args.repeat):
+                workdir = os.path.join(directory, f"run_{number}")
+                os.makedirs(workdir)
+                starts.append(time_start(api, workdir, image, text_pdf, args.timeout))
+        finally:
+            api.stop()
+
+    report = json.dumps({
+        'benchmark': 'startup',
+        'parameters': {'repeat': args.repeat, 'workers': args.workers, 'cpu_count': os.cpu_count()},
+        'results': {
+            'import_bot': summarize(imports),
+            'launch_to_polling': summarize([start['to_polling'] for start in starts]),
+            'first_image_reply': summarize([start['first_image'] for start in starts]),
+            'first_text_reply': summarize([start['first_text'] for start in starts]),
+        },
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
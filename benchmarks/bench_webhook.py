@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import socket
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from corpus import make_image_corpus
+from fake_bot_api import FakeBotAPI
+from run_bench import _ms, collect_results, percentile, register, start_bot, stop_bot, wait_until_ready
+
+SECRET_TOKEN = 'bench-secret'
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def post_update(url, update, secret_token):
+    """POST an update the way Telegram does; returns the HTTP status and the seconds until it was answered"""
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret_token is not None:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret_token)
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.monotonic() - started
+
+
+def check_refuses_without_secret(api, workdir, port):
+    """Start the bot in webhook mode with no WEBHOOK_SECRET_TOKEN; it must exit without setting a webhook"""
+    event_index = len(api.events_since(0))
+    process = start_bot(api, workdir, {
+        'BOT_MODE': 'webhook',
+        'WEBHOOK_URL': f"http://127.0.0.1:{port}",
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_SECRET_TOKEN': '',
+    })
+    try:
+        exit_code = process.wait(timeout=60)
+    except Exception:
+        stop_bot(process)
+        exit_code = None
+    webhook_set = any(event['method'] == 'setWebhook' for event in api.events_since(event_index))
+    return {'exited': exit_code is not None, 'webhook_set': webhook_set}
+
+
+def run_webhook(api, images, args, workdir, port):
+    """Post image updates to the bot's webhook server and time them until the PDF comes back"""
+    url = f"http://127.0.0.1:{port}/webhook"
+    event_index = len(api.events_since(0))
+    process = start_bot(api, workdir, {
+        'BOT_MODE': 'webhook',
+        'WEBHOOK_URL': f"http://127.0.0.1:{port}",
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_SECRET_TOKEN': SECRET_TOKEN,
+    })
+    try:
+        wait_until_ready(api, process, event_index, method='setWebhook')
+        event_index = len(api.events_since(0))
+
+        # Updates without the secret, or with a wrong one, must not reach the handlers
+        rejected = {}
+        for name, token in (('missing', None), ('wrong', 'not-' + SECRET_TOKEN)):
+            update = api.new_update(1, document=register(api, images[0]))
+            rejected[name], _ = post_update(url, update, token)
+
+        sent = {}
+        answered = []
+        statuses = {}
+        started = time.monotonic()
+        for number in range(args.requests):
+            # Pace updates at the target rate rather than firing them all at once
+            delay = started + number / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            chat_id = 10 ** 6 + number
+            update = api.new_update(chat_id, document=register(api, images[number % len(images)]))
+            sent[chat_id] = time.monotonic()
+            status, seconds = post_update(url, update, SECRET_TOKEN)
+            statuses[status] = statuses.get(status, 0) + 1
+            answered.append(seconds)
+
+        latencies, errors, busy, _ = collect_results(api, sent, event_index, args.timeout)
+        # Nothing may have been sent to the chat the rejected updates came from
+        leaked = sum(1 for event in api.events_since(event_index) if event['params'].get('chat_id') in (1, '1'))
+    finally:
+        stop_bot(process)
+
+    latencies.sort()
+    answered.sort()
+    return {
+        'rejected_status': rejected,
+        'rejected_updates_handled': leaked,
+        'post_status': statuses,
+        'requests': args.requests,
+        'completed': len(latencies),
+        'errors': errors,
+        'busy': busy,
+        'post_ms': {
+            'p50': _ms(percentile(answered, 0.50)),
+            'max': _ms(answered[-1]) if answered else None,
+        },
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 0.50)),
+            'p95': _ms(percentile(latencies, 0.95)),
+            'max': _ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post fake updates to the bot's webhook server and check it handles them")
+    parser.add_argument('--requests', type=int, default=20, help="image updates posted")
+    parser.add_argument('--rate', type=float, default=10.0, help="updates per second")
+    parser.add_argument('--timeout', type=float, default=120.0, help="seconds to wait for outstanding replies")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_image_corpus(os.path.join(directory, 'images'))[:2]
+        api = FakeBotAPI(latency=0.02).start()
+        try:
+            refused_dir = os.path.join(directory, 'refused')
+            os.makedirs(refused_dir)
+            refused = check_refuses_without_secret(api, refused_dir, free_port())
+            workdir = os.path.join(directory, 'run')
+            os.makedirs(workdir)
+            results = run_webhook(api, images, args, workdir, free_port())
+        finally:
+            api.stop()
+
+    report = json.dumps({
+        'benchmark': 'webhook',
+        'parameters': {
+            'requests': args.requests,
+            'rate': args.rate,
+            'cpu_count': os.cpu_count(),
+        },
+        'results': {'without_secret': refused, 'with_secret': results},
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
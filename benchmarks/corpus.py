@@ -0,0 +1,98 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+
+from pdf_writer import PDFWriter
+
+DESCRIPTIONS = ["Coffee shop", "Grocery store ltd", "Rent", "Salary", "Card payment", "Transfer to savings"]
+COLUMNS = [(50, "Date"), (130, "Description"), (330, "Reference"), (420, "Amount"), (500, "Balance")]
+WORDS = ["invoice", "total", "account", "payment", "balance", "report", "summary", "quarter", "revenue", "the", "and", "of"]
+
+
+def make_table_pdf(path, pages, rows_per_page=45, seed=0):
+    """Write a bank-statement style PDF whose table continues across pages"""
+    rng = random.Random(seed)
+    balance = 1000.0
+    with open(path, 'wb') as pdf_file:
+        writer = PDFWriter(pdf_file)
+        for page in range(pages):
+            lines = [(50, 760, f"Statement of account - page {page + 1} of {pages}")]
+            y = 730
+            lines.extend((x, y, title) for x, title in COLUMNS)
+            for row in range(rows_per_page):
+                y -= 15
+                amount = rng.uniform(-500, 500)
+                balance += amount
+                values = [
+                    f"2024-{page % 12 + 1:02d}-{row % 28 + 1:02d}",
+                    rng.choice(DESCRIPTIONS),
+                    f"REF{rng.randrange(10 ** 6):06d}",
+                    f"{amount:.2f}",
+                    f"{balance:.2f}",
+                ]
+                lines.extend((x, y, value) for (x, _), value in zip(COLUMNS, values))
+            writer.add_text_page(lines)
+        writer.close()
+    return path
+
+
+def make_table_corpus(directory, page_counts=(1, 10, 50)):
+    """Generate one table PDF per page count, returning their paths"""
+    os.makedirs(directory, exist_ok=True)
+    return [
+        make_table_pdf(os.path.join(directory, f"table_{pages}p.pdf"), pages, seed=pages)
+        for pages in page_counts
+    ]
+
+
+def make_text_pdf(path, pages, lines_per_page=50, seed=0):
+    """Write a PDF of plain prose, one line of words per text line"""
+    rng = random.Random(seed)
+    with open(path, 'wb') as pdf_file:
+        writer = PDFWriter(pdf_file)
+        for page in range(pages):
+            lines = [(50, 760 - 14 * row, " ".join(rng.choice(WORDS) for _ in range(12)))
+                     for row in range(lines_per_page)]
+            writer.add_text_page(lines)
+        writer.close()
+    return path
+
+
+def make_image(path, width, height, seed=0):
+    """Write a photo-like image; the format follows the file extension"""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        size = rng.randrange(10, max(11, min(width, height) // 3))
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        draw.ellipse((x, y, x + size, y + size), fill=color)
+    if path.lower().endswith('.png'):
+        image.save(path, 'PNG')
+    else:
+        image.save(path, 'JPEG', quality=90)
+    return path
+
+
+def make_image_corpus(directory, sizes=((640, 480), (1600, 1200), (4000, 3000))):
+    """Generate a JPEG and a PNG for every size, returning their paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for width, height in sizes:
+        for extension in ('jpg', 'png'):
+            paths.append(make_image(os.path.join(directory, f"image_{width}x{height}.{extension}"), width, height, seed=width))
+    return paths
+
+
+def make_text_corpus(directory, page_counts=(1, 10, 100)):
+    """Generate one prose PDF per page count, returning their paths"""
+    os.makedirs(directory, exist_ok=True)
+    return [
+        make_text_pdf(os.path.join(directory, f"text_{pages}p.pdf"), pages, seed=pages)
+        for pages in page_counts
+    ]
@@ -0,0 +1,283 @@
+import collections
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+API_PATH = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+FILE_PATH = re.compile(r'^/file/bot(?P<token>[^/]+)/(?P<file_path>.+)$')
+
+
+class FakeBotAPI:
+    """Local stand-in for the Telegram Bot API, enough to drive the bot's handlers
+
+    Implements getUpdates (long polling), getFile plus file downloads,
+    sendDocument, sendMessage, getChatMember, getChat, deleteMessage and
+    no-op answers for everything else. Every API call sleeps `latency`
+    seconds first to mimic the network round trip. With flood_limit set,
+    send* calls beyond that many per second get a 429 with retry_after.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, flood_limit=0):
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.flood_waits = 0
+        self._recent_sends = collections.deque()
+        self.files = {}
+        self.events = []
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._server = _QuietHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    @property
+    def base_file_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/file/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_file(self, path, file_name, mime_type):
+        """Register a local file as a Telegram document; returns its Document dict"""
+        number = next(self._file_ids)
+        with open(path, 'rb') as source:
+            size = len(source.read())
+        self.files[f"file-{number}"] = path
+        return {
+            'file_id': f"file-{number}",
+            'file_unique_id': f"unique-{number}",
+            'file_name': file_name,
+            'mime_type': mime_type,
+            'file_size': size,
+        }
+
+    def push_message(self, chat_id, text=None, document=None, caption=None, media_group_id=None):
+        """Queue an incoming private message; returns the time it became visible to getUpdates"""
+        update = self.new_update(chat_id, text, document, caption, media_group_id)
+        with self._condition:
+            self._updates.append(update)
+            self._condition.notify_all()
+        return time.monotonic()
+
+    def new_update(self, chat_id, text=None, document=None, caption=None, media_group_id=None):
+        """Build an update with an incoming private message, e.g. to post to a webhook instead of queuing it"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                command = text.split()[0]
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        if document is not None:
+            message['document'] = document
+        if caption is not None:
+            message['caption'] = caption
+        if media_group_id is not None:
+            message['media_group_id'] = media_group_id
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def clear_updates(self):
+        """Drop every queued update, confirmed or not"""
+        with self._condition:
+            self._updates = []
+
+    def events_since(self, index):
+        """Outgoing bot calls recorded from position index on"""
+        with self._condition:
+            return self.events[index:]
+
+    def _record(self, method, params):
+        with self._condition:
+            self.events.append({'time': time.monotonic(), 'method': method, 'params': params})
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # Confirmed updates are dropped, like the real server does
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return list(self._updates[:100])
+
+    def _flooded(self):
+        if not self.flood_limit:
+            return False
+        now = time.monotonic()
+        with self._condition:
+            while self._recent_sends and self._recent_sends[0] <= now - 1:
+                self._recent_sends.popleft()
+            if len(self._recent_sends) >= self.flood_limit:
+                self.flood_waits += 1
+                return True
+            self._recent_sends.append(now)
+            return False
+
+    def _message_result(self, params, **fields):
+        result = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'bench_bot'},
+        }
+        result.update(fields)
+        return result
+
+    def _call(self, method, params):
+        if method == 'getUpdates':
+            return self._get_updates(params)
+
+        if self.latency:
+            time.sleep(self.latency)
+        if method.startswith('send') and self._flooded():
+            raise _FloodError(1)
+        self._record(method, params)
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'bench_bot'}
+        if method == 'getFile':
+            file_id = params['file_id']
+            number = file_id.split('-')[-1]
+            path = self.files[file_id]
+            with open(path, 'rb') as source:
+                size = len(source.read())
+            return {'file_id': file_id, 'file_unique_id': f"unique-{number}",
+                    'file_size': size, 'file_path': f"documents/{file_id}"}
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'Bench'}}
+        if method == 'getChat':
+            return {'id': -100, 'type': 'channel', 'title': 'Bench channel',
+                    'accent_color_id': 0, 'max_reaction_count': 11}
+        if method == 'sendMessage':
+            return self._message_result(params, text=params.get('text', ''))
+        if method == 'sendDocument':
+            number = next(self._file_ids)
+            return self._message_result(params, document={
+                'file_id': f"sent-{number}", 'file_unique_id': f"sent-unique-{number}"
+            })
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+
+                file_match = FILE_PATH.match(url.path)
+                if file_match:
+                    file_id = file_match.group('file_path').rsplit('/', 1)[-1]
+                    path = api.files.get(file_id)
+                    if path is None:
+                        self._send(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+                        return
+                    if api.latency:
+                        time.sleep(api.latency)
+                    with open(path, 'rb') as source:
+                        self._send(200, source.read(), 'application/octet-stream')
+                    return
+
+                api_match = API_PATH.match(url.path)
+                if not api_match:
+                    self._send(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+                    return
+
+                params = dict(parse_qsl(url.query))
+                params.update(_parse_body(self.headers.get('Content-Type', ''), body))
+                try:
+                    result = api._call(api_match.group('method'), params)
+                    payload = {'ok': True, 'result': result}
+                    status = 200
+                except _FloodError as e:
+                    payload = {'ok': False, 'error_code': 429,
+                               'description': f"Too Many Requests: retry after {e.retry_after}",
+                               'parameters': {'retry_after': e.retry_after}}
+                    status = 429
+                except Exception as e:
+                    payload = {'ok': False, 'error_code': 400, 'description': f"Bad Request: {str(e)}"}
+                    status = 400
+                self._send(status, json.dumps(payload).encode())
+
+            def _send(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class _FloodError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The bot hanging up on a long poll when it stops is expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _parse_body(content_type, body):
+    """Parameters from a JSON, urlencoded or multipart request body; uploads become their size"""
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict(parse_qsl(body.decode()))
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            params[name] = len(payload) if part.get_filename() else payload.decode()
+        return params
+    return {}
@@ -0,0 +1,295 @@
+import argparse
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from corpus import make_image_corpus, make_table_corpus, make_text_corpus
+from fake_bot_api import FakeBotAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = '123456:bench'
+SCENARIOS = ['image_to_pdf', 'totext', 'tocsv', 'merge']
+MIME_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png', '.pdf': 'application/pdf'}
+
+
+def start_bot(api, workdir, extra_env):
+    """Run bot.py against the fake server with its own cwd, temp dir, result cache and session store"""
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'BOT_API_BASE_URL': api.base_url,
+        'BOT_API_FILE_URL': api.base_file_url,
+        'RESULT_CACHE_PATH': os.path.join(workdir, 'result_cache.sqlite3'),
+        'SESSION_STORE_URL': f"sqlite:///{os.path.join(workdir, 'sessions.sqlite3')}",
+        'BOT_MODE': 'polling',
+        'METRICS_PORT': '0',
+    })
+    env.update(extra_env)
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'bot.py')],
+        cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def stop_bot(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def process_tree_rss(pid):
+    """Resident set size in bytes of pid plus all of its descendants"""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, fields resume after its closing parenthesis
+        parents[int(entry)] = int(stat.rsplit(')', 1)[1].split()[1])
+
+    tree = {pid}
+    grew = True
+    while grew:
+        children = {child for child, parent in parents.items() if parent in tree} - tree
+        grew = bool(children)
+        tree |= children
+
+    total = 0
+    for member in tree:
+        try:
+            with open(f"/proc/{member}/status") as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RSSSampler(threading.Thread):
+    """Track the peak RSS of a process tree until stopped"""
+
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def wait_until_ready(api, process, event_index, timeout=60, method='deleteWebhook'):
+    """Wait for the bot to clear its webhook (or set it, in webhook mode), i.e. for main() to finish starting"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"Bot exited during startup with code {process.returncode}")
+        if any(event['method'] == method for event in api.events_since(event_index)):
+            # Polling starts right after the webhook is cleared
+            time.sleep(0.5)
+            return
+        time.sleep(0.05)
+    raise Exception("Bot did not start taking updates in time")
+
+
+def send_request(api, scenario, chat_id, files, file_index):
+    """Push the updates for one request; returns when its measured message was enqueued"""
+    if scenario == 'merge':
+        api.push_message(chat_id, text='/merge')
+        for path in files:
+            api.push_message(chat_id, document=register(api, path))
+        return api.push_message(chat_id, text='/donemerge')
+
+    path = files[file_index % len(files)]
+    document = register(api, path)
+    if scenario == 'image_to_pdf':
+        return api.push_message(chat_id, document=document)
+    # The PDF with the command as its caption, as a Telegram client sends it
+    return api.push_message(chat_id, document=document, caption=f"/{scenario}")
+
+
+def register(api, path):
+    # A fresh file_unique_id per request keeps the result cache out of the measurement
+    return api.add_file(path, os.path.basename(path), MIME_TYPES[os.path.splitext(path)[1]])
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_scenario(api, scenario, files, args, workdir, chat_ids):
+    event_index = len(api.events_since(0))
+    flood_waits = api.flood_waits
+    process = start_bot(api, workdir, {'CONVERSION_JOBS_PER_USER': str(args.jobs_per_user)})
+    sampler = None
+    try:
+        wait_until_ready(api, process, event_index)
+        sampler = RSSSampler(process.pid)
+        sampler.start()
+
+        event_index = len(api.events_since(0))
+        sent = {}
+        started = time.monotonic()
+        for number in range(args.requests):
+            # Pace updates at the target rate rather than firing them all at once
+            due = started + number / args.rate
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            chat_id = next(chat_ids)
+            sent[chat_id] = send_request(api, scenario, chat_id, files, number)
+
+        latencies, errors, busy, finished = collect_results(api, sent, event_index, args.timeout)
+        duration = (max(finished) if finished else time.monotonic()) - started
+    finally:
+        if sampler:
+            sampler.stop()
+        stop_bot(process)
+        # Whatever this bot left unanswered must not leak into the next scenario
+        api.clear_updates()
+
+    latencies.sort()
+    return {
+        'requests': args.requests,
+        'completed': len(latencies),
+        'errors': errors,
+        'busy': busy,
+        'timed_out': args.requests - len(latencies) - errors - busy,
+        'duration_seconds': round(duration, 3),
+        'throughput_per_second': round(len(latencies) / duration, 3) if duration > 0 else None,
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 0.50)),
+            'p95': _ms(percentile(latencies, 0.95)),
+            'p99': _ms(percentile(latencies, 0.99)),
+            'mean': _ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': _ms(latencies[-1]) if latencies else None,
+        },
+        'peak_rss_bytes': sampler.peak if sampler else None,
+        'flood_waits': api.flood_waits - flood_waits,
+    }
+
+
+def collect_results(api, sent, event_index, timeout):
+    """Match sendDocument, error and busy replies to requests by chat; latency runs from enqueue to reply"""
+    latencies = []
+    finished = []
+    errors = 0
+    busy = 0
+    pending = dict(sent)
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        events = api.events_since(event_index)
+        event_index += len(events)
+        for event in events:
+            chat_id = _chat_id(event['params'])
+            if chat_id not in pending:
+                continue
+            if event['method'] == 'sendDocument':
+                latencies.append(event['time'] - pending.pop(chat_id))
+                finished.append(event['time'])
+            elif event['method'] == 'sendMessage':
+                text = str(event['params'].get('text', ''))
+                if text.startswith('❌'):
+                    pending.pop(chat_id)
+                    errors += 1
+                elif text.startswith('⏳'):
+                    pending.pop(chat_id)
+                    busy += 1
+        time.sleep(0.01)
+    return latencies, errors, busy, finished
+
+
+def _chat_id(params):
+    try:
+        return int(params.get('chat_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the bot end to end against a local fake Bot API server")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--requests', type=int, default=50, help="requests per scenario")
+    parser.add_argument('--rate', type=float, default=10.0, help="target requests per second")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds added to every fake API call")
+    parser.add_argument('--flood-limit', type=int, default=0, help="answer send* calls above this many per second with 429")
+    parser.add_argument('--timeout', type=float, default=300.0, help="seconds to wait for outstanding replies")
+    parser.add_argument('--merge-files', type=int, default=3, help="PDFs per merge request")
+    parser.add_argument('--jobs-per-user', type=int, default=2)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_image_corpus(os.path.join(directory, 'images'))
+        texts = make_text_corpus(os.path.join(directory, 'text'))
+        tables = make_table_corpus(os.path.join(directory, 'tables'))
+        corpus = {
+            'image_to_pdf': images,
+            'totext': texts,
+            'tocsv': tables,
+            'merge': list(itertools.islice(itertools.cycle(texts + tables), args.merge_files)),
+        }
+
+        api = FakeBotAPI(latency=args.latency, flood_limit=args.flood_limit).start()
+        results = {}
+        chat_ids = itertools.count(10 ** 6)
+        try:
+            for scenario in args.scenarios:
+                workdir = os.path.join(directory, f"run_{scenario}")
+                os.makedirs(workdir)
+                results[scenario] = run_scenario(api, scenario, corpus[scenario], args, workdir, chat_ids)
+        finally:
+            api.stop()
+
+    report = json.dumps({
+        'benchmark': 'bot_end_to_end',
+        'parameters': {
+            'requests': args.requests,
+            'rate': args.rate,
+            'api_latency_seconds': args.latency,
+            'flood_limit': args.flood_limit,
+            'merge_files': args.merge_files,
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,29 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import io
 import logging
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
+import socket
+import time
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ChatMemberHandler
 import config
-from image_converter import ImageConverter
-from pdf_converter import PDFConverter
-import uuid
+from image_converter import ImageConverter, ImageLimitError
+from admission import HEAVY, Admission, AdmissionError
+from membership_cache import MembershipCache
+from album_collector import AlbumCollector
+from conversion_executor import ConversionExecutor, QueueFullError
+from download_manager import DownloadManager
+from result_cache import ResultCache
+from update_processor import ChatOrderedUpdateProcessor
+from send_scheduler import SendScheduler, StatusMessage
+from session_store import SessionBusyError, open_session_store
+from temp_storage import StorageFullError, TempStorage
+import metrics
+from metrics import RequestTrace
+from pdf_converter import MergeLostError, PDFConverter, PDFLimitError, PDFMergeSession
+from pdf_profiles import PROFILES
 import telegram
 
 # Enable logging
@@ -13,27 +31,426 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# httpx logs every Bot API request at INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-def is_user_in_channel(bot, user_id):
+MEMBER_STATUSES = ['member', 'administrator', 'creator']
+
+membership_cache = MembershipCache(
+    max_size=config.MEMBERSHIP_CACHE_SIZE,
+    positive_ttl=config.MEMBERSHIP_POSITIVE_TTL,
+    negative_ttl=config.MEMBERSHIP_NEGATIVE_TTL
+)
+
+# Channel metadata, fetched once at startup
+channel_chat = None
+
+# Process pool for CPU-bound conversions, created in main()
+conversion_executor = None
+
+# Low-priority pool for inputs that admission found expensive, created in main()
+heavy_executor = None
+
+# Cache of already-sent conversion results, created in main()
+result_cache = None
+
+# Paces outgoing messages under Telegram's flood limits, created in main()
+send_scheduler = None
+
+# Merge sessions and conversion jobs shared with the other workers, created in main()
+session_store = None
+
+# Byte budget and janitor for TEMP_DIR, created in main()
+temp_storage = None
+
+# Bounded, resumable downloads of users' files, created in main()
+download_manager = None
+
+# This process's name on leases it holds in the session store
+WORKER_ID = config.WORKER_ID or f"{socket.gethostname()}:{os.getpid()}"
+
+# Store maintenance and the temp janitor, started in on_startup()
+maintenance_tasks = []
+
+# Imported once by the fork server conversion workers are forked from; the
+# backends only conversions use are left out of this process's own imports
+WORKER_PRELOAD = ['__main__', 'image_converter', 'pdf_converter', 'pdf_copier', 'PIL.Image', 'pypdf', 'pdfplumber', 'numpy']
+
+# Run by every conversion worker before its first job
+WORKER_WARMUPS = (ImageConverter.warm_up, PDFConverter.warm_up)
+
+# Scheduler lane of each operation
+OPERATION_LANES = {
+    'image_to_pdf': 'interactive',
+    'album': 'interactive',
+    'pdf_to_text': 'documents',
+    'pdf_to_csv': 'documents',
+    'merge': 'merge',
+}
+
+def scheduler_lanes(workers):
+    """Operation classes an executor with this many workers schedules separately, as {name: (weight, deadline, limit)}"""
+    # /totext and /tocsv leave a worker free for photos and merges, unless there is only one
+    document_workers = config.DOCUMENT_LANE_WORKERS or max(1, workers - 1)
+    return {
+        'interactive': (config.INTERACTIVE_LANE_WEIGHT, config.INTERACTIVE_LANE_DEADLINE, None),
+        'documents': (config.DOCUMENT_LANE_WEIGHT, config.DOCUMENT_LANE_DEADLINE, document_workers),
+        'merge': (config.MERGE_LANE_WEIGHT, config.MERGE_LANE_DEADLINE, None),
+    }
+
+BUSY_MESSAGE = "⏳ The converter is busy right now. Please try again in a moment."
+MERGE_LOST_MESSAGE = "❌ Sorry, your merge was lost. Please /merge again."
+
+async def is_user_in_channel(bot, user_id, refresh=False):
     """Check if user is member of the required channel"""
+    if not refresh:
+        cached = membership_cache.get(user_id)
+        if cached is not None:
+            metrics.CACHE_REQUESTS.labels(cache='membership', result='hit').inc()
+            return cached
+    metrics.CACHE_REQUESTS.labels(cache='membership', result='miss').inc()
+
     try:
-        member = bot.get_chat_member(chat_id=config.CHANNEL_ID, user_id=user_id)
+        member = await bot.get_chat_member(chat_id=config.CHANNEL_ID, user_id=user_id)
         logger.info(f"Channel membership status for user {user_id}: {member.status}")
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in MEMBER_STATUSES
+        membership_cache.set(user_id, is_member)
+        return is_member
     except telegram.error.BadRequest as e:
         logger.error(f"BadRequest error checking channel membership: {str(e)}")
         if "Chat not found" in str(e):
             logger.error(f"Channel {config.CHANNEL_ID} not found. Please verify the channel ID.")
         return False
-    except telegram.error.Unauthorized as e:
+    except telegram.error.Forbidden as e:
         logger.error(f"Unauthorized error: {str(e)}. Bot might not be an admin in the channel.")
         return False
     except Exception as e:
         logger.error(f"Error checking channel membership: {str(e)}")
         return False
 
-def start(update: Update, context: CallbackContext):
+async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the membership cache in sync with channel join/leave events"""
+    chat_member = update.chat_member
+    if not chat_member:
+        return
+
+    channel = str(config.CHANNEL_ID)
+    if channel not in (str(chat_member.chat.id), f"@{chat_member.chat.username}"):
+        return
+
+    user_id = chat_member.new_chat_member.user.id
+    status = chat_member.new_chat_member.status
+    membership_cache.set(user_id, status in MEMBER_STATUSES)
+    logger.info(f"Channel membership changed for user {user_id}: {status}")
+
+async def load_channel_info(bot):
+    """Fetch the channel metadata once so verify clicks don't need to"""
+    global channel_chat
+    try:
+        channel_chat = await bot.get_chat(config.CHANNEL_ID)
+        logger.info(f"Successfully accessed channel: {channel_chat.title}")
+    except telegram.error.TelegramError as e:
+        channel_chat = None
+        logger.error(f"Cannot access channel: {str(e)}")
+
+async def send_cached_result(update: Update, cache_key, caption, trace):
+    """Resend a previously uploaded result by file_id; returns False on a miss"""
+    file_id = await asyncio.to_thread(result_cache.get, cache_key)
+    if not file_id:
+        metrics.CACHE_REQUESTS.labels(cache='result', result='miss').inc()
+        return False
+
+    metrics.CACHE_REQUESTS.labels(cache='result', result='hit').inc()
+    try:
+        with trace.stage('upload'):
+            await update.message.reply_document(document=file_id, caption=caption)
+        trace.finish('cache_hit')
+        return True
+    except telegram.error.BadRequest as e:
+        # The stored file_id is no longer usable, convert from scratch
+        logger.warning(f"Dropping stale cached result {cache_key}: {str(e)}")
+        await asyncio.to_thread(result_cache.invalidate, cache_key)
+        return False
+
+async def download_input(bot, user_id, file_id, file_size, suffix, scope, trace):
+    """Download a file into memory, spilling to a scratch file of scope only above IN_MEMORY_MAX_SIZE
+
+    Returns (data, path): exactly one of them is set. With a local Bot API
+    server the path is the server's own copy of the file.
+    """
+    new_file = await fetch_file(bot, file_id, trace)
+    local_path = local_file_path(new_file)
+    if local_path:
+        trace.add_bytes_in(os.path.getsize(local_path))
+        return None, local_path
+
+    size = file_size or new_file.file_size
+    if size and size <= config.IN_MEMORY_MAX_SIZE:
+        buffer = io.BytesIO()
+        with trace.stage('download'):
+            await download_manager.download(new_file, buffer, user_id)
+        trace.add_bytes_in(buffer.tell())
+        return buffer.getvalue(), None
+
+    return None, await download_to_disk(new_file, user_id, suffix, scope, trace)
+
+async def fetch_file(bot, file_id, trace):
+    """getFile with room for a local Bot API server to fetch the whole file before it answers"""
+    with trace.stage('get_file'):
+        return await bot.get_file(file_id, read_timeout=config.BOT_API_FILE_TIMEOUT)
+
+def local_file_path(new_file):
+    """Where a local Bot API server stored a file on this machine, or None
+
+    The file belongs to the server: it's read in place and never deleted.
+    """
+    if config.BOT_API_LOCAL_MODE and new_file.file_path and os.path.isabs(new_file.file_path):
+        if os.path.isfile(new_file.file_path):
+            return new_file.file_path
+    return None
+
+async def download_to_disk(new_file, user_id, suffix, scope, trace):
+    """Download a telegram.File into a scratch file of scope, returning its path"""
+    local_path = local_file_path(new_file)
+    if local_path:
+        trace.add_bytes_in(os.path.getsize(local_path))
+        return local_path
+    if not suffix:
+        suffix = os.path.splitext(new_file.file_path or '')[1]
+    temp_path = scope.path(suffix)
+    with trace.stage('download'), open(temp_path, 'wb') as output_file:
+        trace.add_bytes_in(await download_manager.download(new_file, output_file, user_id))
+    return temp_path
+
+def open_output(output):
+    """Open a conversion result for upload, whether it's bytes or a file path"""
+    if isinstance(output, bytes):
+        return io.BytesIO(output)
+    return open(output, 'rb')
+
+def upload_file(output_file, filename):
+    """Stream an opened result into the upload in chunks instead of reading it into memory first"""
+    return InputFile(output_file, filename=filename, read_file_handle=False)
+
+def output_size(output):
+    """Size in bytes of a conversion result, whether it's bytes or a file path"""
+    if isinstance(output, bytes):
+        return len(output)
+    return os.path.getsize(output)
+
+# Reply sent when a conversion job fails, by operation
+JOB_ERROR_MESSAGES = {
+    'image_to_pdf': "❌ Sorry, something went wrong while processing your image. Please try again.",
+    'pdf_to_text': "❌ Sorry, something went wrong while converting your PDF. Please try again.",
+    'pdf_to_csv': "❌ Sorry, something went wrong while processing your PDF. Please try again.",
+}
+
+def scratch_bytes(operation, file_size):
+    """Disk space to reserve for a conversion: its download plus an output of about the same size"""
+    size = file_size or config.MAX_FILE_SIZE
+    if config.BOT_API_LOCAL_MODE:
+        # The input is read where the local server stored it, only the output takes space
+        return size
+    if operation == 'image_to_pdf' and file_size and file_size <= config.IN_MEMORY_MAX_SIZE:
+        return 0
+    return 2 * size
+
+def has_capacity(user_id, disk_bytes):
+    """Cheap check before downloading anything: room in the conversion queue and in TEMP_DIR"""
+    return conversion_executor.can_accept(user_id) and temp_storage.can_accept(disk_bytes)
+
+def conversion_job(update: Update, operation, file, cache_key, filename, caption, profile=None):
+    """Describe a conversion as a job payload that any worker can run"""
+    return {
+        'profile': profile,
+        'operation': operation,
+        'chat_id': update.effective_chat.id,
+        'user_id': update.effective_user.id,
+        'file_id': file.file_id,
+        'file_size': file.file_size,
+        'cache_key': cache_key,
+        'filename': filename,
+        'caption': caption,
+    }
+
+async def submit_job(update: Update, context: ContextTypes.DEFAULT_TYPE, job, status_text, trace):
+    """Record a conversion job in the session store and run it here in the background"""
+    job_id = await asyncio.to_thread(session_store.add_job, 'convert', job, owner=WORKER_ID, lease=config.JOB_LEASE)
+    status = StatusMessage(update.message, status_text)
+    context.application.create_task(run_job(context.bot, job_id, job, status, trace), update=update)
+
+async def admit(operation, source, trace):
+    """Sniff a downloaded input; returns the executor its conversion should run on, its estimated cost and page count"""
+    page_count = None
+    with trace.stage('admission'):
+        if operation == 'image_to_pdf':
+            lane = await asyncio.to_thread(Admission.image_lane, source)
+        else:
+            lane, page_count = await asyncio.to_thread(Admission.pdf_lane, source)
+    size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    executor = heavy_executor if lane == HEAVY else conversion_executor
+    return executor, Admission.estimate_cost(operation, size, page_count), page_count
+
+async def extract_text(executor, user_id, pdf_path, page_count, lane, cost, scope):
+    """Extract a PDF's text chunk by chunk on the executor's workers, writing each chunk out in page order as it arrives"""
+    timeout = config.PDF_TEXT_TIMEOUT
+    deadline = time.time() + timeout
+    chunks = [(pdf_path, start, end, deadline, timeout) for start, end in PDFConverter.text_chunks(page_count)]
+    text_path = scope.path('.txt')
+
+    async def write_chunks():
+        with open(text_path, 'w', encoding='utf-8') as text_file:
+            texts = executor.map(user_id, PDFConverter.extract_text_chunk, chunks, lane=lane, cost=cost)
+            async with contextlib.aclosing(texts):
+                async for text in texts:
+                    text_file.write(text)
+
+    try:
+        # The workers stop at the deadline too, so a timed-out job frees them soon after
+        await asyncio.wait_for(write_chunks(), timeout)
+    except asyncio.TimeoutError:
+        raise PDFLimitError(f"PDF took longer than {timeout} seconds to convert")
+    return text_path
+
+async def run_job(bot, job_id, job, status=None, trace=None):
+    """Download, convert and upload one conversion job, then remove it from the store
+
+    Jobs taken over from a worker that went away have no status message.
+    """
+    trace = trace or RequestTrace(job['operation'])
+    heartbeat = asyncio.get_running_loop().create_task(renew_job_lease(job_id, asyncio.current_task()))
+    scope = temp_storage.scope()
+    outcome = 'error'
+    handled = True
+
+    async def reply(text):
+        if status:
+            await status.clear()
+        await bot.send_message(chat_id=job['chat_id'], text=text)
+
+    try:
+        scope.reserve(scratch_bytes(job['operation'], job['file_size']))
+        if job['operation'] == 'image_to_pdf':
+            # Download the file, in memory unless it's large
+            data, temp_path = await download_input(
+                bot, job['user_id'], job['file_id'], job['file_size'], None, scope, trace
+            )
+            if data is not None:
+                convert, source = ImageConverter.convert_bytes_to_pdf, data
+            else:
+                convert, source = ImageConverter.convert_to_pdf, temp_path
+        else:
+            new_file = await fetch_file(bot, job['file_id'], trace)
+            source = await download_to_disk(new_file, job['user_id'], '.pdf', scope, trace)
+            convert = PDFConverter.pdf_to_text if job['operation'] == 'pdf_to_text' else PDFConverter.pdf_to_csv
+
+        executor, cost, page_count = await admit(job['operation'], source, trace)
+        lane = OPERATION_LANES[job['operation']]
+        submitted = time.perf_counter()
+        if job['operation'] == 'image_to_pdf':
+            output = await executor.run(job['user_id'], convert, source, job.get('profile'), lane=lane, cost=cost)
+        elif job['operation'] == 'pdf_to_text' and page_count:
+            output = await extract_text(executor, job['user_id'], source, page_count, lane, cost, scope)
+        else:
+            output = await executor.run(job['user_id'], convert, source, lane=lane, cost=cost)
+        if isinstance(output, str):
+            scope.adopt(output)
+        trace.record('convert', time.perf_counter() - submitted)
+        with open_output(output) as output_file, trace.stage('upload'):
+            message = await bot.send_document(
+                chat_id=job['chat_id'],
+                document=upload_file(output_file, job['filename']),
+                caption=job['caption'],
+                read_timeout=config.BOT_API_FILE_TIMEOUT,
+                write_timeout=config.BOT_API_FILE_TIMEOUT
+            )
+        await asyncio.to_thread(result_cache.set, job['cache_key'], message.document.file_id)
+        trace.add_bytes_out(output_size(output))
+        # Drops the status message instead if it hasn't gone out yet
+        if status:
+            with trace.stage('delete_message'):
+                await status.clear()
+        outcome = 'ok'
+    except asyncio.CancelledError:
+        # Shutting down or lost the lease: leave the job to the worker that takes it over
+        handled = False
+        raise
+    except (QueueFullError, StorageFullError) as e:
+        logger.warning(f"Rejected conversion: {str(e)}")
+        await reply(BUSY_MESSAGE)
+        outcome = 'busy'
+    except (AdmissionError, ImageLimitError, PDFLimitError) as e:
+        logger.warning(f"Input rejected: {str(e)}")
+        await reply(f"❌ {str(e)}.")
+        outcome = 'rejected'
+    except Exception as e:
+        logger.error(f"Error in conversion job {job_id}: {str(e)}")
+        await reply(JOB_ERROR_MESSAGES[job['operation']])
+    finally:
+        heartbeat.cancel()
+        if handled:
+            await asyncio.to_thread(session_store.finish_job, job_id)
+        trace.finish(outcome)
+        scope.close()
+
+async def renew_job_lease(job_id, job_task):
+    """Keep renewing a running job's lease so no other worker takes it over
+
+    If another worker has taken the job over anyway, job_task is cancelled
+    so only one of them converts and uploads it.
+    """
+    while True:
+        await asyncio.sleep(config.JOB_LEASE / 3)
+        try:
+            renewed = await asyncio.to_thread(session_store.renew_job, job_id, WORKER_ID, config.JOB_LEASE)
+        except Exception as e:
+            logger.warning(f"Could not renew lease on job {job_id}: {str(e)}")
+            continue
+        if not renewed:
+            logger.warning(f"Lost the lease on job {job_id} to another worker, abandoning it")
+            job_task.cancel()
+            return
+
+async def temp_janitor():
+    """Periodically delete orphaned temp files and remeasure TEMP_DIR"""
+    while True:
+        await asyncio.sleep(config.TEMP_JANITOR_INTERVAL)
+        try:
+            await asyncio.to_thread(temp_storage.sweep)
+        except Exception as e:
+            logger.error(f"Error sweeping temp storage: {str(e)}")
+
+async def maintain_store(application):
+    """Delete expired merge sessions and take over jobs whose worker stopped renewing them
+
+    Also writes out the result cache's recent hits, which get() keeps in memory.
+    """
+    while True:
+        await asyncio.sleep(config.STORE_MAINTENANCE_INTERVAL)
+        try:
+            await asyncio.to_thread(result_cache.flush)
+        except Exception as e:
+            logger.error(f"Error flushing result cache: {str(e)}")
+        try:
+            for state in await asyncio.to_thread(session_store.expire_sessions, config.SESSION_TTL):
+                PDFMergeSession(state=state).discard()
+
+            # Only claim as many jobs as the pool has room for
+            for _ in range(conversion_executor.max_queue_size - conversion_executor.queue_depth()):
+                job = await asyncio.to_thread(session_store.claim_job, WORKER_ID, config.JOB_LEASE)
+                if job is None:
+                    break
+                if job['attempts'] > config.JOB_MAX_ATTEMPTS:
+                    logger.error(f"Dropping job {job['id']} after {job['attempts'] - 1} attempts")
+                    await asyncio.to_thread(session_store.finish_job, job['id'])
+                    continue
+                logger.info(f"Taking over abandoned job {job['id']}")
+                application.create_task(run_job(application.bot, job['id'], job['payload']))
+        except Exception as e:
+            logger.error(f"Error maintaining session store: {str(e)}")
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     keyboard = [
         [InlineKeyboardButton("Join Our Channel", url=config.CHANNEL_LINK)],
@@ -48,26 +465,24 @@ def start(update: Update, context: CallbackContext):
         "2. Click the verify button below\n"
         "3. Start converting your images!\n\n"
         "Supported formats: JPG, JPEG, PNG\n"
-        "Maximum file size: 20MB"
+        f"Maximum file size: {config.MAX_FILE_SIZE // (1024 * 1024)}MB"
     )
-    update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    await update.message.reply_text(welcome_message, reply_markup=reply_markup)
 
-def verify_membership(update: Update, context: CallbackContext):
+async def verify_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Verify if user has joined the channel"""
     query = update.callback_query
 
     try:
-        # Check if bot has access to the channel
-        try:
-            chat = context.bot.get_chat(config.CHANNEL_ID)
-            logger.info(f"Successfully accessed channel: {chat.title}")
-        except telegram.error.BadRequest as e:
-            logger.error(f"Cannot access channel: {str(e)}")
-            query.answer("⚠️ Bot configuration error. Please contact admin.", show_alert=True)
+        # Check if bot has access to the channel, retrying if startup failed
+        if channel_chat is None:
+            await load_channel_info(context.bot)
+        if channel_chat is None:
+            await query.answer("⚠️ Bot configuration error. Please contact admin.", show_alert=True)
             return
 
-        # Verify membership
-        if is_user_in_channel(context.bot, update.effective_user.id):
+        # Verify membership, bypassing the cache since the user just asked
+        if await is_user_in_channel(context.bot, update.effective_user.id, refresh=True):
             # Create keyboard with all conversion options
             keyboard = [
                 [
@@ -94,7 +509,7 @@ def verify_membership(update: Update, context: CallbackContext):
                 "• Merge PDFs: Combine multiple PDFs\n\n"
                 "Or simply send me your files directly!"
             )
-            query.edit_message_text(text=success_message, reply_markup=reply_markup)
+            await query.edit_message_text(text=success_message, reply_markup=reply_markup)
         else:
             keyboard = [
                 [InlineKeyboardButton("Join Our Channel", url=config.CHANNEL_LINK)],
@@ -106,240 +521,384 @@ def verify_membership(update: Update, context: CallbackContext):
                 "❌ You haven't joined our channel yet.\n\n"
                 "Please join the channel first, then click 'Check Again'"
             )
-            query.edit_message_text(text=error_message, reply_markup=reply_markup)
+            await query.edit_message_text(text=error_message, reply_markup=reply_markup)
 
     except telegram.error.BadRequest as e:
         if "Message is not modified" in str(e):
-            query.answer("Status unchanged. Try again later.", show_alert=True)
+            await query.answer("Status unchanged. Try again later.", show_alert=True)
         else:
             logger.error(f"Error in verify_membership: {str(e)}")
-            query.answer("An error occurred. Please try again.", show_alert=True)
+            await query.answer("An error occurred. Please try again.", show_alert=True)
     except Exception as e:
         logger.error(f"Unexpected error in verify_membership: {str(e)}")
-        query.answer("An error occurred. Please try again.", show_alert=True)
+        await query.answer("An error occurred. Please try again.", show_alert=True)
 
-def handle_pdf_convert(update: Update, context: CallbackContext, convert_to='csv'):
+async def handle_pdf_convert(update: Update, context: ContextTypes.DEFAULT_TYPE, convert_to='csv'):
     """Handle PDF conversion to text or CSV"""
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    trace = RequestTrace(f"pdf_to_{convert_to}")
+    with trace.stage('membership'):
+        is_member = await is_user_in_channel(context.bot, update.effective_user.id)
+    if not is_member:
+        await start(update, context)
         return
 
-    # Initialize variables
-    temp_pdf_path = None
-    output_path = None
-
     try:
         if not update.message.document:
-            update.message.reply_text("❌ Please send a PDF file.")
+            await update.message.reply_text("❌ Please send a PDF file.")
             return
 
         document = update.message.document
         if not document.file_name.lower().endswith('.pdf'):
-            update.message.reply_text("❌ Please send a valid PDF file.")
+            await update.message.reply_text("❌ Please send a valid PDF file.")
             return
-
-        # Download the PDF file
-        new_file = context.bot.get_file(document.file_id)
-        temp_pdf_path = os.path.join(config.TEMP_DIR, f"{str(uuid.uuid4())}.pdf")
-        new_file.download(temp_pdf_path)
-
-        # Send processing message
-        processing_message = update.message.reply_text("🔄 Processing your PDF...")
+        Admission.check_size(document.file_size)
 
         # Convert based on requested format
         if convert_to == 'text':
-            output_path = PDFConverter.pdf_to_text(temp_pdf_path)
             caption = "✅ Here's your text file!"
             filename = "converted.txt"
         else:  # csv
-            output_path = PDFConverter.pdf_to_csv(temp_pdf_path)
             caption = "✅ Here's your CSV file!"
             filename = "converted.csv"
 
-        # Send the converted file
-        with open(output_path, 'rb') as converted_file:
-            update.message.reply_document(
-                document=converted_file,
-                filename=filename,
-                caption=caption
-            )
+        # Reuse the file we sent last time this PDF was converted
+        operation = f"pdf_to_{convert_to}"
+        cache_key = ResultCache.make_key(document.file_unique_id, operation)
+        if await send_cached_result(update, cache_key, caption, trace):
+            return
 
-        # Clean up
-        PDFConverter.cleanup_files([temp_pdf_path, output_path])
-        context.bot.delete_message(
-            chat_id=update.message.chat_id,
-            message_id=processing_message.message_id
-        )
+        # Refuse early rather than downloading a job we can't queue
+        if not has_capacity(update.effective_user.id, scratch_bytes(operation, document.file_size)):
+            await update.message.reply_text(BUSY_MESSAGE)
+            trace.finish('busy')
+            return
 
+        # Download and convert in the background so this chat's next update isn't held up
+        job = conversion_job(update, operation, document, cache_key, filename, caption)
+        await submit_job(update, context, job, "🔄 Processing your PDF...", trace)
+
+    except AdmissionError as e:
+        trace.finish('rejected')
+        await update.message.reply_text(f"❌ {str(e)}.")
     except Exception as e:
+        trace.finish('error')
         logger.error(f"Error processing PDF: {str(e)}")
-        update.message.reply_text(
+        await update.message.reply_text(
             "❌ Sorry, something went wrong while processing your PDF. Please try again."
         )
-        # Clean up in case of error
-        if temp_pdf_path:
-            PDFConverter.cleanup_files([temp_pdf_path])
-        if output_path:
-            PDFConverter.cleanup_files([output_path])
 
-def pdf_to_text(update: Update, context: CallbackContext):
+async def pdf_to_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Convert single PDF to text"""
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    trace = RequestTrace('pdf_to_text')
+    with trace.stage('membership'):
+        is_member = await is_user_in_channel(context.bot, update.effective_user.id)
+    if not is_member:
+        await start(update, context)
         return
 
     try:
         if not update.message.document:
-            update.message.reply_text("❌ Please send a PDF file.")
+            await update.message.reply_text("❌ Please send a PDF file.")
             return
 
         document = update.message.document
         if not document.file_name.lower().endswith('.pdf'):
-            update.message.reply_text("❌ Please send a valid PDF file.")
+            await update.message.reply_text("❌ Please send a valid PDF file.")
             return
 
         # Check file size
-        if document.file_size > config.MAX_FILE_SIZE:
-            update.message.reply_text("❌ File is too big. Maximum size is 20MB.")
-            return
-
-        # Send processing message
-        processing_message = update.message.reply_text("🔄 Converting PDF to text...")
-
-        # Download and process the file
-        temp_pdf_path = os.path.join(config.TEMP_DIR, f"{str(uuid.uuid4())}.pdf")
-        context.bot.get_file(document.file_id).download(temp_pdf_path)
+        Admission.check_size(document.file_size)
 
-        # Convert to text
-        output_path = PDFConverter.pdf_to_text(temp_pdf_path)
-
-        # Send the text file
-        with open(output_path, 'rb') as text_file:
-            update.message.reply_document(
-                document=text_file,
-                filename=f"{os.path.splitext(document.file_name)[0]}.txt",
-                caption="✅ Here's your text file!"
-            )
+        # Reuse the file we sent last time this PDF was converted
+        cache_key = ResultCache.make_key(document.file_unique_id, "pdf_to_text")
+        if await send_cached_result(update, cache_key, "✅ Here's your text file!", trace):
+            return
 
-        # Clean up
-        for file_path in [temp_pdf_path, output_path]:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        # Refuse early rather than downloading a job we can't queue
+        if not has_capacity(update.effective_user.id, scratch_bytes('pdf_to_text', document.file_size)):
+            await update.message.reply_text(BUSY_MESSAGE)
+            trace.finish('busy')
+            return
 
-        # Delete processing message
-        context.bot.delete_message(
-            chat_id=update.message.chat_id,
-            message_id=processing_message.message_id
+        # Download and convert to text in the background so this chat's next update isn't held up
+        job = conversion_job(
+            update, 'pdf_to_text', document, cache_key,
+            f"{os.path.splitext(document.file_name)[0]}.txt", "✅ Here's your text file!"
         )
+        await submit_job(update, context, job, "🔄 Converting PDF to text...", trace)
 
+    except AdmissionError as e:
+        trace.finish('rejected')
+        await update.message.reply_text(f"❌ {str(e)}.")
     except Exception as e:
+        trace.finish('error')
         logger.error(f"Error converting PDF to text: {str(e)}")
-        update.message.reply_text(
+        await update.message.reply_text(
             "❌ Sorry, something went wrong while converting your PDF. Please try again."
         )
 
-def pdf_to_csv(update: Update, context: CallbackContext):
+async def pdf_to_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Convert PDF to CSV"""
-    handle_pdf_convert(update, context, 'csv')
+    await handle_pdf_convert(update, context, 'csv')
 
-def merge_pdfs_command(update: Update, context: CallbackContext):
+async def merge_pdfs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the PDF merge process"""
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    if not await is_user_in_channel(context.bot, update.effective_user.id):
+        await start(update, context)
         return
 
-    if not hasattr(context.user_data, 'pdf_files'):
-        context.user_data['pdf_files'] = []
+    # Throw away any unfinished merge, once its pending steps are done, and start a fresh one
+    add_merge_step(update, context, start_merge)
 
-    context.user_data['pdf_files'] = []  # Reset the list
-    update.message.reply_text(
+    await update.message.reply_text(
         "🔄 Send me the PDFs you want to merge (one by one).\n"
         "When you're done, send /donemerge to merge them all."
     )
 
-def done_merge_command(update: Update, context: CallbackContext):
+async def done_merge_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Complete the PDF merge process"""
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
-        return
-
-    if not hasattr(context.user_data, 'pdf_files') or not context.user_data['pdf_files']:
-        update.message.reply_text("❌ Please send some PDF files first, then use /donemerge")
+    trace = RequestTrace('done_merge')
+    with trace.stage('membership'):
+        is_member = await is_user_in_channel(context.bot, update.effective_user.id)
+    if not is_member:
+        await start(update, context)
         return
 
     try:
         # Send processing message
-        processing_message = update.message.reply_text("🔄 Merging your PDFs...")
+        status = StatusMessage(update.message, "🔄 Merging your PDFs...")
 
-        # Merge PDFs
-        merged_path = PDFConverter.merge_pdfs(context.user_data['pdf_files'])
+        # Finalize after any PDFs that are still being appended
+        add_merge_step(update, context, finish_merge, status, trace)
 
-        # Send merged file
-        with open(merged_path, 'rb') as merged_file:
-            update.message.reply_document(
-                document=merged_file,
-                filename="merged.pdf",
-                caption="✅ Here's your merged PDF!"
-            )
+    except Exception as e:
+        trace.finish('error')
+        logger.error(f"Error merging PDFs: {str(e)}")
+        await update.message.reply_text(
+            "❌ Sorry, something went wrong while merging your PDFs. Please try again."
+        )
+
+def merge_key(user_id):
+    """Key of a user's merge session in the session store"""
+    return f"merge:{user_id}"
+
+def add_merge_step(update: Update, context: ContextTypes.DEFAULT_TYPE, step, *args):
+    """Run a merge step in the background once the user's previous one is done, keeping their sending order"""
+    previous = context.user_data.get('merge_step')
+    context.user_data['merge_step'] = context.application.create_task(
+        step(update, context, previous, *args), update=update
+    )
+
+async def wait_for_step(step):
+    """Wait for an earlier merge step to finish, whether or not it succeeded"""
+    if step is not None:
+        await asyncio.wait([step])
+
+async def claim_merge(user_id):
+    """Lease the user's merge session, waiting while another worker holds it; None if they have none
 
-        # Clean up
-        PDFConverter.cleanup_files(context.user_data['pdf_files'] + [merged_path])
-        context.user_data['pdf_files'] = []  # Reset the list
-        context.bot.delete_message(
-            chat_id=update.message.chat_id,
-            message_id=processing_message.message_id
+    Raises MergeLostError if the session's output is gone.
+    """
+    deadline = time.monotonic() + config.SESSION_LOCK_TIMEOUT
+    while True:
+        try:
+            state = await asyncio.to_thread(
+                session_store.claim_session, merge_key(user_id), WORKER_ID, config.SESSION_LEASE
+            )
+            if state and not os.path.exists(state['output_path']):
+                # Evicted to free disk space, or written to a TEMP_DIR this worker doesn't share.
+                # The session is left for /merge to replace rather than deleted behind the user's back
+                await asyncio.to_thread(session_store.release_session, merge_key(user_id), WORKER_ID)
+                raise MergeLostError(f"Output of the merge session of user {user_id} is missing")
+            return PDFMergeSession(state=state) if state else None
+        except SessionBusyError:
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def release_merge(user_id, session):
+    """Save the session's progress to the store and give up the lease"""
+    # Serializing a long merge's state takes a while too, so it happens off the event loop as well
+    released = await asyncio.to_thread(
+        lambda: session_store.release_session(merge_key(user_id), WORKER_ID, session.state())
+    )
+    if not released:
+        logger.warning(f"Lost the lease on the merge session of user {user_id}")
+
+def replace_merge_status(context: ContextTypes.DEFAULT_TYPE, session, status):
+    """Coalesce a session's progress messages: a still-queued one is dropped in favour of the newer one"""
+    previous_path, previous_status = context.user_data.get('merge_status', (None, None))
+    if previous_path == session.output_path:
+        previous_status.drop()
+        context.user_data.pop('merge_status')
+    if status:
+        context.user_data['merge_status'] = (session.output_path, status)
+
+async def start_merge(update: Update, context: ContextTypes.DEFAULT_TYPE, previous):
+    """Replace the user's merge session with an empty one, deleting the old output"""
+    user_id = update.effective_user.id
+    try:
+        await wait_for_step(previous)
+        try:
+            old_session = await claim_merge(user_id)
+        except MergeLostError:
+            old_session = None
+        new_session = PDFMergeSession(profile=pdf_profile(context))
+        await asyncio.to_thread(session_store.put_session, merge_key(user_id), new_session.state())
+        if old_session:
+            old_session.discard()
+    except Exception as e:
+        logger.error(f"Error starting merge: {str(e)}")
+        await update.message.reply_text(
+            "❌ Sorry, something went wrong while starting your merge. Please try again."
         )
 
+async def finish_merge(update: Update, context: ContextTypes.DEFAULT_TYPE, previous, status, trace):
+    """Write the merged PDF's xref and upload it"""
+    user_id = update.effective_user.id
+    session = None
+    outcome = 'error'
+    try:
+        await wait_for_step(previous)
+        # Take the session out of the store so a new /merge starts from scratch
+        session = await claim_merge(user_id)
+        if session:
+            await asyncio.to_thread(session_store.delete_session, merge_key(user_id))
+            replace_merge_status(context, session, None)
+        if not session or not session.file_count:
+            await status.clear()
+            await update.message.reply_text("❌ Please send some PDF files first, then use /donemerge")
+            outcome = 'rejected'
+            return
+
+        with trace.stage('finalize'):
+            merged_path = await asyncio.to_thread(session.finalize)
+
+        # Send merged file
+        with open(merged_path, 'rb') as merged_file, trace.stage('upload'):
+            await update.message.reply_document(
+                document=upload_file(merged_file, "merged.pdf"),
+                caption="✅ Here's your merged PDF!",
+                read_timeout=config.BOT_API_FILE_TIMEOUT,
+                write_timeout=config.BOT_API_FILE_TIMEOUT
+            )
+        trace.add_bytes_out(os.path.getsize(merged_path))
+        with trace.stage('delete_message'):
+            await status.clear()
+        outcome = 'ok'
+
+    except MergeLostError as e:
+        logger.warning(f"Merge not finished: {str(e)}")
+        await status.clear()
+        await update.message.reply_text(MERGE_LOST_MESSAGE)
+        outcome = 'rejected'
     except Exception as e:
         logger.error(f"Error merging PDFs: {str(e)}")
-        update.message.reply_text(
+        await status.clear()
+        await update.message.reply_text(
             "❌ Sorry, something went wrong while merging your PDFs. Please try again."
         )
-        # Clean up in case of error
-        if context.user_data.get('pdf_files'):
-            PDFConverter.cleanup_files(context.user_data['pdf_files'])
-        context.user_data['pdf_files'] = []
+    finally:
+        trace.finish(outcome)
+        if session:
+            session.discard()
 
-def handle_pdf_document(update: Update, context: CallbackContext):
+async def handle_pdf_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming PDF documents for merge"""
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    trace = RequestTrace('merge_append')
+    with trace.stage('membership'):
+        is_member = await is_user_in_channel(context.bot, update.effective_user.id)
+    if not is_member:
+        await start(update, context)
         return
 
-    if not hasattr(context.user_data, 'pdf_files'):
-        context.user_data['pdf_files'] = []
-
     try:
         document = update.message.document
         if not document.file_name.lower().endswith('.pdf'):
-            update.message.reply_text("❌ Please send only PDF files.")
+            await update.message.reply_text("❌ Please send only PDF files.")
             return
+        Admission.check_size(document.file_size)
 
-        # Download the PDF file
-        new_file = context.bot.get_file(document.file_id)
-        temp_pdf_path = os.path.join(config.TEMP_DIR, f"{str(uuid.uuid4())}.pdf")
-        new_file.download(temp_pdf_path)
+        # Keep the user's sending order even though files are merged in the background
+        add_merge_step(update, context, append_to_merge, document, trace)
 
-        # Add to list of files to merge
-        context.user_data['pdf_files'].append(temp_pdf_path)
+    except AdmissionError as e:
+        trace.finish('rejected')
+        await update.message.reply_text(f"❌ {str(e)}.")
+    except Exception as e:
+        trace.finish('error')
+        logger.error(f"Error handling PDF: {str(e)}")
+        await update.message.reply_text(
+            "❌ Sorry, something went wrong while processing your PDF. Please try again."
+        )
 
-        # Send confirmation
-        file_count = len(context.user_data['pdf_files'])
-        update.message.reply_text(
+async def append_to_merge(update: Update, context: ContextTypes.DEFAULT_TYPE, previous, document, trace):
+    """Download one PDF and merge it into the user's session, discarding the download after"""
+    user_id = update.effective_user.id
+    scope = temp_storage.scope()
+    outcome = 'error'
+    try:
+        # Room for the download and for what it adds to the merged output
+        scope.reserve(scratch_bytes('merge', document.file_size))
+
+        # Download the PDF file while earlier steps are still running
+        new_file = await fetch_file(context.bot, document.file_id, trace)
+        temp_pdf_path = await download_to_disk(new_file, user_id, '.pdf', scope, trace)
+        Admission.sniff_pdf(temp_pdf_path)
+
+        # Append its pages once the earlier files are in; PDFs sent without /merge start a session
+        await wait_for_step(previous)
+        session = await claim_merge(user_id)
+        if not session:
+            session = PDFMergeSession(profile=pdf_profile(context))
+            await asyncio.to_thread(
+                session_store.put_session, merge_key(user_id), session.state(), WORKER_ID, config.SESSION_LEASE
+            )
+        try:
+            # Copied in a worker process, which leaves the event loop and its GIL to cheap updates
+            with trace.stage('append'):
+                state = await conversion_executor.run(
+                    user_id, PDFMergeSession.add_to_state, session.state(), temp_pdf_path,
+                    lane=OPERATION_LANES['merge'], cost=Admission.estimate_cost('merge', document.file_size)
+                )
+            session = PDFMergeSession(state=state)
+        finally:
+            await release_merge(user_id, session)
+        outcome = 'ok'
+
+        # Send confirmation, replacing the previous one if it is still queued
+        file_count = session.file_count
+        replace_merge_status(context, session, StatusMessage(
+            update.message,
             f"✅ PDF received! ({file_count} {'file' if file_count == 1 else 'files'} ready to merge)\n"
             "Send more PDFs or use /donemerge when finished."
-        )
-
+        ))
+
+    except (QueueFullError, StorageFullError) as e:
+        logger.warning(f"PDF rejected for merge: {str(e)}")
+        await update.message.reply_text(BUSY_MESSAGE)
+        outcome = 'busy'
+    except (AdmissionError, PDFLimitError) as e:
+        logger.warning(f"PDF rejected for merge: {str(e)}")
+        await update.message.reply_text(f"❌ {str(e)}. This PDF was not added.")
+        outcome = 'rejected'
+    except MergeLostError as e:
+        logger.warning(f"PDF rejected for merge: {str(e)}")
+        await update.message.reply_text(MERGE_LOST_MESSAGE)
+        outcome = 'rejected'
     except Exception as e:
         logger.error(f"Error handling PDF: {str(e)}")
-        update.message.reply_text(
+        await update.message.reply_text(
             "❌ Sorry, something went wrong while processing your PDF. Please try again."
         )
+    finally:
+        trace.finish(outcome)
+        scope.close()
 
-def help_command(update: Update, context: CallbackContext):
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    if not await is_user_in_channel(context.bot, update.effective_user.id):
+        await start(update, context)
         return
 
     help_text = (
@@ -361,87 +920,220 @@ def help_command(update: Update, context: CallbackContext):
         "• Images: JPG, JPEG, PNG\n"
         "• Convert from: PDF\n"
         "• Convert to: TXT, CSV\n"
-        "Maximum file size: 20MB\n\n"
+        f"Maximum file size: {config.MAX_FILE_SIZE // (1024 * 1024)}MB\n\n"
         "Commands:\n"
         "/start - Start the bot\n"
         "/help - Show this help message\n"
         "/totext - Convert PDF to text\n"
         "/tocsv - Convert PDF to CSV\n"
         "/merge - Start merging PDFs\n"
-        "/donemerge - Complete PDF merge\n\n"
+        "/donemerge - Complete PDF merge\n"
+        "/quality - Choose between original, balanced and small PDFs\n\n"
         "Note: You must remain a member of our channel to use the bot."
     )
-    update.message.reply_text(help_text)
+    await update.message.reply_text(help_text)
 
-def handle_image(update: Update, context: CallbackContext):
+def pdf_profile(context: ContextTypes.DEFAULT_TYPE):
+    """Name of the output profile the user chose with /quality, or the default"""
+    return context.user_data.get('pdf_profile') or config.PDF_PROFILE
+
+async def quality_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or set the output profile of the PDFs the bot generates"""
+    if not await is_user_in_channel(context.bot, update.effective_user.id):
+        await start(update, context)
+        return
+
+    choices = ", ".join(PROFILES)
+    if not context.args:
+        await update.message.reply_text(
+            f"📐 Your PDFs use the '{pdf_profile(context)}' profile.\n"
+            f"Use /quality <name> to change it. Profiles: {choices}."
+        )
+        return
+
+    name = context.args[0].lower()
+    if name not in PROFILES:
+        await update.message.reply_text(f"❌ Unknown profile. Choose one of: {choices}.")
+        return
+    context.user_data['pdf_profile'] = name
+    await update.message.reply_text(f"✅ New PDFs will use the '{name}' profile.")
+
+async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming images and convert them to PDF."""
+    trace = RequestTrace('handle_image')
+
     # Check channel membership first
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    with trace.stage('membership'):
+        is_member = await is_user_in_channel(context.bot, update.effective_user.id)
+    if not is_member:
+        await start(update, context)
         return
 
-    # Initialize variables
-    temp_image_path = None
-    pdf_path = None
-
     try:
         if update.message.photo:
-            photo = update.message.photo[-1]
-            file_id = photo.file_id
+            image = update.message.photo[-1]
         elif update.message.document:
             document = update.message.document
             if not any(document.file_name.lower().endswith(ext) for ext in config.ALLOWED_FORMATS):
-                update.message.reply_text("❌ Please send a valid image file (JPG, JPEG, or PNG).")
+                await update.message.reply_text("❌ Please send a valid image file (JPG, JPEG, or PNG).")
                 return
-            file_id = document.file_id
+            image = document
         else:
-            update.message.reply_text("❌ Please send an image file.")
+            await update.message.reply_text("❌ Please send an image file.")
             return
+        Admission.check_size(image.file_size)
 
-        # Download the file
-        new_file = context.bot.get_file(file_id)
-        temp_image_path = os.path.join(config.TEMP_DIR, f"{str(uuid.uuid4())}_image{os.path.splitext(new_file.file_path)[1]}")
-        new_file.download(temp_image_path)
-
-        # Send processing message
-        processing_message = update.message.reply_text("🔄 Processing your image...")
+        # Photos sent as an album are batched into a single PDF
+        if update.message.media_group_id:
+            album_collector.add(update.message.media_group_id, (update, context, image.file_id, image.file_size))
+            return
 
-        # Convert to PDF
-        pdf_path = ImageConverter.convert_to_pdf(temp_image_path)
+        # Reuse the PDF we sent last time this image was converted
+        profile = pdf_profile(context)
+        cache_key = ResultCache.make_key(image.file_unique_id, "image_to_pdf", profile=profile)
+        if await send_cached_result(update, cache_key, "✅ Here's your PDF!", trace):
+            return
 
-        # Send the PDF file
-        with open(pdf_path, 'rb') as pdf_file:
-            update.message.reply_document(
-                document=pdf_file,
-                filename="converted.pdf",
-                caption="✅ Here's your PDF!"
-            )
+        # Refuse early rather than downloading a job we can't queue
+        if not has_capacity(update.effective_user.id, scratch_bytes('image_to_pdf', image.file_size)):
+            await update.message.reply_text(BUSY_MESSAGE)
+            trace.finish('busy')
+            return
 
-        # Clean up
-        ImageConverter.cleanup_files([temp_image_path, pdf_path])
-        context.bot.delete_message(
-            chat_id=update.message.chat_id,
-            message_id=processing_message.message_id
+        # Download and convert in the background so this chat's next update isn't held up
+        job = conversion_job(
+            update, 'image_to_pdf', image, cache_key, "converted.pdf", "✅ Here's your PDF!", profile
         )
+        await submit_job(update, context, job, "🔄 Processing your image...", trace)
 
+    except AdmissionError as e:
+        trace.finish('rejected')
+        await update.message.reply_text(f"❌ {str(e)}.")
     except Exception as e:
+        trace.finish('error')
         logger.error(f"Error processing image: {str(e)}")
-        update.message.reply_text(
+        await update.message.reply_text(
             "❌ Sorry, something went wrong while processing your image. Please try again."
         )
-        # Clean up in case of error
-        if temp_image_path:
-            ImageConverter.cleanup_files([temp_image_path])
-        if pdf_path:
-            ImageConverter.cleanup_files([pdf_path])
 
-def handle_conversion_callback(update: Update, context: CallbackContext):
+async def process_album(items):
+    """Convert every photo of an album into one multi-page PDF with a single upload"""
+    items.sort(key=lambda item: item[0].message.message_id)
+    update, context = items[0][0], items[0][1]
+    trace = RequestTrace('album')
+    scope = temp_storage.scope()
+    status = None
+    outcome = 'error'
+
+    try:
+        # Only parts too large to keep in memory take up disk space, and so does
+        # the PDF made from them; a local Bot API server's copies are read in place
+        disk_bytes = (1 if config.BOT_API_LOCAL_MODE else 2) * sum(
+            file_size or config.MAX_FILE_SIZE for _, _, _, file_size in items
+            if not file_size or file_size > config.IN_MEMORY_MAX_SIZE
+        )
+        if not has_capacity(update.effective_user.id, disk_bytes):
+            await update.message.reply_text(BUSY_MESSAGE)
+            outcome = 'busy'
+            return
+        scope.reserve(disk_bytes)
+
+        # Send processing message
+        status = StatusMessage(update.message, f"🔄 Processing your {len(items)} images...")
+
+        # Download all parts concurrently, as many at a time as the download manager allows one user
+        user_id = update.effective_user.id
+        downloads = await asyncio.gather(
+            *(download_input(context.bot, user_id, file_id, file_size, None, scope, trace)
+              for _, _, file_id, file_size in items),
+            return_exceptions=True
+        )
+        if any(isinstance(download_result, BaseException) for download_result in downloads):
+            raise Exception("Failed to download part of the album")
+        sources = [data if data is not None else path for data, path in downloads]
+
+        # One expensive photo sends the whole album to the heavy lane
+        with trace.stage('admission'):
+            lanes = await asyncio.to_thread(lambda: [Admission.image_lane(source) for source in sources])
+        executor = heavy_executor if HEAVY in lanes else conversion_executor
+        cost = sum(
+            Admission.estimate_cost('album', len(source) if isinstance(source, bytes) else os.path.getsize(source))
+            for source in sources
+        )
+
+        # Decode pages in parallel, then write them into one PDF in album order
+        submitted = time.perf_counter()
+        profile = pdf_profile(context)
+        prepared = await executor.run_many(
+            update.effective_user.id, ImageConverter.prepare_page, [(source, profile) for source in sources],
+            lane=OPERATION_LANES['album'], cost=cost
+        )
+        output_path = scope.path('.pdf') if disk_bytes else None
+        output = await asyncio.to_thread(write_album, sources, prepared, profile, output_path)
+        trace.record('convert', time.perf_counter() - submitted)
+        trace.add_bytes_out(output_size(output))
+
+        with open_output(output) as output_file, trace.stage('upload'):
+            await update.message.reply_document(
+                document=upload_file(output_file, "converted.pdf"),
+                caption=f"✅ Here's your {len(sources)}-page PDF!",
+                read_timeout=config.BOT_API_FILE_TIMEOUT,
+                write_timeout=config.BOT_API_FILE_TIMEOUT
+            )
+        with trace.stage('delete_message'):
+            await status.clear()
+        outcome = 'ok'
+
+    except (QueueFullError, StorageFullError) as e:
+        logger.warning(f"Rejected album: {str(e)}")
+        if status:
+            await status.clear()
+        await update.message.reply_text(BUSY_MESSAGE)
+        outcome = 'busy'
+    except (AdmissionError, ImageLimitError) as e:
+        logger.warning(f"Rejected album: {str(e)}")
+        await status.clear()
+        await update.message.reply_text(f"❌ {str(e)}.")
+        outcome = 'rejected'
+    except Exception as e:
+        logger.error(f"Error processing album: {str(e)}")
+        if status:
+            await status.clear()
+        await update.message.reply_text(
+            "❌ Sorry, something went wrong while processing your images. Please try again."
+        )
+    finally:
+        trace.finish(outcome)
+        scope.close()
+
+def write_album(sources, prepared, profile=None, output_path=None):
+    """Write the prepared album pages into one PDF, in memory unless output_path is given
+
+    Sources that are files are copied into it in chunks, never read whole.
+    """
+    pages = [
+        (source if jpeg_data is None else jpeg_data, jpeg_info)
+        for source, (jpeg_data, jpeg_info) in zip(sources, prepared)
+    ]
+    if output_path:
+        with open(output_path, 'wb') as output_file:
+            ImageConverter.write_pages(pages, output_file, profile)
+        return output_path
+
+    output = io.BytesIO()
+    ImageConverter.write_pages(pages, output, profile)
+    return output.getvalue()
+
+# Batches album photos by media_group_id
+album_collector = AlbumCollector(process_album, window=config.ALBUM_WINDOW)
+
+async def handle_conversion_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle conversion button callbacks"""
     query = update.callback_query
-    query.answer()
+    await query.answer()
 
-    if not is_user_in_channel(context.bot, update.effective_user.id):
-        start(update, context)
+    if not await is_user_in_channel(context.bot, update.effective_user.id):
+        await start(update, context)
         return
 
     action = query.data
@@ -450,25 +1142,25 @@ def handle_conversion_callback(update: Update, context: CallbackContext):
             "📸 Send me an image (JPG, JPEG, or PNG)\n"
             "I'll convert it to PDF for you!"
         )
-        query.edit_message_text(text=message)
+        await query.edit_message_text(text=message)
     elif action == 'convert_to_text':
         message = (
             "📄 Send me a PDF file\n"
             "I'll convert it to text for you!"
         )
-        query.edit_message_text(text=message)
+        await query.edit_message_text(text=message)
     elif action == 'convert_to_csv':
         message = (
             "📊 Send me a PDF file\n"
             "I'll convert it to CSV for you!"
         )
-        query.edit_message_text(text=message)
+        await query.edit_message_text(text=message)
     elif action == 'merge_pdfs':
         message = (
             "📚 Send me multiple PDF files one by one\n"
             "When you're done, use /donemerge to merge them!"
         )
-        query.edit_message_text(text=message)
+        await query.edit_message_text(text=message)
     elif action == 'show_help':
         help_text = (
             "🔍 Quick Guide:\n\n"
@@ -478,43 +1170,178 @@ def handle_conversion_callback(update: Update, context: CallbackContext):
             "• Merge PDFs: Use /merge, then send PDFs\n\n"
             "Type /help for more details!"
         )
-        query.edit_message_text(text=help_text)
+        await query.edit_message_text(text=help_text)
     elif action == 'more_options':
         message = "More options coming soon!"
-        query.edit_message_text(text=message)
+        await query.edit_message_text(text=message)
     else:
         message = "Invalid option selected. Please try again."
-        query.edit_message_text(text=message)
+        await query.edit_message_text(text=message)
 
 
 
+def run_webhook(application):
+    """Serve updates over a webhook instead of long polling"""
+    if not config.WEBHOOK_URL:
+        logger.error("WEBHOOK_URL must be set when BOT_MODE is 'webhook'")
+        return False
+    if not config.WEBHOOK_SECRET_TOKEN:
+        logger.error("WEBHOOK_SECRET_TOKEN must be set when BOT_MODE is 'webhook'")
+        return False
+
+    # Telegram sends the secret in the X-Telegram-Bot-Api-Secret-Token header;
+    # the webhook server answers 403 to any request without the right one
+    url_path = config.WEBHOOK_PATH.strip('/')
+    logger.info(f"Webhook server listening on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}")
+    application.run_webhook(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        url_path=url_path,
+        webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{url_path}",
+        secret_token=config.WEBHOOK_SECRET_TOKEN,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES
+    )
+    return True
+
+async def on_startup(application):
+    """Fetch channel metadata once instead of on every verify click, and start the maintenance loops"""
+    await load_channel_info(application.bot)
+    loop = asyncio.get_running_loop()
+    maintenance_tasks.append(loop.create_task(maintain_store(application)))
+    maintenance_tasks.append(loop.create_task(temp_janitor()))
+
+async def on_stop(application):
+    """Stop the maintenance loops; jobs still leased to us are taken over by another worker"""
+    for task in maintenance_tasks:
+        task.cancel()
+    await download_manager.close()
+
 def main():
     """Start the bot."""
+    global conversion_executor, heavy_executor, result_cache, send_scheduler, session_store, temp_storage
+    global download_manager
+
     if not config.BOT_TOKEN:
         logger.error("Bot token not set! Please set your bot token in config.py")
         return
+    if config.PDF_PROFILE not in PROFILES:
+        logger.error(f"PDF_PROFILE must be one of {', '.join(PROFILES)}, not {config.PDF_PROFILE!r}")
+        return
 
-    # Create the Updater and pass it your bot's token
-    updater = Updater(config.BOT_TOKEN)
+    # Every temp file lives under TEMP_DIR within one byte budget
+    temp_storage = TempStorage(
+        config.TEMP_DIR,
+        max_bytes=config.TEMP_MAX_BYTES,
+        min_free_bytes=config.TEMP_MIN_FREE_BYTES,
+        stale_merge_age=config.TEMP_STALE_MERGE_AGE,
+        orphan_age=config.TEMP_ORPHAN_AGE
+    )
 
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
+    # Start and warm up the conversion process pools before taking any updates
+    conversion_executor = ConversionExecutor(
+        max_workers=config.CONVERSION_WORKERS,
+        max_queue_size=config.CONVERSION_QUEUE_SIZE,
+        max_jobs_per_user=config.CONVERSION_JOBS_PER_USER,
+        preload=WORKER_PRELOAD,
+        warmups=WORKER_WARMUPS,
+        lanes=scheduler_lanes(config.CONVERSION_WORKERS)
+    )
+    heavy_executor = ConversionExecutor(
+        max_workers=config.HEAVY_CONVERSION_WORKERS,
+        max_queue_size=config.HEAVY_QUEUE_SIZE,
+        max_jobs_per_user=1,
+        niceness=config.HEAVY_NICENESS,
+        preload=WORKER_PRELOAD,
+        warmups=WORKER_WARMUPS,
+        lanes=scheduler_lanes(config.HEAVY_CONVERSION_WORKERS)
+    )
+    started = time.perf_counter()
+    concurrent.futures.wait(conversion_executor.start() + heavy_executor.start())
+    logger.info(f"Conversion workers ready in {time.perf_counter() - started:.2f}s")
+    result_cache = ResultCache(
+        config.RESULT_CACHE_PATH,
+        max_entries=config.RESULT_CACHE_SIZE,
+        ttl=config.RESULT_CACHE_TTL
+    )
+    # Every download streams to its destination, a few files per user at a time
+    download_manager = DownloadManager(
+        max_concurrent=config.DOWNLOAD_WORKERS,
+        per_user=config.DOWNLOAD_PER_USER,
+        retries=config.DOWNLOAD_RETRIES,
+        timeout=config.DOWNLOAD_TIMEOUT
+    )
+    # Merge sessions and jobs live here so any worker can continue them
+    session_store = open_session_store(config.SESSION_STORE_URL)
+
+    # Outgoing messages are paced under Telegram's flood limits, results first
+    send_scheduler = SendScheduler(
+        overall_rate=config.SEND_OVERALL_RATE,
+        chat_rate=config.SEND_CHAT_RATE,
+        group_rate=config.SEND_GROUP_RATE,
+        chat_burst=config.SEND_CHAT_BURST,
+        max_retries=config.SEND_MAX_RETRIES
+    )
+
+    # Expose latency histograms and counters on a local /metrics endpoint
+    RequestTrace.slow_threshold = config.SLOW_REQUEST_SECONDS
+    metrics.QUEUE_DEPTH.set_function(conversion_executor.queue_depth)
+    metrics.HEAVY_QUEUE_DEPTH.set_function(heavy_executor.queue_depth)
+    metrics.SEND_QUEUE_DEPTH.set_function(send_scheduler.queue_depth)
+    metrics.ACTIVE_DOWNLOADS.set_function(download_manager.active)
+    for kind in ('reserved', 'disk', 'free'):
+        metrics.TEMP_BYTES.set_function(lambda kind=kind: temp_storage.usage()[kind], kind=kind)
+    if config.METRICS_PORT:
+        metrics.start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
+
+    # Create the Application: updates are handled concurrently (in order within
+    # a chat) and all Bot API calls share one pool of keep-alive connections
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(config.CONCURRENT_UPDATES))
+        .connection_pool_size(config.CONNECTION_POOL_SIZE)
+        .pool_timeout(config.CONNECTION_POOL_TIMEOUT)
+        .rate_limiter(send_scheduler)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+    )
+    if config.BOT_API_BASE_URL:
+        builder.base_url(config.BOT_API_BASE_URL)
+    if config.BOT_API_FILE_URL:
+        builder.base_file_url(config.BOT_API_FILE_URL)
+    if config.BOT_API_LOCAL_MODE:
+        # File paths from getFile are on this machine; downloads are read from them in place
+        builder.local_mode(True)
+    application = builder.build()
 
     # Add handlers
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", help_command))
-    dp.add_handler(CommandHandler("totext", pdf_to_text))
-    dp.add_handler(CommandHandler("tocsv", pdf_to_csv))
-    dp.add_handler(CommandHandler("merge", merge_pdfs_command))
-    dp.add_handler(CommandHandler("donemerge", done_merge_command))
-    dp.add_handler(CallbackQueryHandler(verify_membership, pattern='^verify_membership$'))
-    dp.add_handler(MessageHandler(Filters.photo | Filters.document.image, handle_image))
-    dp.add_handler(MessageHandler(Filters.document.pdf, handle_pdf_document))
-    dp.add_handler(CallbackQueryHandler(handle_conversion_callback)) #Added handler for conversion callbacks
-
-    # Start the Bot
-    updater.start_polling()
-    updater.idle()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("totext", pdf_to_text))
+    application.add_handler(CommandHandler("tocsv", pdf_to_csv))
+    application.add_handler(CommandHandler("merge", merge_pdfs_command))
+    application.add_handler(CommandHandler("donemerge", done_merge_command))
+    application.add_handler(CommandHandler("quality", quality_command))
+    # A PDF sent with /totext or /tocsv as its caption (CommandHandler only reads message text)
+    application.add_handler(MessageHandler(filters.Document.PDF & filters.CaptionRegex(r'^/totext(@\w+)?(\s|$)'), pdf_to_text))
+    application.add_handler(MessageHandler(filters.Document.PDF & filters.CaptionRegex(r'^/tocsv(@\w+)?(\s|$)'), pdf_to_csv))
+    application.add_handler(CallbackQueryHandler(verify_membership, pattern='^verify_membership$'))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_image))
+    application.add_handler(MessageHandler(filters.Document.PDF, handle_pdf_document))
+    application.add_handler(CallbackQueryHandler(handle_conversion_callback)) #Added handler for conversion callbacks
+    application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+
+    # Start the Bot (chat_member updates must be requested explicitly)
+    if config.BOT_MODE == 'webhook':
+        run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+    conversion_executor.shutdown()
+    heavy_executor.shutdown()
+    result_cache.close()
+    session_store.close()
 
 if __name__ == '__main__':
     main()
@@ -4,12 +4,108 @@ import os
 BOT_TOKEN = os.environ.get('BOT_TOKEN')  # Get token from environment variables
 CHANNEL_LINK = os.environ.get('CHANNEL_LINK', 'https://t.me/your_channel')  # Your channel invite link
 CHANNEL_ID = os.environ.get('CHANNEL_ID', '@your_channel_id')  # Your channel ID or username
+BOT_API_BASE_URL = os.environ.get('BOT_API_BASE_URL')  # Bot API endpoint, defaults to https://api.telegram.org/bot
+BOT_API_FILE_URL = os.environ.get('BOT_API_FILE_URL')  # File download endpoint, defaults to https://api.telegram.org/file/bot
+BOT_API_LOCAL_MODE = os.environ.get('BOT_API_LOCAL_MODE', '').lower() in ('1', 'true', 'yes')  # BOT_API_BASE_URL is a server run with --local that shares this machine's disk
+BOT_API_FILE_TIMEOUT = float(os.environ.get('BOT_API_FILE_TIMEOUT', 600))  # Seconds for getFile and uploads, which a local server only answers once the transfer is done
+
+# Update Delivery Settings
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Public base URL, e.g. https://bot.example.com behind a reverse proxy
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')  # Address the local webhook server binds to
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))  # Port the local webhook server binds to
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'webhook')  # URL path Telegram posts updates to
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')  # Shared secret Telegram sends in a header with every update, required in webhook mode
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))  # Concurrent connections Telegram may open
+
+# Update Processing Settings
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 1024))  # Updates handled at once, in order within a chat
+CONNECTION_POOL_SIZE = int(os.environ.get('CONNECTION_POOL_SIZE', 256))  # Keep-alive connections to the Bot API
+CONNECTION_POOL_TIMEOUT = float(os.environ.get('CONNECTION_POOL_TIMEOUT', 30))  # Seconds to wait for a free connection
+
+# Send Scheduler Settings
+SEND_OVERALL_RATE = float(os.environ.get('SEND_OVERALL_RATE', 30))  # Messages per second across all chats
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))  # Messages per second to one private chat
+SEND_GROUP_RATE = float(os.environ.get('SEND_GROUP_RATE', 20 / 60))  # Messages per second to one group or channel
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3))  # Messages a chat may receive back to back
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))  # Retries after a 429 before a send fails
+
+# Membership Cache Settings
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 10000))  # Max cached users
+MEMBERSHIP_POSITIVE_TTL = int(os.environ.get('MEMBERSHIP_POSITIVE_TTL', 600))  # Seconds to trust "is a member"
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 30))  # Seconds to trust "not a member"
+
+# Conversion Executor Settings
+CONVERSION_WORKERS = int(os.environ.get('CONVERSION_WORKERS', os.cpu_count() or 2))  # Worker processes
+CONVERSION_QUEUE_SIZE = int(os.environ.get('CONVERSION_QUEUE_SIZE', 32))  # Max queued + running jobs
+CONVERSION_JOBS_PER_USER = int(os.environ.get('CONVERSION_JOBS_PER_USER', 2))  # Max jobs per user
+
+# Scheduler Settings
+INTERACTIVE_LANE_WEIGHT = float(os.environ.get('INTERACTIVE_LANE_WEIGHT', 4))  # Share of free workers for photos and albums
+INTERACTIVE_LANE_DEADLINE = float(os.environ.get('INTERACTIVE_LANE_DEADLINE', 30))  # Seconds a photo may wait for a worker, 0 waits forever
+DOCUMENT_LANE_WEIGHT = float(os.environ.get('DOCUMENT_LANE_WEIGHT', 1))  # Share of free workers for /totext and /tocsv
+DOCUMENT_LANE_DEADLINE = float(os.environ.get('DOCUMENT_LANE_DEADLINE', 300))  # Seconds a /totext or /tocsv may wait for a worker
+DOCUMENT_LANE_WORKERS = int(os.environ.get('DOCUMENT_LANE_WORKERS', 0))  # Workers /totext and /tocsv may hold at once, 0 leaves one to the other lanes
+MERGE_LANE_WEIGHT = float(os.environ.get('MERGE_LANE_WEIGHT', 2))  # Share of free workers for adding PDFs to merges
+MERGE_LANE_DEADLINE = float(os.environ.get('MERGE_LANE_DEADLINE', 120))  # Seconds a merged PDF may wait for a worker, well within SESSION_LEASE
+
+# Result Cache Settings
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', 'result_cache.sqlite3')  # SQLite file for sent results
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 50000))  # Max cached results
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 7 * 24 * 3600))  # Seconds before a result is reconverted
+
+# Session Store Settings
+# Merge sessions keep their output under TEMP_DIR, so workers sharing a store must share TEMP_DIR too
+SESSION_STORE_URL = os.environ.get('SESSION_STORE_URL', 'sqlite:///sessions.sqlite3')  # sqlite:///path or unix:///path to a store server
+WORKER_ID = os.environ.get('WORKER_ID')  # Name of this worker in the store, defaults to hostname:pid
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))  # Seconds before an untouched merge session is deleted
+SESSION_LEASE = int(os.environ.get('SESSION_LEASE', 300))  # Seconds a worker may hold a merge session
+SESSION_LOCK_TIMEOUT = float(os.environ.get('SESSION_LOCK_TIMEOUT', 30))  # Seconds to wait for a session another worker holds
+JOB_LEASE = int(os.environ.get('JOB_LEASE', 120))  # Seconds before a job whose worker stopped renewing it is retried
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))  # Attempts before an abandoned job is dropped
+STORE_MAINTENANCE_INTERVAL = float(os.environ.get('STORE_MAINTENANCE_INTERVAL', 30))  # Seconds between expiry and recovery sweeps
+
+# Metrics Settings
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')  # Address of the /metrics endpoint
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # Port of the /metrics endpoint, 0 disables it
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0))  # Log a stage breakdown above this, 0 disables
 
 # File Settings
-MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB max file size
+MAX_FILE_SIZE = min(
+    int(os.environ.get('MAX_FILE_SIZE', 20 * 1024 * 1024)),
+    (2000 if BOT_API_LOCAL_MODE else 20) * 1024 * 1024
+)  # The cloud Bot API can't download more than 20MB, a local server up to 2000MB
 ALLOWED_FORMATS = ['.jpg', '.jpeg', '.png']
-TEMP_DIR = "temp"
+TEMP_DIR = os.environ.get('TEMP_DIR', 'temp')  # Point at a tmpfs mount (e.g. /dev/shm/bot) to keep temp files in RAM
+IN_MEMORY_MAX_SIZE = int(os.environ.get('IN_MEMORY_MAX_SIZE', 8 * 1024 * 1024))  # Larger files spill to TEMP_DIR
+
+# Temp Storage Settings
+TEMP_MAX_BYTES = int(os.environ.get('TEMP_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # Budget for everything under TEMP_DIR
+TEMP_MIN_FREE_BYTES = int(os.environ.get('TEMP_MIN_FREE_BYTES', 256 * 1024 * 1024))  # Refuse work that would leave less free space
+TEMP_STALE_MERGE_AGE = int(os.environ.get('TEMP_STALE_MERGE_AGE', 600))  # Seconds idle before a merge may be evicted for space
+TEMP_ORPHAN_AGE = int(os.environ.get('TEMP_ORPHAN_AGE', 3600))  # Seconds before the janitor deletes an unowned temp file
+TEMP_JANITOR_INTERVAL = float(os.environ.get('TEMP_JANITOR_INTERVAL', 60))  # Seconds between janitor sweeps
+
+# Admission Settings
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50000000))  # Larger images are rejected before decoding
+HEAVY_DECODE_BYTES = int(os.environ.get('HEAVY_DECODE_BYTES', 256 * 1024 * 1024))  # Images needing more memory to decode go to the heavy lane
+HEAVY_PDF_PAGES = int(os.environ.get('HEAVY_PDF_PAGES', 100))  # PDFs with more pages go to the heavy lane
+HEAVY_CONVERSION_WORKERS = int(os.environ.get('HEAVY_CONVERSION_WORKERS', 1))  # Worker processes of the heavy lane
+HEAVY_QUEUE_SIZE = int(os.environ.get('HEAVY_QUEUE_SIZE', 4))  # Max queued + running heavy jobs
+HEAVY_NICENESS = int(os.environ.get('HEAVY_NICENESS', 10))  # CPU niceness of heavy lane workers
+
+# Download Settings
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 32))  # Files downloaded at once
+DOWNLOAD_PER_USER = int(os.environ.get('DOWNLOAD_PER_USER', 10))  # Files of one user (album parts, merge inputs) downloaded at once
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', 3))  # Resumed attempts after a dropped connection, timeout or 5xx
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', 60))  # Seconds without progress before an attempt fails
+
+# Album Settings
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', 1.0))  # Seconds to wait for more photos of an album
 
-# Create temp directory if it doesn't exist
-if not os.path.exists(TEMP_DIR):
-    os.makedirs(TEMP_DIR)
+# PDF Settings
+MAX_PDF_PAGES = int(os.environ.get('MAX_PDF_PAGES', 500))  # Larger PDFs are rejected
+PDF_TEXT_TIMEOUT = int(os.environ.get('PDF_TEXT_TIMEOUT', 120))  # Seconds allowed for one text extraction
+MERGE_MAX_PAGES = int(os.environ.get('MERGE_MAX_PAGES', 1000))  # Max pages in one merge session
+MERGE_MAX_BYTES = int(os.environ.get('MERGE_MAX_BYTES', 100 * 1024 * 1024))  # Max total input bytes per merge session
+PDF_PROFILE = os.environ.get('PDF_PROFILE', 'original')  # Default output profile from pdf_profiles.PROFILES; 'original' embeds JPEGs unchanged
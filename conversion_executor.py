@@ -0,0 +1,339 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lane of jobs run without naming one
+DEFAULT_LANE = 'default'
+
+
+class QueueFullError(Exception):
+    """Raised when a conversion job cannot be queued"""
+
+
+class DeadlineExceededError(QueueFullError):
+    """Raised when a job waited in its lane longer than the lane's deadline"""
+
+
+def process_context(preload=None):
+    """Multiprocessing context for worker pools: a fork server where the platform has one, else spawn
+
+    Forking a process with a running event loop and HTTP pool is unsafe, but
+    the fork server is a clean process that imports the preload modules once;
+    every worker forked from it starts with them already loaded.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    if preload:
+        context.set_forkserver_preload(preload)
+    return context
+
+
+def _init_worker(niceness, warmups):
+    # Lower-priority pools yield the CPU to the normal one
+    if niceness:
+        os.nice(niceness)
+    for warmup in warmups:
+        try:
+            warmup()
+        except Exception as e:
+            logger.error(f"Error warming up conversion worker: {str(e)}")
+
+
+def _ready():
+    return True
+
+
+def _call_soon(loop, callback):
+    # Pool futures finish on the pool's own thread
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        # The loop closed before the job finished; there is nothing left to release to
+        pass
+
+
+def _discard(future):
+    # Retrieve the outcome of a job nobody waits for any more, so it is not logged as unhandled
+    if not future.cancelled():
+        future.exception()
+
+
+class JobScheduler:
+    """Hands out a fixed number of run slots across lanes, users and job sizes
+
+    Each lane is an operation class with a weight, a deadline and a limit on
+    the slots it may hold at once. Whenever a slot frees up, the lanes with
+    waiting jobs and room under their limit share it in proportion to their
+    weights, so cheap interactive jobs keep moving while heavy ones saturate
+    the workers. Within a lane, users get equal turns by fair queueing: a
+    job's tag is where its user's previous job finishes in
+    the lane's virtual time plus the job's estimated cost, and the lowest
+    tag runs first, so a user's cheap jobs also go before their expensive
+    ones. Jobs still waiting after their lane's deadline are cancelled with
+    DeadlineExceededError.
+    """
+
+    def __init__(self, capacity, lanes):
+        self._free = capacity
+        self._lanes = {
+            name: {'weight': weight, 'deadline': deadline, 'limit': limit or capacity, 'running': 0,
+                   'pass': 0.0, 'vtime': 0.0, 'finish': {}, 'waiting': [], 'queued': 0}
+            for name, (weight, deadline, limit) in lanes.items()
+        }
+        self._pass = 0.0
+        self._sequence = itertools.count()
+
+    async def acquire(self, lane_name, user_id, cost=1.0):
+        """Wait for a run slot in the given lane; returns a function that gives it back"""
+        lane = self._lanes[lane_name]
+        if not lane['queued']:
+            # An idle lane rejoins at the current pass instead of claiming the turns it missed
+            lane['pass'] = max(lane['pass'], self._pass)
+        start = max(lane['vtime'], lane['finish'].get(user_id, 0.0))
+        finish = start + max(cost, 0.0)
+        lane['finish'][user_id] = finish
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane['waiting'], (finish, next(self._sequence), start, cost, granted))
+        lane['queued'] += 1
+        queued_at = time.monotonic()
+        self._dispatch()
+
+        try:
+            # wait_for cancels the future on timeout, and a cancelled future is never granted
+            await asyncio.wait_for(granted, lane['deadline'] or None)
+        except BaseException as e:
+            if not granted.done():
+                granted.cancel()
+            if granted.cancelled():
+                lane['queued'] -= 1
+            else:
+                # Granted just as the wait gave up
+                self._give_back(lane)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.LANE_DEADLINE_MISSES.labels(lane=lane_name).inc()
+                raise DeadlineExceededError(f"Job waited over {lane['deadline']}s in the {lane_name} lane")
+            raise
+        metrics.LANE_WAIT_SECONDS.labels(lane=lane_name).observe(time.monotonic() - queued_at)
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._give_back(lane)
+        return release
+
+    def limit(self, lane_name):
+        """Number of slots the lane may hold at once"""
+        return self._lanes[lane_name]['limit']
+
+    def queued(self, lane_name=None):
+        """Number of jobs waiting for a slot, in one lane or all of them"""
+        if lane_name:
+            return self._lanes[lane_name]['queued']
+        return sum(lane['queued'] for lane in self._lanes.values())
+
+    def _give_back(self, lane):
+        lane['running'] -= 1
+        self._free += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._free:
+            lanes = [lane for lane in self._lanes.values() if lane['queued'] and lane['running'] < lane['limit']]
+            if not lanes:
+                return
+            lane = min(lanes, key=lambda lane: lane['pass'])
+            finish, _, start, cost, granted = heapq.heappop(lane['waiting'])
+            if granted.cancelled():
+                # Left behind by a job that gave up waiting
+                continue
+            granted.set_result(None)
+            lane['queued'] -= 1
+            lane['running'] += 1
+            lane['vtime'] = start
+            lane['pass'] += max(cost, 1.0) / lane['weight']
+            self._pass = lane['pass']
+            self._free -= 1
+            self._prune(lane)
+
+    @staticmethod
+    def _prune(lane):
+        # Users whose last job is behind the lane's virtual time start from it anyway
+        if len(lane['finish']) > 1024:
+            lane['finish'] = {user_id: finish for user_id, finish in lane['finish'].items()
+                              if finish > lane['vtime']}
+
+
+class ConversionExecutor:
+    """Process pool for CPU-bound conversions with a bounded, per-user fair queue
+
+    Jobs are awaited from the event loop with run(), run_many() and map(); the
+    worker processes do the CPU work while the loop keeps serving updates.
+    Workers come from a fork server that imported the preload modules, and
+    run every warmup callable (loading codecs, fonts and the like) before
+    their first job. start() brings them all up ahead of any jobs.
+
+    Jobs are handed to the pool only when a worker is free; until then they
+    wait in a JobScheduler over the given lanes, a {name: (weight, deadline,
+    limit)} dict, so they run in an order set by their lane, user and cost
+    rather than by their arrival.
+    """
+
+    def __init__(self, max_workers=None, max_queue_size=32, max_jobs_per_user=2, niceness=0,
+                 preload=None, warmups=(), lanes=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=process_context(preload),
+            initializer=_init_worker,
+            initargs=(niceness, tuple(warmups))
+        )
+        self.max_queue_size = max_queue_size
+        self.max_jobs_per_user = max_jobs_per_user
+        self._pending = 0
+        self._per_user = {}
+        self._lock = threading.Lock()
+        self._scheduler = JobScheduler(self.max_workers, lanes or {DEFAULT_LANE: (1, None, None)})
+
+    def start(self):
+        """Start and warm up every worker process now rather than on the first jobs
+
+        Returns futures that finish once the workers are ready.
+        """
+        # The pool only reuses a worker once it has finished a job, and warming
+        # up outlasts this loop, so each of these starts a process of its own
+        return [self._pool.submit(_ready) for _ in range(self.max_workers)]
+
+    def can_accept(self, user_id):
+        """Cheap check used before downloading anything for a job"""
+        with self._lock:
+            return (self._pending < self.max_queue_size and
+                    self._per_user.get(user_id, 0) < self.max_jobs_per_user)
+
+    async def run(self, user_id, fn, *args, lane=DEFAULT_LANE, cost=1.0):
+        """Run fn(*args) in a worker process and return its result, raising QueueFullError on backpressure
+
+        cost is the job's estimated size relative to other jobs of its lane.
+        """
+        self._reserve(user_id)
+        try:
+            return await self._submit(lane, user_id, cost, fn, args)
+        finally:
+            self._release(user_id)
+
+    async def run_many(self, user_id, fn, args_list, lane=DEFAULT_LANE, cost=1.0):
+        """Run fn over several argument tuples in parallel as a single queued job
+
+        Returns the results in order; if any call failed, its exception is
+        raised once all of them have finished. Each call waits for a worker
+        of its own, with an even share of cost.
+        """
+        if not args_list:
+            raise ValueError("run_many needs at least one argument tuple")
+        self._reserve(user_id)
+        try:
+            part_cost = cost / len(args_list)
+            results = await asyncio.gather(
+                *(self._submit(lane, user_id, part_cost, fn, args) for args in args_list),
+                return_exceptions=True
+            )
+        finally:
+            self._release(user_id)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def map(self, user_id, fn, args_list, lane=DEFAULT_LANE, cost=1.0, window=None):
+        """Run fn over several argument tuples in parallel as a single queued job, yielding the results in order
+
+        At most window calls (twice the lane's worker limit by default) are
+        queued or running at once, and each result is handed over as soon as
+        every earlier one has been, so results never pile up in memory. The
+        first failed call raises its exception and cancels the rest; close
+        the generator (e.g. with contextlib.aclosing) when stopping early.
+        """
+        if not args_list:
+            raise ValueError("map needs at least one argument tuple")
+        self._reserve(user_id)
+        part_cost = cost / len(args_list)
+        window = window or 2 * self._scheduler.limit(lane)
+        remaining = iter(args_list)
+        running = collections.deque()
+        try:
+            for args in itertools.islice(remaining, window):
+                running.append(asyncio.ensure_future(self._submit(lane, user_id, part_cost, fn, args)))
+            while running:
+                result = await running.popleft()
+                for args in itertools.islice(remaining, 1):
+                    running.append(asyncio.ensure_future(self._submit(lane, user_id, part_cost, fn, args)))
+                yield result
+        finally:
+            for task in running:
+                task.cancel()
+            self._release(user_id)
+
+    def queued(self, lane=None):
+        """Number of jobs waiting for a worker, in one lane or all of them"""
+        return self._scheduler.queued(lane)
+
+    def queue_depth(self):
+        """Number of jobs queued or running"""
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and tear down the worker processes"""
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+
+    async def _submit(self, lane, user_id, cost, fn, args):
+        release = await self._scheduler.acquire(lane, user_id, cost)
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            release()
+            raise
+
+        # A cancelled caller stops waiting, but the worker keeps running the
+        # job, so its slot is only given back once the job itself is done
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: _call_soon(loop, release))
+        result = asyncio.wrap_future(future, loop=loop)
+        try:
+            return await asyncio.shield(result)
+        except asyncio.CancelledError:
+            result.add_done_callback(_discard)
+            raise
+
+    def _reserve(self, user_id):
+        with self._lock:
+            if self._pending >= self.max_queue_size:
+                raise QueueFullError("Conversion queue is full")
+            if self._per_user.get(user_id, 0) >= self.max_jobs_per_user:
+                raise QueueFullError(f"User {user_id} has too many conversions in progress")
+            self._pending += 1
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+
+    def _release(self, user_id):
+        with self._lock:
+            self._pending -= 1
+            remaining = self._per_user.get(user_id, 0) - 1
+            if remaining > 0:
+                self._per_user[user_id] = remaining
+            else:
+                self._per_user.pop(user_id, None)
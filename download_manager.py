@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the response and written out at a time
+CHUNK_SIZE = 256 * 1024
+
+# Answers worth retrying: the server is overloaded or failed, not the request
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class DownloadError(Exception):
+    """Raised when a file can't be downloaded, after any retries"""
+
+
+class _TransientError(Exception):
+    pass
+
+
+class DownloadManager:
+    """Bounded pool of streaming downloads from the Bot API file endpoint
+
+    At most max_concurrent files are fetched at once, and at most per_user
+    of one user's, so a 20-file merge downloads several files in parallel
+    without starving everyone else. Each download streams the response in
+    CHUNK_SIZE pieces straight into its output, so memory doesn't grow with
+    file size. A dropped connection, timeout or 5xx is retried up to
+    retries times with exponential backoff, asking for the rest of the file
+    with a Range request; a server that ignores it sends the whole file
+    again.
+    """
+
+    def __init__(self, max_concurrent=32, per_user=10, retries=3, backoff=0.5, timeout=60):
+        self.per_user = per_user
+        self.retries = retries
+        self.backoff = backoff
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_concurrent, max_keepalive_connections=max_concurrent)
+        )
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._user_slots = {}
+        self._active = 0
+
+    async def download(self, new_file, output, user_id=None):
+        """Stream a telegram.File into output, a binary file opened for writing; returns the bytes written"""
+        async with self._slot(user_id):
+            for attempt in range(self.retries + 1):
+                try:
+                    await self._fetch(_file_url(new_file.file_path), output)
+                    if new_file.file_size and output.tell() < new_file.file_size:
+                        raise _TransientError(f"Connection closed after {output.tell()} of {new_file.file_size} bytes")
+                    return output.tell()
+                except (httpx.TransportError, _TransientError) as e:
+                    if attempt == self.retries:
+                        raise DownloadError(f"Download failed after {attempt + 1} attempts: {str(e)}")
+                    metrics.DOWNLOAD_RETRIES.labels().inc()
+                    logger.warning(f"Download interrupted at {output.tell()} bytes, retrying: {str(e)}")
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    def active(self):
+        """Number of downloads in progress"""
+        return self._active
+
+    async def close(self):
+        await self._client.aclose()
+
+    async def _fetch(self, url, output):
+        offset = output.tell()
+        headers = {'Range': f"bytes={offset}-"} if offset else None
+        async with self._client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 416 and offset:
+                # Everything had arrived already
+                return
+            if response.status_code in RETRY_STATUSES:
+                raise _TransientError(f"Server answered {response.status_code}")
+            if response.status_code not in (200, 206):
+                raise DownloadError(f"Server answered {response.status_code}")
+            if response.status_code == 200 and offset:
+                # The server ignored the range, so take the file from the start
+                output.seek(0)
+                output.truncate()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                output.write(chunk)
+
+    @asynccontextmanager
+    async def _slot(self, user_id):
+        # A user's own limit is taken first, so their queued files don't hold global slots
+        user_slot = self._user_slots.get(user_id)
+        if user_slot is None:
+            user_slot = self._user_slots[user_id] = [asyncio.Semaphore(self.per_user), 0]
+        user_slot[1] += 1
+        try:
+            async with user_slot[0], self._slots:
+                self._active += 1
+                try:
+                    yield
+                finally:
+                    self._active -= 1
+        finally:
+            user_slot[1] -= 1
+            if not user_slot[1]:
+                del self._user_slots[user_id]
+
+
+def _file_url(file_path):
+    """Download URL of a getFile result, with non-ASCII characters in its path percent-encoded"""
+    parts = urlsplit(file_path)
+    return urlunsplit(parts._replace(path=quote(parts.path)))
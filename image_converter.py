@@ -1,31 +1,264 @@
 import os
-from PIL import Image
 import io
-from config import TEMP_DIR
-import uuid
+import hashlib
+import struct
+import config
+from pdf_profiles import get_profile, target_size
+from pdf_writer import PDFWriter
+from temp_storage import scratch_path
+
+# Page size matches PIL's PDF output at resolution=100.0
+PDF_RESOLUTION = 100.0
+
+# Baseline, extended and progressive Huffman-coded frames; PDF readers
+# don't reliably handle arithmetic-coded or lossless JPEGs
+JPEG_PASSTHROUGH_SOF_MARKERS = (0xC0, 0xC1, 0xC2)
+JPEG_COLORSPACES = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}
+
+# Bytes read from an image file to find its JPEG frame header, past any EXIF and ICC blocks
+JPEG_HEADER_BYTES = 1024 * 1024
+
+
+class ImageLimitError(Exception):
+    """Raised when an image exceeds the configured pixel limit"""
+
 
 class ImageConverter:
     @staticmethod
-    def convert_to_pdf(image_path):
+    def convert_to_pdf(image_path, profile=None):
         try:
             # Generate unique filename for the PDF
-            pdf_filename = f"{str(uuid.uuid4())}.pdf"
-            pdf_path = os.path.join(TEMP_DIR, pdf_filename)
-
-            # Open and convert image to PDF
-            image = Image.open(image_path)
+            pdf_path = scratch_path('.pdf')
 
-            # Convert image to RGB if it's in RGBA mode
-            if image.mode == 'RGBA':
-                image = image.convert('RGB')
-
-            # Save as PDF
-            image.save(pdf_path, "PDF", resolution=100.0)
+            # The image is read from its file as needed, never loaded whole
+            with open(pdf_path, 'wb') as pdf_file:
+                ImageConverter._write_pdf(image_path, pdf_file, profile)
 
             return pdf_path
+        except ImageLimitError:
+            raise
+        except Exception as e:
+            raise Exception(f"Error converting image to PDF: {str(e)}")
+
+    @staticmethod
+    def convert_bytes_to_pdf(image_data, profile=None):
+        """Convert an in-memory image to PDF bytes without touching the disk"""
+        try:
+            output = io.BytesIO()
+            ImageConverter._write_pdf(image_data, output, profile)
+            return output.getvalue()
+        except ImageLimitError:
+            raise
         except Exception as e:
             raise Exception(f"Error converting image to PDF: {str(e)}")
 
+    @staticmethod
+    def _write_pdf(data, destination, profile=None):
+        settings = get_profile(profile)
+        if settings['dpi'] or settings['compress']:
+            jpeg_data, jpeg_info = ImageConverter.prepare_page(data, profile)
+            ImageConverter.write_pages([(jpeg_data or data, jpeg_info)], destination, profile)
+            return
+
+        # JPEGs are embedded as-is, without decoding or re-encoding
+        jpeg_info = ImageConverter.read_jpeg_info(ImageConverter._read_head(data))
+        if jpeg_info:
+            writer = PDFWriter(destination)
+            ImageConverter._add_jpeg_page(writer, data, jpeg_info)
+            writer.close()
+            return
+
+        # Open and convert image to PDF
+        image = ImageConverter._open(data)
+
+        # Convert image to RGB if it's in RGBA mode
+        if image.mode == 'RGBA':
+            image = image.convert('RGB')
+
+        # Save as PDF
+        image.save(destination, "PDF", resolution=PDF_RESOLUTION)
+
+    @staticmethod
+    def prepare_page(source, profile=None):
+        """Turn an image (bytes or a file path) into a JPEG page ready for PDFWriter
+
+        Returns (jpeg_data, jpeg_info). jpeg_data is None when the source is
+        already an embeddable JPEG small enough for its page, so the caller
+        can reuse the bytes it has. Other images are decoded, downsampled to
+        the profile's DPI and re-encoded as JPEG, as PIL's PDF writer does.
+        """
+        from PIL import Image
+
+        settings = get_profile(profile)
+        jpeg_info = ImageConverter.read_jpeg_info(ImageConverter._read_head(source))
+        image = None
+        if jpeg_info:
+            width, height = jpeg_info['width'], jpeg_info['height']
+        else:
+            image = ImageConverter._open(source)
+            width, height = image.size
+        page_width, page_height = ImageConverter._page_size(width, height, settings)
+        target = target_size(width, height, page_width, page_height, settings)
+        page = {'page_width': page_width, 'page_height': page_height}
+        if jpeg_info and not target:
+            return None, dict(jpeg_info, **page)
+
+        if image is None:
+            image = ImageConverter._open(source)
+        if target:
+            # Lets the JPEG decoder scale down by up to 8x while decoding
+            image.draft('RGB', target)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        if target:
+            image = image.resize(target, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=settings['quality'])
+        jpeg_data = buffer.getvalue()
+        return jpeg_data, dict(ImageConverter.read_jpeg_info(jpeg_data), **page)
+
+    @staticmethod
+    def downsample_jpeg(data, size, quality):
+        """Re-encode JPEG data at a smaller pixel size"""
+        from PIL import Image
+
+        image = ImageConverter._open(data)
+        image.draft(image.mode, size)
+        image = image.resize(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _page_size(width, height, settings):
+        """Page size in points: the pixels at PDF_RESOLUTION, fitted into the profile's page"""
+        scale = 72.0 / PDF_RESOLUTION
+        page_width, page_height = width * scale, height * scale
+        if settings['page'] and max(page_width, page_height) > settings['page']:
+            fit = settings['page'] / max(page_width, page_height)
+            page_width, page_height = page_width * fit, page_height * fit
+        return page_width, page_height
+
+    @staticmethod
+    def _read_head(source):
+        """The first JPEG_HEADER_BYTES of an image given as bytes or a file path"""
+        if isinstance(source, str):
+            with open(source, 'rb') as image_file:
+                return image_file.read(JPEG_HEADER_BYTES)
+        return source[:JPEG_HEADER_BYTES]
+
+    @staticmethod
+    def _open(data):
+        # PIL is loaded where images are decoded, in the workers, so the bot starts without it
+        from PIL import Image
+
+        # Image.open only reads the header, so this refuses a decompression bomb before decoding it
+        image = Image.open(data if isinstance(data, str) else io.BytesIO(data))
+        if image.width * image.height > config.MAX_IMAGE_PIXELS:
+            raise ImageLimitError(f"Image is too large, the limit is {config.MAX_IMAGE_PIXELS // 1000000} megapixels")
+        return image
+
+    @staticmethod
+    def write_pages(pages, destination, profile=None):
+        """Write prepared (jpeg_data, jpeg_info) pages into one multi-page PDF; jpeg_data may be a file path"""
+        writer = PDFWriter(destination, compress=get_profile(profile)['compress'])
+        # The same photo sent twice in an album is embedded once and shown on both pages
+        images = {}
+        for jpeg_data, jpeg_info in pages:
+            ImageConverter._add_jpeg_page(writer, jpeg_data, jpeg_info, images)
+        writer.close()
+
+    @staticmethod
+    def read_jpeg_info(data):
+        """Read size and colorspace from a JPEG header without decoding it
+
+        Returns a dict with width, height, components and adobe (whether an
+        Adobe APP14 marker is present), or None if the data can't be embedded
+        in a PDF as-is.
+        """
+        if data[:2] != b'\xff\xd8':
+            return None
+
+        adobe = False
+        position = 2
+        while position + 4 <= len(data):
+            if data[position] != 0xFF:
+                return None
+            marker = data[position + 1]
+            # Fill bytes and standalone markers carry no length
+            if marker == 0xFF:
+                position += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                position += 2
+                continue
+            if marker in (0xD9, 0xDA):
+                return None
+
+            length = struct.unpack('>H', data[position + 2:position + 4])[0]
+            segment = data[position + 4:position + 2 + length]
+            if marker == 0xEE and segment[:5] == b'Adobe':
+                adobe = True
+            elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                if marker not in JPEG_PASSTHROUGH_SOF_MARKERS or len(segment) < 6:
+                    return None
+                precision = segment[0]
+                height, width = struct.unpack('>HH', segment[1:5])
+                components = segment[5]
+                if precision != 8 or not width or not height or components not in JPEG_COLORSPACES:
+                    return None
+                return {'width': width, 'height': height, 'components': components, 'adobe': adobe}
+            position += 2 + length
+        return None
+
+    @staticmethod
+    def _add_jpeg_page(writer, data, jpeg_info, images=None):
+        # images maps the digests of JPEGs already written to their image objects
+        digest = ImageConverter._digest(data) if images is not None else None
+        image = images.get(digest) if digest else None
+        if image is None:
+            # Adobe CMYK JPEGs are stored inverted
+            decode = None
+            if jpeg_info['components'] == 4 and jpeg_info['adobe']:
+                decode = [1, 0] * 4
+            image = writer.add_image(
+                data, jpeg_info['width'], jpeg_info['height'],
+                JPEG_COLORSPACES[jpeg_info['components']],
+                image_filter='/DCTDecode', decode=decode
+            )
+            if digest:
+                images[digest] = image
+
+        # Prepared pages carry their page size, otherwise it follows from the pixels
+        scale = 72.0 / PDF_RESOLUTION
+        writer.add_image_page(
+            image,
+            jpeg_info.get('page_width', jpeg_info['width'] * scale),
+            jpeg_info.get('page_height', jpeg_info['height'] * scale)
+        )
+
+    @staticmethod
+    def _digest(data):
+        # data is JPEG bytes or the path of a file holding them
+        if not isinstance(data, str):
+            return hashlib.sha1(data).digest()
+        digest = hashlib.sha1()
+        with open(data, 'rb') as data_file:
+            for chunk in iter(lambda: data_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    @staticmethod
+    def warm_up():
+        """Convert a tiny JPEG and PNG so PIL's plugins are loaded before the first real image"""
+        from PIL import Image
+
+        image = Image.new('RGB', (64, 64))
+        for image_format in ('JPEG', 'PNG'):
+            buffer = io.BytesIO()
+            image.save(buffer, image_format)
+            ImageConverter.convert_bytes_to_pdf(buffer.getvalue())
+
     @staticmethod
     def cleanup_files(file_paths):
         """Remove temporary files after processing"""
@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class MembershipCache:
+    """Bounded LRU cache of channel membership results with separate TTLs"""
+
+    def __init__(self, max_size=10000, positive_ttl=600, negative_ttl=30):
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the cached membership for a user, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            is_member, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            # Mark as recently used
+            self._entries.move_to_end(user_id)
+            return is_member
+
+    def set(self, user_id, is_member):
+        """Store a membership result, evicting the least recently used entries"""
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        with self._lock:
+            self._entries[user_id] = (is_member, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop the cached result for a user"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop all cached results"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
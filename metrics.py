@@ -0,0 +1,259 @@
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric(ABC):
+    """Base for labelled metrics rendered in the Prometheus text format"""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        """Return the child metric for one combination of label values"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            lines.extend(child.render(self.name, dict(zip(self.labelnames, key))))
+        return lines
+
+    @abstractmethod
+    def _new_child(self):
+        """A fresh value for one combination of label values"""
+
+
+class _Value:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def render(self, name, labels):
+        return [f"{name}{_format_labels(labels)} {_format_value(self._value)}"]
+
+
+class _CallbackValue:
+    def __init__(self, function):
+        self._function = function
+
+    def render(self, name, labels):
+        try:
+            value = self._function()
+        except Exception as e:
+            logger.error(f"Error collecting metric {name}: {str(e)}")
+            return []
+        return [f"{name}{_format_labels(labels)} {_format_value(value)}"]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[index] += 1
+                    break
+
+    def render(self, name, labels):
+        with self._lock:
+            counts, count, total = list(self._counts), self._count, self._sum
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            bucket_labels = dict(labels, le=_format_value(bound))
+            lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set_function(self, function, **labels):
+        """Read the gauge from function() at scrape time"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._children[key] = _CallbackValue(function)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+
+REGISTRY = []
+
+REQUEST_SECONDS = Histogram('bot_request_seconds', "End-to-end handler latency", ['handler'])
+STAGE_SECONDS = Histogram('bot_stage_seconds', "Latency of each stage of a handler", ['handler', 'stage'])
+REQUESTS = Counter('bot_requests_total', "Handled requests", ['handler', 'outcome'])
+BYTES_IN = Counter('bot_bytes_in_total', "Bytes downloaded from Telegram", ['handler'])
+BYTES_OUT = Counter('bot_bytes_out_total', "Bytes uploaded to Telegram", ['handler'])
+CACHE_REQUESTS = Counter('bot_cache_requests_total', "Cache lookups", ['cache', 'result'])
+QUEUE_DEPTH = Gauge('bot_conversion_queue_depth', "Conversion jobs queued or running")
+HEAVY_QUEUE_DEPTH = Gauge('bot_heavy_conversion_queue_depth', "Heavy-lane conversion jobs queued or running")
+ADMISSION_REJECTIONS = Counter('bot_admission_rejections_total', "Inputs refused before download or decode", ['reason'])
+SEND_QUEUE_DEPTH = Gauge('bot_send_queue_depth', "Outgoing messages waiting for a flood-limit token")
+FLOOD_WAITS = Counter('bot_flood_waits_total', "Bot API calls answered with 429 Too Many Requests", ['method'])
+DROPPED_STATUS_MESSAGES = Counter('bot_dropped_status_messages_total', "Status messages dropped because the result went out first")
+TEMP_BYTES = Gauge('bot_temp_bytes', "Temp storage reserved by requests, on disk outside them, and free on the filesystem", ['kind'])
+TEMP_REJECTIONS = Counter('bot_temp_rejections_total', "Temp allocations refused because the disk budget was used up")
+TEMP_EVICTIONS = Counter('bot_temp_evictions_total', "Temp files deleted by the janitor or to make room", ['reason'])
+ACTIVE_DOWNLOADS = Gauge('bot_active_downloads', "Files being downloaded from the Bot API")
+DOWNLOAD_RETRIES = Counter('bot_download_retries_total', "Downloads resumed after a transient failure")
+LANE_WAIT_SECONDS = Histogram('bot_lane_wait_seconds', "Time conversion jobs waited in their lane for a worker", ['lane'])
+LANE_DEADLINE_MISSES = Counter('bot_lane_deadline_misses_total', "Queued jobs cancelled after their lane's deadline", ['lane'])
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestTrace:
+    """Per-request stage timer feeding the latency histograms
+
+    Requests slower than slow_threshold seconds (if set) are logged with
+    their per-stage breakdown.
+    """
+
+    slow_threshold = 0
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.stages = []
+        self._finished = False
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        self.stages.append((name, seconds))
+        STAGE_SECONDS.labels(handler=self.handler, stage=name).observe(seconds)
+
+    def add_bytes_in(self, count):
+        BYTES_IN.labels(handler=self.handler).inc(count or 0)
+
+    def add_bytes_out(self, count):
+        BYTES_OUT.labels(handler=self.handler).inc(count or 0)
+
+    def finish(self, outcome='ok'):
+        """Record the end-to-end latency; only the first call counts"""
+        if self._finished:
+            return
+        self._finished = True
+
+        total = time.perf_counter() - self.started
+        REQUEST_SECONDS.labels(handler=self.handler).observe(total)
+        REQUESTS.labels(handler=self.handler, outcome=outcome).inc()
+        if self.slow_threshold and total >= self.slow_threshold:
+            breakdown = ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.stages)
+            logger.warning(f"Slow request in {self.handler}: {total * 1000:.0f}ms ({breakdown})")
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port):
+    """Serve /metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logger.info(f"Metrics available at http://{host}:{server.server_port}/metrics")
+    return server
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
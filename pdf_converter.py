@@ -0,0 +1,345 @@
+import csv
+import io
+import os
+import time
+import config
+from pdf_profiles import get_profile
+from pdf_writer import PDFWriter
+from temp_storage import merge_path, scratch_path
+
+# Pages extracted by one worker job; bigger chunks amortize re-opening the PDF
+PAGES_PER_CHUNK = 16
+
+
+class PDFLimitError(Exception):
+    """Raised when a PDF exceeds the configured page or time limits"""
+
+
+class MergeLostError(Exception):
+    """Raised when a merge session's output is missing from TEMP_DIR"""
+
+
+class PDFConverter:
+    @staticmethod
+    def pdf_to_text(pdf_path, max_pages=None, timeout=None):
+        """Extract text chunk by chunk in this process, streaming it to a .txt file in page order
+
+        The bot spreads the chunks over its worker pool with text_chunks()
+        and extract_text_chunk() instead.
+        """
+        max_pages = max_pages or config.MAX_PDF_PAGES
+        timeout = timeout or config.PDF_TEXT_TIMEOUT
+
+        text_path = scratch_path('.txt')
+        try:
+            page_count = PDFConverter._count_pages(pdf_path, max_pages)
+            deadline = time.time() + timeout
+            with open(text_path, 'w', encoding='utf-8') as text_file:
+                for start, end in PDFConverter.text_chunks(page_count):
+                    text_file.write(PDFConverter.extract_text_chunk(pdf_path, start, end, deadline, timeout))
+
+            return text_path
+        except PDFLimitError:
+            PDFConverter.cleanup_files([text_path])
+            raise
+        except Exception as e:
+            PDFConverter.cleanup_files([text_path])
+            raise Exception(f"Error converting PDF to text: {str(e)}")
+
+    @staticmethod
+    def text_chunks(page_count):
+        """Split a PDF's pages into [start, end) ranges of PAGES_PER_CHUNK pages"""
+        return [(start, min(start + PAGES_PER_CHUNK, page_count))
+                for start in range(0, page_count, PAGES_PER_CHUNK)]
+
+    @staticmethod
+    def extract_text_chunk(pdf_path, start, end, deadline=None, timeout=None):
+        """Extract the text of pages [start, end), one line break after each page
+
+        deadline is a time.time() value, since it is checked in another
+        process; once it passes, PDFLimitError is raised between pages.
+        """
+        # pypdf is loaded where PDFs are parsed, in the workers, so the bot starts without it
+        from pypdf import PdfReader
+
+        texts = []
+        with open(pdf_path, 'rb') as pdf_file:
+            reader = PdfReader(pdf_file)
+            for page_number in range(start, end):
+                if deadline:
+                    PDFConverter._check_deadline(deadline, timeout)
+                texts.append((reader.pages[page_number].extract_text() or "") + "\n")
+        return "".join(texts)
+
+    @staticmethod
+    def pdf_to_csv(pdf_path, max_pages=None):
+        """Extract tables page by page, appending rows to a .csv file as each page is done
+
+        All pages go to one CSV so tables spanning pages stay contiguous, and
+        a header row repeated on a continuation page is skipped.
+        """
+        max_pages = max_pages or config.MAX_PDF_PAGES
+
+        # Loaded on first use: only table extraction needs pdfplumber, and it's slow to import
+        import pdfplumber
+
+        csv_path = scratch_path('.csv')
+        try:
+            with pdfplumber.open(pdf_path) as pdf, open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+                if len(pdf.pages) > max_pages:
+                    raise PDFLimitError(f"PDF has {len(pdf.pages)} pages, the limit is {max_pages}")
+
+                writer = csv.writer(csv_file)
+                header = None
+                for page in pdf.pages:
+                    rows = _cluster_table(page.extract_words())
+                    # Drop cached layout objects so memory stays flat across pages
+                    page.flush_cache()
+                    if not rows:
+                        continue
+
+                    # The header is the first row that fills more than one column
+                    header_index = next(
+                        (index for index, row in enumerate(rows) if sum(1 for cell in row if cell) > 1), None
+                    )
+                    if header_index is not None:
+                        if rows[header_index] == header:
+                            del rows[header_index]
+                        else:
+                            header = rows[header_index]
+                    writer.writerows(rows)
+
+            return csv_path
+        except PDFLimitError:
+            PDFConverter.cleanup_files([csv_path])
+            raise
+        except Exception as e:
+            PDFConverter.cleanup_files([csv_path])
+            raise Exception(f"Error converting PDF to CSV: {str(e)}")
+
+    @staticmethod
+    def merge_pdfs(pdf_paths):
+        """Merge PDFs in order into a single file"""
+        session = PDFMergeSession()
+        try:
+            for pdf_path in pdf_paths:
+                session.add(pdf_path)
+            return session.finalize()
+        except PDFLimitError:
+            session.discard()
+            raise
+        except Exception as e:
+            session.discard()
+            raise Exception(f"Error merging PDFs: {str(e)}")
+
+    @staticmethod
+    def cleanup_files(file_paths):
+        """Remove temporary files after processing"""
+        for file_path in file_paths:
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            except Exception:
+                pass
+
+    @staticmethod
+    def warm_up():
+        """Extract text and a table from a one-page PDF, loading pypdf, pdfplumber, numpy and font metrics"""
+        import pdfplumber
+        from pypdf import PdfReader
+
+        output = io.BytesIO()
+        writer = PDFWriter(output)
+        writer.add_text_page([(72, 720, "Name Amount"), (72, 700, "Warm 1")])
+        writer.close()
+        output.seek(0)
+        PdfReader(output).pages[0].extract_text()
+        output.seek(0)
+        with pdfplumber.open(output) as pdf:
+            _cluster_table(pdf.pages[0].extract_words())
+
+    @staticmethod
+    def _count_pages(pdf_path, max_pages):
+        from pypdf import PdfReader
+
+        with open(pdf_path, 'rb') as pdf_file:
+            page_count = len(PdfReader(pdf_file).pages)
+        if page_count > max_pages:
+            raise PDFLimitError(f"PDF has {page_count} pages, the limit is {max_pages}")
+        return page_count
+
+    @staticmethod
+    def _check_deadline(deadline, timeout):
+        if time.time() > deadline:
+            raise PDFLimitError(f"PDF took longer than {timeout} seconds to convert")
+
+
+class PDFMergeSession:
+    """Merge PDFs incrementally as they arrive
+
+    Each add() copies the source's pages straight into the output file, so
+    sources can be deleted right after. Objects with identical content
+    (fonts, images shared between sources) are written once, and the
+    output profile may compress streams and downsample large JPEG images.
+    finalize() only writes the page tree and xref.
+
+    state() captures the session between calls, so another process with
+    access to output_path can continue it with PDFMergeSession(state=...).
+    """
+
+    def __init__(self, output_path=None, max_pages=None, max_bytes=None, state=None, profile=None):
+        if state:
+            # Continue a merge saved by an earlier session object
+            self.output_path = state['output_path']
+            self.profile = state.get('profile')
+            self.max_pages = state['max_pages']
+            self.max_bytes = state['max_bytes']
+            self.file_count = state['file_count']
+            self.byte_count = state['byte_count']
+            self._digests = {bytes.fromhex(digest): number for digest, number in state['digests'].items()}
+            self._state = state['writer']
+        else:
+            self.output_path = output_path or merge_path()
+            self.profile = profile
+            self.max_pages = max_pages or config.MERGE_MAX_PAGES
+            self.max_bytes = max_bytes or config.MERGE_MAX_BYTES
+            self.file_count = 0
+            self.byte_count = 0
+            self._digests = {}
+            with open(self.output_path, 'wb') as output:
+                writer = PDFWriter(output, version='1.7', compress=get_profile(profile)['compress'])
+                self._state = writer.state()
+
+    @property
+    def page_count(self):
+        return len(self._state['pages'])
+
+    def state(self):
+        """Everything needed to resume the merge with PDFMergeSession(state=...), JSON-serializable"""
+        return {
+            'output_path': self.output_path,
+            'profile': self.profile,
+            'max_pages': self.max_pages,
+            'max_bytes': self.max_bytes,
+            'file_count': self.file_count,
+            'byte_count': self.byte_count,
+            'digests': {digest.hex(): number for digest, number in self._digests.items()},
+            'writer': self._state,
+        }
+
+    def add(self, pdf_path):
+        """Append every page of pdf_path; returns the number of pages added"""
+        # Loaded on first use: the bot process only creates, saves and finalizes merges
+        from pypdf import PdfReader
+        from pdf_copier import ObjectCopier
+
+        size = os.path.getsize(pdf_path)
+        if self.byte_count + size > self.max_bytes:
+            raise PDFLimitError(f"Merged files would exceed {self.max_bytes // (1024 * 1024)}MB")
+
+        # Reading from the open file keeps only the objects being copied in memory
+        with open(pdf_path, 'rb') as pdf_file, open(self.output_path, 'r+b') as output:
+            reader = PdfReader(pdf_file)
+            if reader.is_encrypted:
+                reader.decrypt("")
+            page_count = len(reader.pages)
+            if self.page_count + page_count > self.max_pages:
+                raise PDFLimitError(f"Merged PDF would exceed {self.max_pages} pages")
+
+            # Work on copies so a failure halfway leaves the session as it was;
+            # the next add() simply overwrites the partial objects
+            digests = dict(self._digests)
+            output.seek(self._state['position'])
+            writer = PDFWriter(output, state=self._state)
+            copier = ObjectCopier(writer, digests, get_profile(self.profile))
+            for page in reader.pages:
+                writer.add_page(copier.copy_reference(page.indirect_reference, page))
+            state = writer.state()
+
+        self._state = state
+        self._digests = digests
+
+        self.file_count += 1
+        self.byte_count += size
+        return page_count
+
+    @staticmethod
+    def add_to_state(state, pdf_path):
+        """Append pdf_path to the merge saved in state and return its new state, e.g. from a worker process"""
+        session = PDFMergeSession(state=state)
+        session.add(pdf_path)
+        return session.state()
+
+    def finalize(self):
+        """Write the page tree and xref, returning the merged file's path"""
+        with open(self.output_path, 'r+b') as output:
+            output.seek(self._state['position'])
+            PDFWriter(output, state=self._state).close()
+            output.truncate()
+        return self.output_path
+
+    def discard(self):
+        """Delete the partial output"""
+        PDFConverter.cleanup_files([self.output_path])
+
+
+def _cluster_table(words):
+    """Group word boxes into a grid of cell strings using array operations
+
+    Words are clustered into rows by their top edge, joined into cells
+    where the horizontal gap is small, and cells are assigned to columns
+    by gaps in the x coverage of rows that have more than one cell.
+    """
+    if not words:
+        return []
+    import numpy as np
+
+    x0 = np.fromiter((word['x0'] for word in words), dtype=float, count=len(words))
+    x1 = np.fromiter((word['x1'] for word in words), dtype=float, count=len(words))
+    top = np.fromiter((word['top'] for word in words), dtype=float, count=len(words))
+    bottom = np.fromiter((word['bottom'] for word in words), dtype=float, count=len(words))
+    lengths = np.fromiter((len(word['text']) for word in words), dtype=float, count=len(words))
+
+    # Rows: a new row starts wherever the sorted top edges jump by more than
+    # half a line height
+    row_tolerance = max(float(np.median(bottom - top)) * 0.5, 1.0)
+    by_top = np.argsort(top, kind='stable')
+    row_starts = np.concatenate(([0], np.diff(top[by_top]) > row_tolerance))
+    rows = np.empty(len(words), dtype=np.int64)
+    rows[by_top] = np.cumsum(row_starts)
+
+    # Cells: words in the same row closer than ~1.5 characters belong together
+    char_width = float(np.median((x1 - x0) / np.maximum(lengths, 1)))
+    cell_gap = max(char_width * 1.5, 2.0)
+    order = np.lexsort((x0, rows))
+    sorted_rows = rows[order]
+    new_cell = np.ones(len(words), dtype=bool)
+    new_cell[1:] = (sorted_rows[1:] != sorted_rows[:-1]) | (x0[order][1:] - x1[order][:-1] > cell_gap)
+    cell_starts = np.flatnonzero(new_cell)
+    cell_x0 = np.minimum.reduceat(x0[order], cell_starts)
+    cell_x1 = np.maximum.reduceat(x1[order], cell_starts)
+    cell_rows = sorted_rows[cell_starts]
+
+    # Columns: gaps in the x coverage of multi-cell rows; single-cell rows
+    # such as titles would otherwise bridge every column
+    cells_per_row = np.bincount(cell_rows)
+    tabular = cells_per_row[cell_rows] >= 2
+    if tabular.any():
+        by_x = np.argsort(cell_x0[tabular])
+        starts = cell_x0[tabular][by_x]
+        reach = np.maximum.accumulate(cell_x1[tabular][by_x])
+        boundaries = starts[1:][starts[1:] > reach[:-1]]
+    else:
+        boundaries = np.empty(0)
+    cell_columns = np.searchsorted(boundaries, (cell_x0 + cell_x1) / 2, side='right')
+
+    # Only the final string joins are per cell, not per character
+    texts = [words[index]['text'] for index in order]
+    cell_ends = np.append(cell_starts[1:], len(words))
+    row_numbers, row_index = np.unique(cell_rows, return_inverse=True)
+    grid = [[""] * (len(boundaries) + 1) for _ in range(len(row_numbers))]
+    for cell, (start, end) in enumerate(zip(cell_starts, cell_ends)):
+        text = " ".join(texts[start:end])
+        row, column = row_index[cell], cell_columns[cell]
+        grid[row][column] = f"{grid[row][column]} {text}" if grid[row][column] else text
+    return grid
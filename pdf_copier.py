@@ -0,0 +1,136 @@
+import hashlib
+import io
+import zlib
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+from image_converter import ImageConverter
+from pdf_profiles import target_size
+from pdf_writer import PDFWriter
+
+
+class ObjectCopier:
+    """Copy objects reachable from a source page into a PDFWriter, renumbering references"""
+
+    def __init__(self, writer, digests, profile):
+        self._writer = writer
+        self._digests = digests
+        self._profile = profile
+        self._page_size = None
+        self._numbers = {}
+        self._in_progress = set()
+        self._cyclic = set()
+
+    def copy_reference(self, reference, source=None):
+        key = (reference.idnum, reference.generation)
+        if key in self._numbers:
+            if key in self._in_progress:
+                self._cyclic.add(key)
+            return self._numbers[key]
+
+        number = self._writer.reserve()
+        self._numbers[key] = number
+        self._in_progress.add(key)
+        if source is None:
+            source = reference.get_object()
+        is_page = isinstance(source, DictionaryObject) and source.get('/Type') == '/Page'
+        outer_page_size = self._page_size
+        if is_page:
+            self._page_size = page_size(source)
+        body = self._serialize(source, is_page)
+        self._page_size = outer_page_size
+        self._in_progress.discard(key)
+
+        # Content-identical objects are written once; objects on a reference
+        # cycle keep their own number since something already points at it
+        if not is_page and key not in self._cyclic:
+            digest = hashlib.sha1(body).digest()
+            existing = self._digests.get(digest)
+            if existing is not None:
+                self._numbers[key] = existing
+                return existing
+            self._digests[digest] = number
+
+        self._writer.write_object(number, body, is_stream=isinstance(source, StreamObject))
+        return number
+
+    def _serialize(self, source, is_page):
+        buffer = io.BytesIO()
+        if isinstance(source, StreamObject):
+            header = DictionaryObject()
+            for name, value in source.items():
+                if name != '/Length':
+                    header[NameObject(name)] = self._copy(value)
+            # Raw (still encoded) bytes, copied as-is like pypdf's own clone()
+            data = source._data
+            if self._writer.compress and '/Filter' not in header:
+                data = zlib.compress(data)
+                header[NameObject('/Filter')] = NameObject('/FlateDecode')
+            elif self._page_size:
+                data = self._downsample(header, data)
+            header[NameObject('/Length')] = NumberObject(len(data))
+            header.write_to_stream(buffer)
+            buffer.write(b"\nstream\n")
+            buffer.write(data)
+            buffer.write(b"\nendstream")
+        elif is_page:
+            page = DictionaryObject()
+            for name, value in source.items():
+                # Article beads would drag in the source's whole thread structure
+                if name not in ('/Parent', '/B'):
+                    page[NameObject(name)] = self._copy(value)
+            page[NameObject('/Parent')] = IndirectObject(PDFWriter.PAGES, 0, None)
+            page.write_to_stream(buffer)
+        else:
+            self._copy(source).write_to_stream(buffer)
+        return buffer.getvalue()
+
+    def _downsample(self, header, data):
+        """Re-encode a JPEG image at the profile's DPI for the page it's on, updating header
+
+        Assumes the image covers at most its whole page, so an image drawn
+        smaller keeps more pixels than it needs, never fewer.
+        """
+        if (header.get('/Subtype') != '/Image' or header.get('/Filter') not in ('/DCTDecode', ['/DCTDecode']) or
+                header.get('/ColorSpace') not in ('/DeviceRGB', '/DeviceGray') or
+                header.get('/BitsPerComponent') != 8 or
+                any(name in header for name in ('/SMask', '/Mask', '/Decode', '/DecodeParms'))):
+            return data
+        width, height = header.get('/Width'), header.get('/Height')
+        if not isinstance(width, int) or not isinstance(height, int):
+            return data
+        target = target_size(width, height, *self._page_size, self._profile)
+        if not target:
+            return data
+
+        try:
+            smaller = ImageConverter.downsample_jpeg(data, target, self._profile['quality'])
+        except Exception:
+            # Leave an image we can't decode as it was
+            return data
+        if len(smaller) >= len(data):
+            return data
+        header[NameObject('/Width')] = NumberObject(target[0])
+        header[NameObject('/Height')] = NumberObject(target[1])
+        return smaller
+
+    def _copy(self, value):
+        if isinstance(value, IndirectObject):
+            return IndirectObject(self.copy_reference(value), 0, None)
+        if isinstance(value, DictionaryObject):
+            copied = DictionaryObject()
+            for name, item in value.items():
+                copied[NameObject(name)] = self._copy(item)
+            return copied
+        if isinstance(value, ArrayObject):
+            return ArrayObject(self._copy(item) for item in value)
+        return value
+
+
+def page_size(page):
+    """Width and height of a page's MediaBox in points, or None if it can't be read"""
+    try:
+        left, bottom, right, top = (float(value) for value in page['/MediaBox'])
+        return abs(right - left), abs(top - bottom)
+    except Exception:
+        return None
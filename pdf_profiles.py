@@ -0,0 +1,28 @@
+import config
+
+# Size-versus-quality settings for the PDFs we generate:
+#   page     longest page side in points that image pages are fitted into,
+#            None sizes pages from the pixels at 100 DPI
+#   dpi      resolution images are downsampled to for their page, None keeps them
+#   quality  JPEG quality of re-encoded images
+#   compress Flate-compress streams and pack objects into object streams
+PROFILES = {
+    'original': {'page': None, 'dpi': None, 'quality': 75, 'compress': False},
+    'balanced': {'page': 842, 'dpi': 150, 'quality': 75, 'compress': True},
+    'small': {'page': 842, 'dpi': 96, 'quality': 60, 'compress': True},
+}
+
+
+def get_profile(name=None):
+    """Settings of the named profile, falling back to PDF_PROFILE"""
+    return PROFILES.get(name) or PROFILES[config.PDF_PROFILE]
+
+
+def target_size(width, height, page_width, page_height, profile):
+    """Pixel size to downsample an image shown on a page to, or None if it is small enough already"""
+    if not profile['dpi']:
+        return None
+    scale = max(page_width, page_height) / 72.0 * profile['dpi'] / max(width, height)
+    if scale >= 1:
+        return None
+    return max(1, round(width * scale)), max(1, round(height * scale))
@@ -0,0 +1,229 @@
+import os
+import zlib
+
+# Objects packed into one compressed object stream
+OBJECT_STREAM_SIZE = 100
+
+# Bytes read at a time when stream data comes from a file
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PDFWriter:
+    """Minimal streaming PDF writer: objects go straight to the output, the xref is written on close
+
+    With compress=True, content streams are Flate-compressed and other
+    objects are packed into compressed object streams, with an xref
+    stream instead of an xref table (PDF 1.5).
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, output, version='1.4', state=None, compress=False):
+        self._output = output
+        self._font = None
+        self._pending = []
+        if state:
+            # Continue a document written by an earlier writer on the same file
+            self._position = state['position']
+            self._offsets = {int(number): offset for number, offset in state['offsets'].items()}
+            self._pages = list(state['pages'])
+            self._next_number = state['next_number']
+            self.compress = state.get('compress', False)
+        else:
+            self._position = 0
+            self._offsets = {}
+            self._pages = []
+            self._next_number = 3
+            self.compress = compress
+            if compress:
+                version = max(version, '1.5')
+            self._write(f"%PDF-{version}\n%".encode() + b"\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def state(self):
+        """Everything needed to resume writing with PDFWriter(output, state=...) later"""
+        self._flush_objects()
+        return {
+            'position': self._position,
+            'offsets': dict(self._offsets),
+            'pages': list(self._pages),
+            'next_number': self._next_number,
+            'compress': self.compress,
+        }
+
+    def reserve(self):
+        """Allocate an object number to be written later"""
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def write_object(self, number, body, is_stream=False):
+        """Write a serialized object; body is everything between 'obj' and 'endobj'
+
+        Streams can't go into an object stream, so say when body is one.
+        """
+        if self.compress and not is_stream:
+            self._pending.append((number, body))
+            if len(self._pending) >= OBJECT_STREAM_SIZE:
+                self._flush_objects()
+            return
+        self._offsets[number] = self._position
+        self._write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    def add_page(self, number):
+        """Append an already written page object, whose /Parent must be PAGES"""
+        self._pages.append(number)
+
+    def add_image(self, data, width, height, colorspace, bits_per_component=8, image_filter=None, decode=None):
+        """Write an image XObject and return its object number, for add_image_page() to show
+
+        data must already be encoded with image_filter (e.g. /DCTDecode for JPEG,
+        /FlateDecode for zlib-compressed raw samples); it may also be the path
+        of a file holding it, which is copied in chunks.
+        """
+        image = self.reserve()
+        entries = [
+            "/Type /XObject", "/Subtype /Image",
+            f"/Width {width}", f"/Height {height}",
+            f"/ColorSpace {colorspace}", f"/BitsPerComponent {bits_per_component}"
+        ]
+        if image_filter:
+            entries.append(f"/Filter {image_filter}")
+        if decode:
+            entries.append(f"/Decode [{' '.join(str(value) for value in decode)}]")
+        self._write_stream(image, " ".join(entries), data)
+        return image
+
+    def add_image_page(self, image, page_width, page_height):
+        """Add a page showing an image written by add_image() that fills it; several pages may show the same image"""
+        content = self.reserve()
+        drawing = f"q {_number(page_width)} 0 0 {_number(page_height)} 0 0 cm /Im0 Do Q".encode()
+        self._write_content(content, drawing)
+
+        page = self.reserve()
+        self.write_object(page, (
+            f"<< /Type /Page /Parent {self.PAGES} 0 R "
+            f"/MediaBox [0 0 {_number(page_width)} {_number(page_height)}] "
+            f"/Resources << /XObject << /Im0 {image} 0 R >> >> "
+            f"/Contents {content} 0 R >>"
+        ).encode())
+        self._pages.append(page)
+        return page
+
+    def add_text_page(self, lines, page_width=612, page_height=792, font_size=10):
+        """Add a page of Helvetica text; lines is a list of (x, y, text) in points"""
+        if self._font is None:
+            self._font = self.reserve()
+            self.write_object(self._font, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+        operations = ["BT", f"/F1 {_number(font_size)} Tf"]
+        for x, y, text in lines:
+            operations.append(f"1 0 0 1 {_number(x)} {_number(y)} Tm ({_escape(text)}) Tj")
+        operations.append("ET")
+
+        content = self.reserve()
+        self._write_content(content, "\n".join(operations).encode('latin-1', 'replace'))
+
+        page = self.reserve()
+        self.write_object(page, (
+            f"<< /Type /Page /Parent {self.PAGES} 0 R "
+            f"/MediaBox [0 0 {_number(page_width)} {_number(page_height)}] "
+            f"/Resources << /Font << /F1 {self._font} 0 R >> >> "
+            f"/Contents {content} 0 R >>"
+        ).encode())
+        self._pages.append(page)
+        return page
+
+    def close(self):
+        """Write the page tree, catalog, xref and trailer"""
+        kids = " ".join(f"{page} 0 R" for page in self._pages)
+        self.write_object(self.PAGES, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>".encode())
+        self.write_object(self.CATALOG, f"<< /Type /Catalog /Pages {self.PAGES} 0 R >>".encode())
+        if self.compress:
+            self._flush_objects()
+            self._write_xref_stream()
+            return
+
+        xref_position = self._position
+        lines = [f"xref\n0 {self._next_number}\n", "0000000000 65535 f \n"]
+        for number in range(1, self._next_number):
+            if number in self._offsets:
+                lines.append(f"{self._offsets[number]:010d} 00000 n \n")
+            else:
+                lines.append("0000000000 00000 f \n")
+        lines.append(f"trailer\n<< /Size {self._next_number} /Root {self.CATALOG} 0 R >>\n")
+        lines.append(f"startxref\n{xref_position}\n%%EOF\n")
+        self._write("".join(lines).encode())
+
+    def _write_content(self, number, data):
+        if self.compress:
+            self._write_stream(number, "/Filter /FlateDecode", zlib.compress(data))
+        else:
+            self._write_stream(number, "", data)
+
+    def _flush_objects(self):
+        """Write the pending objects as one compressed object stream"""
+        if not self._pending:
+            return
+        stream = self.reserve()
+        header = []
+        offset = 0
+        for index, (number, body) in enumerate(self._pending):
+            header.append(f"{number} {offset}")
+            # Each object is followed by a newline
+            offset += len(body) + 1
+            self._offsets[number] = [stream, index]
+        first = " ".join(header).encode() + b"\n"
+        data = first + b"\n".join(body for _, body in self._pending)
+        entries = f"/Type /ObjStm /N {len(self._pending)} /First {len(first)} /Filter /FlateDecode"
+        self._pending = []
+        self._write_stream(stream, entries, zlib.compress(data))
+
+    def _write_xref_stream(self):
+        xref = self.reserve()
+        xref_position = self._position
+        self._offsets[xref] = xref_position
+        # Entries are (type, offset or object stream, generation or index) in 1 + 4 + 2 bytes
+        rows = [b"\x00\x00\x00\x00\x00\xff\xff"]
+        for number in range(1, self._next_number):
+            location = self._offsets.get(number)
+            if location is None:
+                rows.append(b"\x00" * 7)
+            elif isinstance(location, list):
+                rows.append(b"\x02" + location[0].to_bytes(4, 'big') + location[1].to_bytes(2, 'big'))
+            else:
+                rows.append(b"\x01" + location.to_bytes(4, 'big') + b"\x00\x00")
+        entries = f"/Type /XRef /Size {self._next_number} /W [1 4 2] /Root {self.CATALOG} 0 R /Filter /FlateDecode"
+        self._write_stream(xref, entries, zlib.compress(b"".join(rows)))
+        self._write(f"startxref\n{xref_position}\n%%EOF\n".encode())
+
+    def _write_stream(self, number, entries, data):
+        self._offsets[number] = self._position
+        length = os.path.getsize(data) if isinstance(data, str) else len(data)
+        entries = f"{entries} /Length {length}" if entries else f"/Length {length}"
+        self._write(f"{number} 0 obj\n<< {entries} >>\nstream\n".encode())
+        if isinstance(data, str):
+            with open(data, 'rb') as data_file:
+                for chunk in iter(lambda: data_file.read(COPY_CHUNK_SIZE), b''):
+                    self._write(chunk)
+        else:
+            self._write(data)
+        self._write(b"\nendstream\nendobj\n")
+
+    def _write(self, data):
+        self._output.write(data)
+        self._position += len(data)
+
+
+def _escape(text):
+    """Escape a string for use in a PDF literal string"""
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def _number(value):
+    """Format a PDF number without a trailing .0 or float noise"""
+    return f"{value:.4f}".rstrip('0').rstrip('.')
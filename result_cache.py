@@ -0,0 +1,117 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """Persistent LRU/TTL cache mapping a source file + operation to the file_id we already sent
+
+    get() only reads, so a hit never waits on a disk write: the new
+    last_used times are kept in memory and written by the next set(),
+    flush() or close(). Expired entries are deleted by set() as well.
+    The number of rows is kept in memory too, so eviction never counts
+    the table.
+    """
+
+    def __init__(self, db_path, max_entries=50000, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+        self._connection.commit()
+        self._count = self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @staticmethod
+    def make_key(file_unique_id, operation, **params):
+        """Build a cache key from the source file, the operation and its parameters"""
+        parts = [file_unique_id, operation]
+        parts.extend(f"{name}={params[name]}" for name in sorted(params))
+        return ":".join(parts)
+
+    def get(self, key):
+        """Return the cached output file_id, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT file_id, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            file_id, created_at = row
+            if created_at + self.ttl <= now:
+                return None
+
+            self._touched[key] = now
+            return file_id
+
+    def set(self, key, file_id):
+        """Remember the output file_id for a key, evicting the least recently used entries"""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE results SET file_id = ?, created_at = ?, last_used = ? WHERE key = ?",
+                (file_id, now, now, key)
+            )
+            if cursor.rowcount == 0:
+                self._connection.execute(
+                    "INSERT INTO results (key, file_id, created_at, last_used) VALUES (?, ?, ?, ?)",
+                    (key, file_id, now, now)
+                )
+                self._count += 1
+            self._touched.pop(key, None)
+            self._write_touched()
+            self._evict(now)
+            self._connection.commit()
+
+    def flush(self):
+        """Write the last_used times of recent hits"""
+        with self._lock:
+            if self._touched:
+                self._write_touched()
+                self._connection.commit()
+
+    def invalidate(self, key):
+        """Forget a cached result, e.g. when Telegram no longer accepts its file_id"""
+        with self._lock:
+            self._touched.pop(key, None)
+            cursor = self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._count -= cursor.rowcount
+            self._connection.commit()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+    def _write_touched(self):
+        self._connection.executemany(
+            "UPDATE results SET last_used = ? WHERE key = ?",
+            [(last_used, key) for key, last_used in self._touched.items()]
+        )
+        self._touched = {}
+
+    def _evict(self, now):
+        cursor = self._connection.execute("DELETE FROM results WHERE created_at <= ?", (now - self.ttl,))
+        self._count -= cursor.rowcount
+        if self._count > self.max_entries:
+            cursor = self._connection.execute(
+                "DELETE FROM results WHERE key IN ("
+                " SELECT key FROM results ORDER BY last_used ASC LIMIT ?)",
+                (self._count - self.max_entries,)
+            )
+            self._count -= cursor.rowcount
@@ -0,0 +1,257 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower values go out first when the buckets are short of tokens
+RESULT_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+STATUS_PRIORITY = 2
+
+# Methods that post into a chat and count against Telegram's flood limits
+LIMITED_METHODS = ('send', 'edit', 'copy', 'forward')
+
+
+class Grant:
+    """Flag set by the scheduler the moment a request is let through"""
+
+    __slots__ = ('granted',)
+
+    def __init__(self):
+        self.granted = False
+
+
+class _TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until the next token is available"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class SendScheduler(BaseRateLimiter):
+    """Rate limiter for outgoing Bot API calls that stays under Telegram's flood limits
+
+    Messages need a token from a global bucket and from their chat's
+    bucket (groups and channels refill slower than private chats). While
+    tokens are short, waiting requests go out by priority: result
+    documents first, plain replies next, status messages last. A 429
+    pauses every request for its retry_after, then the call is retried.
+    """
+
+    def __init__(self, overall_rate=30, chat_rate=1, group_rate=20 / 60, chat_burst=3, max_retries=3,
+                 max_chat_buckets=10000):
+        self._overall = _TokenBucket(overall_rate, max(1, overall_rate))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._chats = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+
+    async def initialize(self):
+        # The Application and its Updater both initialize the bot
+        if self._task:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, _, _, future, _ in self._waiting:
+            future.cancel()
+        self._waiting = []
+
+    def queue_depth(self):
+        """Number of requests waiting for a token"""
+        return len(self._waiting)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        rate_limit_args = rate_limit_args or {}
+        limited = endpoint.startswith(LIMITED_METHODS)
+        default_priority = RESULT_PRIORITY if endpoint == 'sendDocument' else DEFAULT_PRIORITY
+        priority = rate_limit_args.get('priority', default_priority)
+        grant = rate_limit_args.get('grant')
+
+        attempt = 0
+        while True:
+            if limited:
+                await self._acquire(data.get('chat_id'), priority, grant)
+            else:
+                await self._wait_for_pause()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.FLOOD_WAITS.labels(method=endpoint).inc()
+                retry_after = _seconds(e.retry_after)
+                logger.warning(f"Flood limit hit on {endpoint}, pausing sends for {retry_after}s")
+                self._pause(retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+    async def _acquire(self, chat_id, priority, grant):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((priority, next(self._sequence), chat_id, future, grant))
+        self._wakeup.set()
+        # A cancelled waiter leaves a cancelled future behind, which _grant() skips
+        await future
+
+    async def _wait_for_pause(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Start from an empty bucket afterwards, or the backlog bursts into the limit again
+        self._overall.tokens = 0
+        self._overall.updated = self._paused_until
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant()
+            if delay is None:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant(self):
+        """Let through every request that has tokens; returns seconds until the next try, None if idle"""
+        if not self._waiting:
+            return None
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self._overall.refill(now)
+        delay = None
+        remaining = []
+        # Sorting by (priority, sequence) keeps FIFO order within a priority
+        for entry in sorted(self._waiting, key=lambda entry: entry[:2]):
+            future, grant = entry[3], entry[4]
+            if future.done():
+                continue
+            if self._overall.tokens < 1:
+                delay = self._overall.wait_time()
+                remaining.append(entry)
+                continue
+
+            bucket = self._chat_bucket(entry[2], now)
+            if bucket is not None and bucket.tokens < 1:
+                delay = bucket.wait_time() if delay is None else min(delay, bucket.wait_time())
+                remaining.append(entry)
+                continue
+
+            self._overall.tokens -= 1
+            if bucket is not None:
+                bucket.tokens -= 1
+            if grant is not None:
+                grant.granted = True
+            future.set_result(None)
+
+        self._waiting = remaining
+        if len(self._chats) > self.max_chat_buckets:
+            self._prune(now)
+        if not remaining:
+            return None
+        return delay
+
+    def _chat_bucket(self, chat_id, now):
+        if chat_id is None:
+            return None
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            # Negative ids are groups and channels, and so are @usernames
+            is_group = not key.isdigit()
+            bucket = self._chats[key] = _TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+        bucket.refill(now)
+        return bucket
+
+    def _prune(self, now):
+        """Forget chats whose bucket has refilled, a new bucket would start out the same"""
+        for key, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._chats[key]
+
+
+class StatusMessage:
+    """A low-priority "🔄 Processing…" reply that is dropped if the result goes out first
+
+    The message is queued right away without waiting for it. clear()
+    deletes it once sent, or cancels it while it is still queued; drop()
+    only cancels, for progress messages that a newer one supersedes.
+    """
+
+    def __init__(self, message, text):
+        self._message = message
+        self._grant = Grant()
+        self._task = asyncio.get_running_loop().create_task(self._send(text))
+
+    async def _send(self, text):
+        return await self._message.get_bot().send_message(
+            chat_id=self._message.chat_id,
+            text=text,
+            rate_limit_args={'priority': STATUS_PRIORITY, 'grant': self._grant}
+        )
+
+    def drop(self):
+        """Cancel the message if it hasn't gone out yet; returns whether it was dropped"""
+        if self._grant.granted:
+            return False
+        self._task.cancel()
+        metrics.DROPPED_STATUS_MESSAGES.labels().inc()
+        return True
+
+    async def clear(self):
+        """Remove the status message, whether or not it has gone out yet"""
+        if self.drop():
+            return
+
+        try:
+            sent = await self._task
+        except Exception as e:
+            logger.warning(f"Status message was not sent: {str(e)}")
+            return
+        await sent.delete()
+
+
+def _seconds(retry_after):
+    # retry_after is an int in older releases and a timedelta in newer ones
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
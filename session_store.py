@@ -0,0 +1,404 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class SessionBusyError(Exception):
+    """Raised when another worker holds the lease on a session"""
+
+
+class SessionStore(ABC):
+    """Merge sessions and conversion jobs shared by every worker process
+
+    Sessions are JSON-serializable dicts under a string key. A worker
+    claims a session for `lease` seconds while it works on it and releases
+    it afterwards; a lease that runs out (its worker died) can be claimed
+    again. Jobs are JSON payloads; claiming one is also a lease, renewed
+    while the job runs, so jobs of a crashed worker are picked up by the
+    next one that asks.
+    """
+
+    @abstractmethod
+    def put_session(self, key, state, owner=None, lease=0):
+        """Create or replace a session, optionally claimed by owner"""
+
+    @abstractmethod
+    def get_session(self, key):
+        """Return a session's state without claiming it, or None"""
+
+    @abstractmethod
+    def claim_session(self, key, owner, lease):
+        """Lease a session to owner and return its state; None if there is none, SessionBusyError if held"""
+
+    @abstractmethod
+    def release_session(self, key, owner, state=None):
+        """Save the new state (if given) and give up the lease; returns False if owner no longer held it"""
+
+    @abstractmethod
+    def delete_session(self, key):
+        """Remove a session, returning its last state or None"""
+
+    @abstractmethod
+    def expire_sessions(self, ttl):
+        """Remove sessions untouched for ttl seconds and not leased, returning their states"""
+
+    @abstractmethod
+    def add_job(self, kind, payload, owner=None, lease=0):
+        """Queue a job, already claimed by owner if given; returns its id"""
+
+    @abstractmethod
+    def claim_job(self, owner, lease):
+        """Lease the oldest unclaimed or abandoned job, or return None
+
+        Returns a dict with id, kind, payload and attempts (including this one).
+        """
+
+    @abstractmethod
+    def renew_job(self, job_id, owner, lease):
+        """Extend the lease on a running job; returns False if owner lost it"""
+
+    @abstractmethod
+    def finish_job(self, job_id):
+        """Remove a job that was handled, successfully or not"""
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store in a SQLite database in WAL mode, shared by processes on the same host
+
+    States and payloads are stored as zlib-compressed JSON.
+    """
+
+    def __init__(self, db_path, busy_timeout=10):
+        self._lock = threading.Lock()
+        # Autocommit mode, claims open their own IMMEDIATE transactions
+        self._connection = sqlite3.connect(
+            db_path, timeout=busy_timeout, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " key TEXT PRIMARY KEY,"
+            " state BLOB NOT NULL,"
+            " owner TEXT,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " payload BLOB NOT NULL,"
+            " owner TEXT,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_lease_until ON jobs (lease_until)")
+
+    def put_session(self, key, state, owner=None, lease=0):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sessions (key, state, owner, lease_until, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (key, _pack(state), owner, now + lease if owner else 0, now)
+            )
+
+    def get_session(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT state FROM sessions WHERE key = ?", (key,)).fetchone()
+        return _unpack(row[0]) if row else None
+
+    def claim_session(self, key, owner, lease):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT state, owner, lease_until FROM sessions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            state, current_owner, lease_until = row
+            if current_owner and current_owner != owner and lease_until > now:
+                raise SessionBusyError(f"Session {key} is held by {current_owner}")
+            connection.execute(
+                "UPDATE sessions SET owner = ?, lease_until = ? WHERE key = ?", (owner, now + lease, key)
+            )
+        return _unpack(state)
+
+    def release_session(self, key, owner, state=None):
+        now = time.time()
+        with self._lock:
+            if state is None:
+                cursor = self._connection.execute(
+                    "UPDATE sessions SET owner = NULL, lease_until = 0, updated_at = ? WHERE key = ? AND owner = ?",
+                    (now, key, owner)
+                )
+            else:
+                cursor = self._connection.execute(
+                    "UPDATE sessions SET state = ?, owner = NULL, lease_until = 0, updated_at = ?"
+                    " WHERE key = ? AND owner = ?",
+                    (_pack(state), now, key, owner)
+                )
+        return cursor.rowcount == 1
+
+    def delete_session(self, key):
+        with self._transaction() as connection:
+            row = connection.execute("SELECT state FROM sessions WHERE key = ?", (key,)).fetchone()
+            connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        return _unpack(row[0]) if row else None
+
+    def expire_sessions(self, ttl):
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT key, state FROM sessions WHERE updated_at < ? AND lease_until < ?", (now - ttl, now)
+            ).fetchall()
+            connection.executemany("DELETE FROM sessions WHERE key = ?", [(key,) for key, _ in rows])
+        return [_unpack(state) for _, state in rows]
+
+    def add_job(self, kind, payload, owner=None, lease=0):
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (kind, payload, owner, lease_until, attempts, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, _pack(payload), owner, now + lease if owner else 0, 1 if owner else 0, now)
+            )
+        return cursor.lastrowid
+
+    def claim_job(self, owner, lease):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT id, kind, payload, attempts FROM jobs"
+                " WHERE owner IS NULL OR lease_until < ? ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, kind, payload, attempts = row
+            connection.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ?, attempts = ? WHERE id = ?",
+                (owner, now + lease, attempts + 1, job_id)
+            )
+        return {'id': job_id, 'kind': kind, 'payload': _unpack(payload), 'attempts': attempts + 1}
+
+    def renew_job(self, job_id, owner, lease):
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ?", (time.time() + lease, job_id, owner)
+            )
+        return cursor.rowcount == 1
+
+    def finish_job(self, job_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+
+class SocketSessionStore(SessionStore):
+    """Client for a SessionStoreServer on a local Unix socket
+
+    For workers that should not open the database themselves. Requests
+    and replies are single JSON lines over one persistent connection.
+    """
+
+    def __init__(self, socket_path, timeout=10):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._reader = None
+
+    def put_session(self, key, state, owner=None, lease=0):
+        return self._call('put_session', key, state, owner, lease)
+
+    def get_session(self, key):
+        return self._call('get_session', key)
+
+    def claim_session(self, key, owner, lease):
+        return self._call('claim_session', key, owner, lease)
+
+    def release_session(self, key, owner, state=None):
+        return self._call('release_session', key, owner, state)
+
+    def delete_session(self, key):
+        return self._call('delete_session', key)
+
+    def expire_sessions(self, ttl):
+        return self._call('expire_sessions', ttl)
+
+    def add_job(self, kind, payload, owner=None, lease=0):
+        return self._call('add_job', kind, payload, owner, lease)
+
+    def claim_job(self, owner, lease):
+        return self._call('claim_job', owner, lease)
+
+    def renew_job(self, job_id, owner, lease):
+        return self._call('renew_job', job_id, owner, lease)
+
+    def finish_job(self, job_id):
+        return self._call('finish_job', job_id)
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _call(self, method, *args):
+        request = json.dumps({'method': method, 'args': args}, separators=(',', ':')).encode() + b"\n"
+        with self._lock:
+            reconnected = self._socket is None
+            if reconnected:
+                self._connect()
+            try:
+                self._socket.sendall(request)
+            except OSError:
+                # The server restarted since our last call; nothing was sent, so retry once
+                self._disconnect()
+                if reconnected:
+                    raise
+                self._connect()
+                self._socket.sendall(request)
+            try:
+                line = self._reader.readline()
+            except OSError:
+                self._disconnect()
+                raise
+            if not line:
+                self._disconnect()
+                raise ConnectionError("Session store closed the connection")
+
+        response = json.loads(line)
+        if 'error' in response:
+            if response.get('type') == 'SessionBusyError':
+                raise SessionBusyError(response['error'])
+            raise Exception(f"Error in session store: {response['error']}")
+        return response['result']
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        connection.connect(self.socket_path)
+        self._socket = connection
+        self._reader = connection.makefile('rb')
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+        self._socket = None
+        self._reader = None
+
+
+class SessionStoreServer:
+    """Serve a SessionStore to SocketSessionStore clients over a Unix socket"""
+
+    METHODS = (
+        'put_session', 'get_session', 'claim_session', 'release_session', 'delete_session', 'expire_sessions',
+        'add_job', 'claim_job', 'renew_job', 'finish_job',
+    )
+
+    def __init__(self, store, socket_path):
+        self.store = store
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, self._make_handler())
+        self._server.daemon_threads = True
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, name='session-store-server', daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _make_handler(self):
+        store = self.store
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                        if request['method'] not in SessionStoreServer.METHODS:
+                            raise Exception(f"Unknown method {request['method']}")
+                        response = {'result': getattr(store, request['method'])(*request['args'])}
+                    except Exception as e:
+                        response = {'error': str(e), 'type': type(e).__name__}
+                    self.wfile.write(json.dumps(response, separators=(',', ':')).encode() + b"\n")
+
+        return Handler
+
+
+def open_session_store(url):
+    """Open the store named by a sqlite:///path/to/db or unix:///path/to/socket URL"""
+    if url.startswith('sqlite:///'):
+        return SQLiteSessionStore(url[len('sqlite:///'):])
+    if url.startswith('unix://'):
+        return SocketSessionStore(url[len('unix://'):])
+    raise ValueError(f"Unsupported session store URL: {url}")
+
+
+def _pack(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a SQLite session store to bot workers over a Unix socket")
+    parser.add_argument('db_path')
+    parser.add_argument('socket_path')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    server = SessionStoreServer(SQLiteSessionStore(args.db_path), args.socket_path)
+    logger.info(f"Serving {args.db_path} on {args.socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
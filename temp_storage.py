@@ -0,0 +1,210 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Short-lived files of one request, and merge outputs that outlive requests
+SCRATCH_DIR = 'scratch'
+MERGE_DIR = 'merges'
+
+
+class StorageFullError(Exception):
+    """Raised when a temp allocation doesn't fit the disk budget"""
+
+
+def scratch_path(suffix=''):
+    """A fresh path for a short-lived file under TEMP_DIR, usable from worker processes too"""
+    return _new_path(SCRATCH_DIR, suffix)
+
+
+def merge_path():
+    """A fresh path for a merge session's output under TEMP_DIR"""
+    return _new_path(MERGE_DIR, '.pdf')
+
+
+def _new_path(subdir, suffix):
+    directory = os.path.join(config.TEMP_DIR, subdir)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{str(uuid.uuid4())}{suffix}")
+
+
+class TempStorage:
+    """Disk budget for everything under TEMP_DIR
+
+    Requests work inside a scope(): they reserve the bytes they expect to
+    write before downloading anything, and every file the scope handed out
+    or adopted is deleted when it closes, whatever happened. Reservations
+    count against max_bytes together with the files no scope owns (merge
+    outputs, and anything other workers wrote) as measured by the last
+    sweep(). When a reservation doesn't fit, merge outputs untouched for
+    stale_merge_age seconds are evicted, least recently written first.
+
+    sweep() is the janitor: it remeasures the disk and deletes files that
+    no scope owns and nobody has touched for orphan_age seconds, such as
+    leftovers of a crashed worker.
+    """
+
+    def __init__(self, root, max_bytes, min_free_bytes=0, stale_merge_age=600, orphan_age=3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.stale_merge_age = stale_merge_age
+        self.orphan_age = orphan_age
+        for subdir in (SCRATCH_DIR, MERGE_DIR):
+            os.makedirs(os.path.join(root, subdir), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._owned = set()
+        self._disk_bytes = 0
+        self._evictable_bytes = 0
+        self.sweep()
+
+    def scope(self):
+        """Start tracking the temp files of one request"""
+        return TempScope(self)
+
+    def can_accept(self, size):
+        """Cheap check used before downloading anything for a request, counting idle merges as evictable"""
+        with self._lock:
+            return self._fits(max(0, size - self._evictable_bytes))
+
+    def usage(self):
+        """Bytes reserved by open scopes, bytes on disk outside them, and free space on the filesystem"""
+        with self._lock:
+            return {'reserved': self._reserved, 'disk': self._disk_bytes, 'free': self._free_bytes()}
+
+    def sweep(self):
+        """Delete orphaned files and remeasure the bytes on disk that no scope owns"""
+        now = time.time()
+        disk_bytes = 0
+        evictable_bytes = 0
+        for path, stat in self._files():
+            with self._lock:
+                if path in self._owned:
+                    continue
+            if stat.st_mtime < now - self.orphan_age:
+                self._remove(path, 'orphan')
+                continue
+            disk_bytes += stat.st_size
+            if os.path.basename(os.path.dirname(path)) == MERGE_DIR and stat.st_mtime < now - self.stale_merge_age:
+                evictable_bytes += stat.st_size
+        with self._lock:
+            self._disk_bytes = disk_bytes
+            self._evictable_bytes = evictable_bytes
+
+    def _reserve(self, size):
+        with self._lock:
+            if self._fits(size):
+                self._reserved += size
+                return
+        self._evict_stale_merges(size)
+        with self._lock:
+            if not self._fits(size):
+                metrics.TEMP_REJECTIONS.labels().inc()
+                raise StorageFullError(f"No room for {size} more bytes in {self.root}")
+            self._reserved += size
+
+    def _release(self, size, paths):
+        with self._lock:
+            self._reserved -= size
+            self._owned.difference_update(paths)
+
+    def _own(self, path):
+        with self._lock:
+            self._owned.add(path)
+
+    def _fits(self, size):
+        if self._disk_bytes + self._reserved + size > self.max_bytes:
+            return False
+        return self._free_bytes() - size >= self.min_free_bytes
+
+    def _free_bytes(self):
+        return shutil.disk_usage(self.root).free
+
+    def _evict_stale_merges(self, size):
+        """Delete idle merge outputs, least recently written first, until size bytes fit"""
+        cutoff = time.time() - self.stale_merge_age
+        merges = [(stat.st_mtime, stat.st_size, path) for path, stat in self._files(MERGE_DIR)
+                  if stat.st_mtime < cutoff]
+        for _, file_size, path in sorted(merges):
+            with self._lock:
+                if self._fits(size):
+                    return
+                self._disk_bytes = max(0, self._disk_bytes - file_size)
+                self._evictable_bytes = max(0, self._evictable_bytes - file_size)
+            logger.warning(f"Evicting idle merge output {path} to free disk space")
+            self._remove(path, 'budget')
+
+    def _files(self, *subdirs):
+        for subdir in subdirs or (SCRATCH_DIR, MERGE_DIR):
+            try:
+                entries = list(os.scandir(os.path.join(self.root, subdir)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        yield entry.path, entry.stat()
+                except FileNotFoundError:
+                    # Removed by its owner while we were looking
+                    continue
+
+    @staticmethod
+    def _remove(path, reason):
+        try:
+            os.remove(path)
+            metrics.TEMP_EVICTIONS.labels(reason=reason).inc()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error removing temp file {path}: {str(e)}")
+
+
+class TempScope:
+    """Reserved bytes and temp files of one request, all released by close()"""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._reserved = 0
+        self._paths = []
+
+    def reserve(self, size):
+        """Reserve room for size more bytes, raising StorageFullError if they don't fit"""
+        if size:
+            self._storage._reserve(size)
+            self._reserved += size
+
+    def path(self, suffix=''):
+        """A fresh scratch path, deleted when the scope closes"""
+        return self.adopt(scratch_path(suffix))
+
+    def adopt(self, path):
+        """Delete a file created elsewhere, e.g. by a worker process, when the scope closes"""
+        self._storage._own(path)
+        self._paths.append(path)
+        return path
+
+    def close(self):
+        for path in self._paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                logger.error(f"Error removing temp file {path}: {str(e)}")
+        self._storage._release(self._reserved, self._paths)
+        self._reserved = 0
+        self._paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
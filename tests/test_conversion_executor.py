@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import time
+
+import pytest
+
+from conversion_executor import ConversionExecutor, DeadlineExceededError, JobScheduler
+
+
+async def grant_order(scheduler, jobs, holder_lane):
+    """Queue jobs, a list of (name, lane, user_id, cost), behind a held slot; returns the order they got slots in"""
+    order = []
+
+    async def job(name, lane, user_id, cost):
+        release = await scheduler.acquire(lane, user_id, cost)
+        order.append(name)
+        await asyncio.sleep(0)
+        release()
+
+    release_holder = await scheduler.acquire(holder_lane, 'holder')
+    tasks = [asyncio.ensure_future(job(*args)) for args in jobs]
+    await asyncio.sleep(0)
+    release_holder()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_lanes_share_slots_by_weight():
+    async def main():
+        scheduler = JobScheduler(1, {'fast': (3, None, None), 'slow': (1, None, None)})
+        jobs = [(f"fast{number}", 'fast', number, 1.0) for number in range(8)]
+        jobs += [(f"slow{number}", 'slow', number, 1.0) for number in range(8)]
+        return await grant_order(scheduler, jobs, 'fast')
+
+    order = asyncio.run(main())
+    assert sum(name.startswith('slow') for name in order[:8]) == 2
+
+
+def test_users_take_turns_within_a_lane():
+    async def main():
+        scheduler = JobScheduler(1, {'lane': (1, None, None)})
+        jobs = [(f"a{number}", 'lane', 'a', 1.0) for number in range(4)] + [('b0', 'lane', 'b', 1.0)]
+        return await grant_order(scheduler, jobs, 'lane')
+
+    order = asyncio.run(main())
+    assert order.index('b0') == 1
+
+
+def test_cheaper_jobs_go_first():
+    async def main():
+        scheduler = JobScheduler(1, {'lane': (1, None, None)})
+        return await grant_order(scheduler, [('big', 'lane', 'a', 5.0), ('small', 'lane', 'b', 1.0)], 'lane')
+
+    assert asyncio.run(main()) == ['small', 'big']
+
+
+def test_lane_limit_leaves_slots_to_other_lanes():
+    async def main():
+        scheduler = JobScheduler(2, {'limited': (1, None, 1), 'other': (1, None, None)})
+        release = await scheduler.acquire('limited', 'a')
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire('limited', 'b'), 0.05)
+        assert scheduler.queued('limited') == 0
+        release_other = await asyncio.wait_for(scheduler.acquire('other', 'c'), 1)
+        release_other()
+        release()
+
+    asyncio.run(main())
+
+
+def test_deadline_cancels_waiting_job_without_leaking_its_slot():
+    async def main():
+        scheduler = JobScheduler(1, {'lane': (1, 0.05, None)})
+        release = await scheduler.acquire('lane', 'a')
+        with pytest.raises(DeadlineExceededError):
+            await scheduler.acquire('lane', 'b')
+        assert scheduler.queued() == 0
+        release()
+        release_next = await asyncio.wait_for(scheduler.acquire('lane', 'c'), 1)
+        release_next()
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        scheduler = JobScheduler(1, {'lane': (1, None, None)})
+        release = await scheduler.acquire('lane', 'a')
+        waiter = asyncio.ensure_future(scheduler.acquire('lane', 'b'))
+        await asyncio.sleep(0)
+        assert scheduler.queued('lane') == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.queued('lane') == 0
+        release()
+        release_next = await asyncio.wait_for(scheduler.acquire('lane', 'c'), 1)
+        release_next()
+
+    asyncio.run(main())
+
+
+def test_release_is_idempotent():
+    async def main():
+        scheduler = JobScheduler(1, {'lane': (1, None, None)})
+        release = await scheduler.acquire('lane', 'a')
+        release()
+        release()
+        first = await asyncio.wait_for(scheduler.acquire('lane', 'b'), 1)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire('lane', 'c'), 0.05)
+        first()
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def executor():
+    executor = ConversionExecutor(max_workers=1, max_jobs_per_user=4)
+    for future in executor.start():
+        future.result()
+    yield executor
+    executor.shutdown()
+
+
+def test_cancelled_job_keeps_its_worker_until_it_finishes(executor):
+    async def main():
+        running = asyncio.ensure_future(executor.run('a', time.sleep, 0.5))
+        await asyncio.sleep(0.1)
+        running.cancel()
+        started = time.monotonic()
+        await executor.run('b', time.sleep, 0)
+        return time.monotonic() - started
+
+    # The second job only gets the worker once the first one's sleep is over
+    assert asyncio.run(main()) >= 0.3
+
+
+def test_map_yields_results_in_order(executor):
+    async def main():
+        results = executor.map('a', pow, [(2, number) for number in range(10)], window=3)
+        async with contextlib.aclosing(results):
+            return [result async for result in results]
+
+    assert asyncio.run(main()) == [2 ** number for number in range(10)]
+
+
+def test_map_releases_its_job_when_closed_early(executor):
+    async def main():
+        results = executor.map('a', pow, [(2, number) for number in range(10)], window=3)
+        async with contextlib.aclosing(results):
+            async for _ in results:
+                break
+        return executor.queue_depth()
+
+    assert asyncio.run(main()) == 0
+
+
+def test_map_raises_the_first_failure(executor):
+    async def main():
+        results = executor.map('a', int, [('1',), ('x',), ('3',)])
+        async with contextlib.aclosing(results):
+            return [result async for result in results]
+
+    with pytest.raises(ValueError):
+        asyncio.run(main())
@@ -0,0 +1,142 @@
+import io
+import json
+
+import pytest
+from PIL import Image
+from pypdf import PdfReader
+
+from image_converter import ImageConverter
+from pdf_converter import PDFMergeSession
+from pdf_writer import PDFWriter
+
+
+def jpeg(size, color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def write_text_pdf(path, pages, compress=False):
+    """Write a PDF with one page of text per string in pages"""
+    with open(path, 'wb') as output:
+        writer = PDFWriter(output, compress=compress)
+        for text in pages:
+            writer.add_text_page([(72, 720, text)])
+        writer.close()
+    return path
+
+
+def image_ids(reader):
+    return [page['/Resources']['/XObject'].raw_get('/Im0').idnum for page in reader.pages]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_text_pages_round_trip(compress):
+    output = io.BytesIO()
+    writer = PDFWriter(output, compress=compress)
+    writer.add_text_page([(72, 720, 'First page')])
+    writer.add_text_page([(72, 720, 'Second (page)')], page_width=300, page_height=400)
+    writer.close()
+
+    reader = PdfReader(io.BytesIO(output.getvalue()))
+    assert len(reader.pages) == 2
+    assert 'First page' in reader.pages[0].extract_text()
+    assert 'Second (page)' in reader.pages[1].extract_text()
+    assert [float(value) for value in reader.pages[1].mediabox] == [0, 0, 300, 400]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_writer_resumes_from_its_state(compress):
+    output = io.BytesIO()
+    writer = PDFWriter(output, compress=compress)
+    writer.add_text_page([(72, 720, 'Before')])
+    state = json.loads(json.dumps(writer.state()))
+
+    writer = PDFWriter(output, state=state)
+    writer.add_text_page([(72, 720, 'After')])
+    writer.close()
+
+    reader = PdfReader(io.BytesIO(output.getvalue()))
+    assert [page.extract_text().strip() for page in reader.pages] == ['Before', 'After']
+
+
+def test_pages_can_share_an_image():
+    data = jpeg((320, 240))
+    output = io.BytesIO()
+    writer = PDFWriter(output)
+    image = writer.add_image(data, 320, 240, '/DeviceRGB', image_filter='/DCTDecode')
+    writer.add_image_page(image, 320, 240)
+    writer.add_image_page(image, 160, 120)
+    writer.close()
+
+    reader = PdfReader(io.BytesIO(output.getvalue()))
+    assert len(reader.pages) == 2
+    assert image_ids(reader)[0] == image_ids(reader)[1]
+    assert reader.pages[1].images[0].image.size == (320, 240)
+
+
+def test_write_pages_embeds_repeated_jpegs_once():
+    red, blue = jpeg((320, 240), 'red'), jpeg((320, 240), 'blue')
+    pages = [(data, ImageConverter.read_jpeg_info(data)) for data in (red, blue, red)]
+    output = io.BytesIO()
+    ImageConverter.write_pages(pages, output)
+
+    reader = PdfReader(io.BytesIO(output.getvalue()))
+    ids = image_ids(reader)
+    assert ids[0] == ids[2] != ids[1]
+    assert len(output.getvalue()) < 2 * len(red) + 2 * len(blue)
+
+
+@pytest.mark.parametrize('profile', ['original', 'balanced'])
+def test_merge_copies_pages_in_order(tmp_path, profile):
+    first = write_text_pdf(tmp_path / 'first.pdf', ['one', 'two'])
+    second = write_text_pdf(tmp_path / 'second.pdf', ['three'], compress=True)
+
+    session = PDFMergeSession(output_path=str(tmp_path / 'merged.pdf'), profile=profile)
+    assert session.add(str(first)) == 2
+    # A worker process continues the merge from the saved state
+    state = PDFMergeSession.add_to_state(json.loads(json.dumps(session.state())), str(second))
+    session = PDFMergeSession(state=state)
+    merged = session.finalize()
+
+    reader = PdfReader(merged)
+    assert session.file_count == 2
+    assert [page.extract_text().strip() for page in reader.pages] == ['one', 'two', 'three']
+
+
+def test_merge_writes_identical_objects_once(tmp_path):
+    data = jpeg((800, 600))
+    source = tmp_path / 'photo.pdf'
+    with open(source, 'wb') as output:
+        writer = PDFWriter(output)
+        writer.add_image_page(writer.add_image(data, 800, 600, '/DeviceRGB', image_filter='/DCTDecode'), 576, 432)
+        writer.close()
+
+    session = PDFMergeSession(output_path=str(tmp_path / 'merged.pdf'), profile='original')
+    session.add(str(source))
+    session.add(str(source))
+    merged = session.finalize()
+
+    reader = PdfReader(merged)
+    assert len(reader.pages) == 2
+    ids = image_ids(reader)
+    assert ids[0] == ids[1]
+    assert (tmp_path / 'merged.pdf').stat().st_size < 1.5 * source.stat().st_size
+
+
+def test_merge_downsamples_large_images_for_small_profiles(tmp_path):
+    data = jpeg((1600, 1200))
+    source = tmp_path / 'photo.pdf'
+    with open(source, 'wb') as output:
+        writer = PDFWriter(output)
+        # Shown on a small page, so 1600 pixels are far more than 150 DPI needs
+        writer.add_image_page(writer.add_image(data, 1600, 1200, '/DeviceRGB', image_filter='/DCTDecode'), 200, 150)
+        writer.close()
+
+    session = PDFMergeSession(output_path=str(tmp_path / 'merged.pdf'), profile='balanced')
+    session.add(str(source))
+    reader = PdfReader(session.finalize())
+
+    width, height = reader.pages[0].images[0].image.size
+    assert width < 1600 and height < 1200
+    assert [float(value) for value in reader.pages[0].mediabox] == [0, 0, 200, 150]
@@ -0,0 +1,151 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from send_scheduler import STATUS_PRIORITY, Grant, SendScheduler
+
+
+async def send(scheduler, endpoint, chat_id, calls, rate_limit_args=None, callback=None):
+    """Push one request through the scheduler, recording (endpoint, chat_id, time) when it is let through"""
+    async def record():
+        calls.append((endpoint, chat_id, time.monotonic()))
+        if callback:
+            return await callback()
+        return True
+
+    return await scheduler.process_request(record, (), {}, endpoint, {'chat_id': chat_id}, rate_limit_args)
+
+
+def run(scheduler, test):
+    async def main():
+        await scheduler.initialize()
+        try:
+            return await test()
+        finally:
+            await scheduler.shutdown()
+
+    return asyncio.run(main())
+
+
+def test_chat_bucket_allows_a_burst_then_paces():
+    scheduler = SendScheduler(overall_rate=1000, chat_rate=10, chat_burst=2)
+    calls = []
+
+    async def test():
+        started = time.monotonic()
+        await asyncio.gather(*(send(scheduler, 'sendMessage', 1, calls) for _ in range(4)))
+        return [at - started for _, _, at in calls]
+
+    delays = run(scheduler, test)
+    assert delays[1] < 0.05
+    assert delays[3] >= 0.15
+
+
+def test_groups_refill_slower_than_private_chats():
+    scheduler = SendScheduler(overall_rate=1000, chat_rate=100, group_rate=5, chat_burst=1)
+    calls = []
+
+    async def test():
+        started = time.monotonic()
+        await asyncio.gather(*(send(scheduler, 'sendMessage', chat_id, calls) for chat_id in (1, 1, -100, -100)))
+        return {chat_id: at - started for _, chat_id, at in calls}
+
+    # The last message to each chat waited for one token of its bucket
+    delays = run(scheduler, test)
+    assert delays[1] < 0.1
+    assert delays[-100] >= 0.15
+
+
+def test_overall_bucket_limits_all_chats_together():
+    scheduler = SendScheduler(overall_rate=10, chat_rate=100, chat_burst=10)
+    calls = []
+
+    async def test():
+        started = time.monotonic()
+        await asyncio.gather(*(send(scheduler, 'sendMessage', chat_id, calls) for chat_id in range(15)))
+        return sorted(at - started for _, _, at in calls)
+
+    delays = run(scheduler, test)
+    assert delays[9] < 0.05
+    assert delays[14] >= 0.4
+
+
+def test_results_go_out_before_replies_and_status_messages():
+    scheduler = SendScheduler(overall_rate=5, chat_rate=100, chat_burst=10)
+    calls = []
+
+    async def test():
+        # Use up the overall bucket so the next requests have to wait for tokens
+        await asyncio.gather(*(send(scheduler, 'sendMessage', chat_id, []) for chat_id in range(5)))
+        await asyncio.gather(
+            send(scheduler, 'sendMessage', 10, calls, {'priority': STATUS_PRIORITY}),
+            send(scheduler, 'sendMessage', 11, calls),
+            send(scheduler, 'sendDocument', 12, calls),
+        )
+        return [chat_id for _, chat_id, _ in calls]
+
+    assert run(scheduler, test) == [12, 11, 10]
+
+
+def test_unlimited_methods_skip_the_buckets():
+    scheduler = SendScheduler(overall_rate=1, chat_rate=1, chat_burst=1)
+    calls = []
+
+    async def test():
+        await send(scheduler, 'sendMessage', 1, calls)
+        started = time.monotonic()
+        await send(scheduler, 'getFile', 1, calls)
+        return time.monotonic() - started
+
+    assert run(scheduler, test) < 0.05
+
+
+def test_grant_is_set_when_the_request_goes_out():
+    scheduler = SendScheduler(overall_rate=100, chat_rate=100, chat_burst=10)
+    grant = Grant()
+
+    async def test():
+        await send(scheduler, 'sendMessage', 1, [], {'grant': grant})
+
+    run(scheduler, test)
+    assert grant.granted
+
+
+def test_flood_wait_pauses_every_request_then_retries():
+    scheduler = SendScheduler(overall_rate=100, chat_rate=100, chat_burst=10)
+    calls = []
+    failures = [RetryAfter(1)]
+
+    async def flooded():
+        if failures:
+            raise failures.pop()
+        return 'sent'
+
+    async def test():
+        started = time.monotonic()
+        first = asyncio.ensure_future(send(scheduler, 'sendDocument', 1, calls, callback=flooded))
+        await asyncio.sleep(0.1)
+        # Other chats and even unlimited methods wait out the pause too
+        await asyncio.gather(send(scheduler, 'sendMessage', 2, calls), send(scheduler, 'getFile', 3, calls))
+        return await first, {chat_id: at - started for _, chat_id, at in calls}
+
+    result, delays = run(scheduler, test)
+    assert result == 'sent'
+    assert delays[1] >= 0.9
+    assert delays[2] >= 0.9
+    assert delays[3] >= 0.9
+
+
+def test_flood_wait_gives_up_after_max_retries():
+    scheduler = SendScheduler(overall_rate=100, chat_rate=100, chat_burst=10, max_retries=1)
+
+    async def always_flooded():
+        raise RetryAfter(0)
+
+    async def test():
+        await send(scheduler, 'sendMessage', 1, [], callback=always_flooded)
+
+    with pytest.raises(RetryAfter):
+        run(scheduler, test)
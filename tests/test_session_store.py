@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from session_store import SessionBusyError, SessionStoreServer, SocketSessionStore, SQLiteSessionStore
+
+LEASE = 0.2
+
+
+@pytest.fixture(params=['sqlite', 'socket'])
+def store(request, tmp_path):
+    sqlite_store = SQLiteSessionStore(str(tmp_path / 'sessions.sqlite3'))
+    if request.param == 'sqlite':
+        yield sqlite_store
+        sqlite_store.close()
+        return
+
+    # Unix socket paths are limited to about 100 bytes, too few for pytest's tmp_path
+    directory = tempfile.mkdtemp(prefix='store')
+    server = SessionStoreServer(sqlite_store, os.path.join(directory, 'store.sock'))
+    server.start()
+    client = SocketSessionStore(server.socket_path)
+    yield client
+    client.close()
+    server.close()
+    sqlite_store.close()
+    shutil.rmtree(directory)
+
+
+def test_claimed_session_is_busy_for_other_workers(store):
+    store.put_session('merge:1', {'files': 1})
+    assert store.claim_session('merge:1', 'a', LEASE) == {'files': 1}
+    with pytest.raises(SessionBusyError):
+        store.claim_session('merge:1', 'b', LEASE)
+    # The holder may claim it again, e.g. to extend its lease
+    assert store.claim_session('merge:1', 'a', LEASE) == {'files': 1}
+
+
+def test_released_session_can_be_claimed_right_away(store):
+    store.put_session('merge:1', {'files': 1}, 'a', LEASE)
+    assert store.release_session('merge:1', 'a', {'files': 2})
+    assert store.claim_session('merge:1', 'b', LEASE) == {'files': 2}
+
+
+def test_expired_session_lease_is_taken_over(store):
+    store.put_session('merge:1', {'files': 1})
+    store.claim_session('merge:1', 'a', LEASE)
+    time.sleep(LEASE + 0.1)
+    assert store.claim_session('merge:1', 'b', LEASE) == {'files': 1}
+
+    # The worker that lost the lease can no longer save over the new owner's work
+    assert not store.release_session('merge:1', 'a', {'files': 5})
+    assert store.release_session('merge:1', 'b', {'files': 2})
+    assert store.get_session('merge:1') == {'files': 2}
+
+
+def test_missing_session_claims_as_none(store):
+    assert store.claim_session('merge:1', 'a', LEASE) is None
+    assert store.delete_session('merge:1') is None
+
+
+def test_expire_sessions_skips_leased_ones(store):
+    store.put_session('merge:1', {'files': 1})
+    store.put_session('merge:2', {'files': 2}, 'a', 60)
+    assert store.expire_sessions(0) == [{'files': 1}]
+    assert store.get_session('merge:1') is None
+    assert store.get_session('merge:2') == {'files': 2}
+
+
+def test_job_lease_expiry_and_takeover(store):
+    job_id = store.add_job('convert', {'file_id': 'x'})
+    job = store.claim_job('a', LEASE)
+    assert (job['id'], job['kind'], job['payload'], job['attempts']) == (job_id, 'convert', {'file_id': 'x'}, 1)
+    assert store.claim_job('b', LEASE) is None
+    assert store.renew_job(job_id, 'a', LEASE)
+
+    time.sleep(LEASE + 0.1)
+    job = store.claim_job('b', 60)
+    assert (job['id'], job['attempts']) == (job_id, 2)
+    # The first worker learns it lost the job when it next renews
+    assert not store.renew_job(job_id, 'a', LEASE)
+
+    store.finish_job(job_id)
+    assert store.claim_job('c', LEASE) is None
+
+
+def test_job_added_with_an_owner_is_already_claimed(store):
+    job_id = store.add_job('convert', {'file_id': 'x'}, 'a', LEASE)
+    assert store.claim_job('b', LEASE) is None
+    assert store.renew_job(job_id, 'a', LEASE)
+    time.sleep(LEASE + 0.1)
+    assert store.claim_job('b', LEASE)['id'] == job_id